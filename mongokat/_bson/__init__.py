@@ -1,97 +1,97 @@
 
 import bson
-import sys
-from bson.codec_options import DEFAULT_CODEC_OPTIONS, CodecOptions, _raw_document_class
+import datetime
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from mongokat.metrics import metrics
+from mongokat.records import Record
+
+# The original decoder, from the C extension when it is available
+_decode_all = bson.decode_all
+
+_BATCH_KEYS = ("firstBatch", "nextBatch")
 
 
 def decode_all(data, codec_options=DEFAULT_CODEC_OPTIONS):
-    if not isinstance(codec_options, CodecOptions):
-        raise bson._CODEC_OPTIONS_TYPE_ERROR
-    docs = []
-    position = 0
-    end = len(data) - 1
-    use_raw = _raw_document_class(codec_options.document_class)
-    try:
-        while position < end:
-            obj_size = bson._UNPACK_INT(data[position:position + 4])[0]
-            if len(data) - position < obj_size:
-                raise bson.InvalidBSON("invalid object size")
-            obj_end = position + obj_size - 1
-            if data[obj_end:position + obj_size] != b"\x00":
-                raise bson.InvalidBSON("bad eoo")
-            if use_raw:
-                docs.append(
-                    codec_options.document_class(
-                        data[position:obj_end + 1], codec_options))
-            else:
-                docs.append(_elements_to_dict(data,
-                                              position + 4,
-                                              obj_end,
-                                              codec_options))
-            position += obj_size
-        return docs
-    except bson.InvalidBSON:
-        raise
-    except Exception:
-        # Change exception type to InvalidBSON but preserve traceback.
-        _, exc_value, exc_tb = sys.exc_info()
-        bson.reraise(bson.InvalidBSON, exc_value, exc_tb)
-
-
-def _element_to_dict(data, position, obj_end, opts):
-    """Decode a single key, value pair."""
-    element_type = data[position:position + 1]
-    position += 1
-    element_name, position = bson._get_c_string(data, position, opts)
-    value, position = bson._ELEMENT_GETTER[element_type](data, position,
-                                                        obj_end, opts,
-                                                        element_name)
-    return element_name, value, position
-
-
-def _iterate_elements(data, position, obj_end, opts):
-    end = obj_end - 1
-    while position < end:
-        (key, value, position) = _element_to_dict(data, position, obj_end, opts)
-        yield key, value, position
-
-def _elements_to_dict(data, position, obj_end, opts, subdocument=None):
-    """Decode a BSON document."""
-    if type(opts.document_class) == tuple:
-        result = opts.document_class[0](**opts.document_class[1]) if not subdocument else dict()
-    else:
-        result = opts.document_class() if not subdocument else dict()
-    pos = position
-    for key, value, pos in _iterate_elements(data, position, obj_end, opts):
-        if key in ["firstBatch", "nextBatch"] and type(opts.document_class) == tuple:
-            batches = []
-            for batch in value:
-                batch_document = opts.document_class[0](**opts.document_class[1])
-                batch_document.update(batch)
-                batches.append(batch_document)
-            result[key] = batches
-        else:
-            result[key] = value
-    if pos != obj_end:
-        raise bson.InvalidBSON('bad object or element length')
-    return result
-
-
-def _get_object(data, position, obj_end, opts, dummy):
-    """Decode a BSON subdocument to opts.document_class or bson.dbref.DBRef."""
-    obj_size = bson._UNPACK_INT(data[position:position + 4])[0]
-    end = position + obj_size - 1
-    if data[end:position + obj_size] != b"\x00":
-        raise bson.InvalidBSON("bad eoo")
-    if end >= obj_end:
-        raise bson.InvalidBSON("invalid object length")
-    if _raw_document_class(opts.document_class):
-        return (opts.document_class(data[position:end + 1], opts),
-                position + obj_size)
-
-    obj = _elements_to_dict(data, position + 4, end, opts, subdocument=True)
-    position += obj_size
-    if "$ref" in obj:
-        return (bson.DBRef(obj.pop("$ref"), obj.pop("$id", None),
-                      obj.pop("$db", None), obj), position)
-    return obj, position
+    """
+      Replaces bson.decode_all to implement https://jira.mongodb.org/browse/PYTHON-175
+
+      Only MongoKat collections pass a (document_class, kwargs[, metrics_key]) tuple as document_class:
+      their replies are decoded to plain dicts by the original decoder, then the documents of cursor batches
+      are converted to the Document (or Record) class. Any other decoding is left to the original decoder.
+    """
+    document_options = codec_options.document_class
+    if type(document_options) is not tuple:
+        return _decode_all(data, codec_options)
+
+    docs = _decode_all(data, codec_options._replace(document_class=dict))
+
+    document_class, document_kwargs = document_options[0], document_options[1]
+    is_record = issubclass(document_class, Record)
+    aliases = document_kwargs["mongokat_collection"]._aliases
+
+    # Command replies wrap the batches: only the documents of the batches are tracked, see mongokat.projections
+    reply_kwargs = document_kwargs
+    if "access_tracker" in document_kwargs:
+        reply_kwargs = dict(document_kwargs)
+        del reply_kwargs["access_tracker"]
+
+    def convert(doc):
+        if aliases is not None:
+            doc = aliases.decode_document(doc)
+        if is_record:
+            return document_class(doc)
+        document = document_class(**document_kwargs)
+        document.update(doc)
+        return document
+
+    for i, doc in enumerate(docs):
+
+        cursor = doc.get("cursor")
+        if type(cursor) is dict:
+            for key in _BATCH_KEYS:
+                batch = cursor.get(key)
+                if batch is not None:
+                    cursor[key] = [convert(x) for x in batch]
+                    if len(document_options) > 2:
+                        metrics.record_decoded(document_options[2], len(batch), len(data))
+
+        # Replies to legacy OP_QUERY finds are the documents themselves
+        if not is_record:
+            document = document_class(**(reply_kwargs if type(cursor) is dict else document_kwargs))
+            document.update(doc)
+            docs[i] = document
+
+    return docs
+
+
+class CodecOptionsWithoutCheck(bson.codec_options.CodecOptions):
+  """
+    CodecOptions without the type check on document_class, because we also can pass a tuple to use
+    additional kwargs in the document_class instanciation. Only used by MongoKat collections.
+  """
+  def __new__(cls, document_class=dict,
+              tz_aware=False, uuid_representation=bson.codec_options.PYTHON_LEGACY,
+              unicode_decode_error_handler="strict", tzinfo=None):
+      # if not issubclass(document_class, MutableMapping):
+      #     raise TypeError("document_class must be dict, bson.son.SON, or "
+    if not isinstance(tz_aware, bool):
+        raise TypeError("tz_aware must be True or False")
+    if uuid_representation not in bson.binary.ALL_UUID_REPRESENTATIONS:
+        raise ValueError("uuid_representation must be a value "
+                            "from bson.binary.ALL_UUID_REPRESENTATIONS")
+    if not isinstance(unicode_decode_error_handler, (bson.py3compat.string_type, None)):
+        raise ValueError("unicode_decode_error_handler must be a string "
+                            "or None")
+    if tzinfo is not None:
+        if not isinstance(tzinfo, datetime.tzinfo):
+            raise TypeError(
+                "tzinfo must be an instance of datetime.tzinfo")
+        if not tz_aware:
+            raise ValueError(
+                "cannot specify tzinfo without also setting tz_aware=True")
+    return tuple.__new__(
+        cls, (document_class, tz_aware, uuid_representation,
+                unicode_decode_error_handler, tzinfo))
+
+  def with_options(self, **kwargs):
+    return self._replace(**kwargs)
@@ -0,0 +1,100 @@
+"""
+Short field names, declared with Collection.short_names = {"description": "d", ...}
+
+Documents use the long names in Python, and the short ones are stored in MongoDB. Translation applies to the
+top-level fields of documents, and to the first component of dotted field names in filters, projections, sorts
+and update operators.
+
+Aggregation pipelines are not translated and must use the short names, though their results are decoded
+like any other document. bulk_write() is not translated either.
+"""
+from bson.son import SON
+from bson.py3compat import string_type
+
+_LOGICAL_OPERATORS = ("$and", "$or", "$nor")
+
+# FieldAliases instances by Collection class
+_CACHE = {}
+
+
+def get_aliases(collection_class):
+    """ Returns the FieldAliases of a Collection class, or None if it has no short names """
+    try:
+        return _CACHE[collection_class]
+    except KeyError:
+        short_names = collection_class.short_names
+        aliases = _CACHE[collection_class] = FieldAliases(short_names) if short_names else None
+        return aliases
+
+
+class FieldAliases(object):
+
+    def __init__(self, short_names):
+        self.to_short = dict(short_names)
+        self.to_long = {v: k for k, v in self.to_short.items()}
+        if len(self.to_long) != len(self.to_short):
+            raise ValueError("Short names must be unique: %s" % short_names)
+
+    def _translate_key(self, key, names):
+        if "." not in key:
+            return names.get(key, key)
+        head, rest = key.split(".", 1)
+        return "%s.%s" % (names.get(head, head), rest)
+
+    def encode_key(self, key):
+        return self._translate_key(key, self.to_short)
+
+    def decode_key(self, key):
+        return self._translate_key(key, self.to_long)
+
+    def encode_document(self, document):
+        """ Returns a copy of a document with short top-level field names """
+        to_short = self.to_short
+        return {to_short.get(k, k): v for k, v in document.items()}
+
+    def decode_document(self, document):
+        """ Returns a copy of a document with long top-level field names """
+        to_long = self.to_long
+        return {to_long.get(k, k): v for k, v in document.items()}
+
+    def encode_filter(self, query):
+        if not isinstance(query, dict):
+            return query
+        encoded = SON()
+        for k, v in query.items():
+            if k in _LOGICAL_OPERATORS:
+                encoded[k] = [self.encode_filter(x) for x in v]
+            elif k.startswith("$"):
+                encoded[k] = v
+            else:
+                encoded[self.encode_key(k)] = v
+        return encoded
+
+    def encode_projection(self, projection):
+        if projection is None:
+            return None
+        if isinstance(projection, dict):
+            return SON((self.encode_key(k), v) for k, v in projection.items())
+        return [self.encode_key(k) for k in projection]
+
+    def encode_sort(self, sort):
+        if sort is None:
+            return None
+        if isinstance(sort, string_type):
+            return self.encode_key(sort)
+        if isinstance(sort, dict):
+            return SON((self.encode_key(k), v) for k, v in sort.items())
+        return [(self.encode_key(k), v) for k, v in sort]
+
+    def encode_update(self, update):
+        """ Translates update operators, or a replacement document """
+        if not any(k.startswith("$") for k in update):
+            return self.encode_document(update)
+        encoded = SON()
+        for operator, fields in update.items():
+            if isinstance(fields, dict):
+                fields = SON((self.encode_key(k), v) for k, v in fields.items())
+                if operator == "$rename":
+                    fields = SON((k, self.encode_key(v)) for k, v in fields.items())
+            encoded[operator] = fields
+        return encoded
@@ -0,0 +1,106 @@
+"""
+Reading and writing mongodump .bson files, see Collection.iter_bson_file() and Collection.dump_bson_file()
+
+A .bson file is a plain concatenation of BSON documents. Files are memory-mapped and decoded by chunks
+with the original (C) bson decoder, then converted to the Document class of the Collection.
+"""
+import mmap
+import os
+import struct
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.errors import InvalidBSON
+from ._bson import _decode_all
+from .query import compile_filter, project
+
+_INT32 = struct.Struct("<i")
+
+# Bytes decoded at once
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# os.replace() overwrites an existing file on Windows too, Python 2 only has os.rename()
+_replace = getattr(os, "replace", os.rename)
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """ Splits a buffer of concatenated BSON documents in chunks of whole documents of about chunk_size bytes """
+
+    size = len(data)
+    start = 0
+    while start < size:
+        end = start
+        while end < size and (end == start or end - start < chunk_size):
+            if end + 4 > size:
+                raise InvalidBSON("Truncated BSON file at offset %s" % end)
+            length = _INT32.unpack_from(data, end)[0]
+            if length < 5 or end + length > size:
+                raise InvalidBSON("Invalid document length %s at offset %s" % (length, end))
+            end += length
+        yield data[start:end]
+        start = end
+
+
+def count_documents(data):
+    """ Counts the documents in a buffer of concatenated BSON documents, without decoding them """
+    count = 0
+    offset = 0
+    size = len(data)
+    while offset < size:
+        offset += _INT32.unpack_from(data, offset)[0]
+        count += 1
+    return count
+
+
+def iter_bson_file(mongokat_collection, path, fields=None, filter=None, chunk_size=CHUNK_SIZE):
+    """ Yields the documents of a .bson file as Documents, see Collection.iter_bson_file() """
+
+    projection = None
+    if fields is not None:
+        projection = {x: True for x in fields} if not isinstance(fields, dict) else dict(fields)
+        projection.setdefault("_id", False)
+
+    predicate = compile_filter(filter) if filter else None
+    document_class = mongokat_collection.document_class
+    aliases = mongokat_collection._aliases
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for chunk in iter_chunks(data, chunk_size=chunk_size):
+                for doc in _decode_all(chunk, DEFAULT_CODEC_OPTIONS):
+                    if aliases is not None:
+                        doc = aliases.decode_document(doc)
+                    if predicate is not None and not predicate(doc):
+                        continue
+                    if projection is not None:
+                        doc = project(doc, projection)
+                    document = document_class(mongokat_collection=mongokat_collection, fetched_fields=projection)
+                    document.update(doc)
+                    yield document
+        finally:
+            data.close()
+
+
+def dump_bson_file(mongokat_collection, filter, path, **kwargs):
+    """
+      Writes the raw batches of a find to path, without decoding them. Returns the number of documents.
+      The file is written next to path then renamed, so that readers never see a partial dump.
+    """
+
+    args, kwargs = mongokat_collection._encode_find_args((filter, ), kwargs)
+
+    tmp_path = "%s.tmp" % path
+    count = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for batch in mongokat_collection.collection.find_raw_batches(*args, **kwargs):
+                f.write(batch)
+                count += count_documents(batch)
+        _replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return count
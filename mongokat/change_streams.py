@@ -0,0 +1,276 @@
+"""
+Runs after_save and after_delete hooks from a change stream, see ChangeStreamDispatcher.
+
+Unlike Collection.trigger, hooks also run for writes made outside of MongoKat (other services, the shell...),
+and writes don't wait for them. Change streams need a replica set or a sharded cluster.
+"""
+import threading
+import time
+from .compression import decompress_value, is_compressed
+from .metrics import metrics
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+SAVE_OPERATIONS = ("insert", "update", "replace")
+
+# Tells the dispatcher thread that the stream ended
+_END = object()
+
+
+class MemoryCheckpointStore(object):
+    """ Keeps resume tokens in memory: changes made while the process isn't running are lost """
+
+    def __init__(self):
+        self.tokens = {}
+
+    def load(self, name):
+        return self.tokens.get(name)
+
+    def save(self, name, token):
+        self.tokens[name] = token
+
+
+class MongoCheckpointStore(object):
+    """ Keeps resume tokens in a pymongo collection, with one document per dispatcher name """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def load(self, name):
+        doc = self.collection.find_one({"_id": name})
+        return doc["token"] if doc else None
+
+    def save(self, name, token):
+        self.collection.update_one({"_id": name}, {"$set": {"token": token, "updated_at": time.time()}}, upsert=True)
+
+
+def update_from_description(description, mongokat_collection=None):
+    """
+      Converts the updateDescription of a change to an update document, as passed to after_save hooks.
+      With mongokat_collection, field names are decoded and compressed fields decompressed, like the updates
+      passed to inline hooks.
+    """
+    updated = description.get("updatedFields") or {}
+    removed = description.get("removedFields") or []
+
+    if mongokat_collection is not None:
+        aliases = mongokat_collection._aliases
+        if aliases is not None:
+            updated = {aliases.decode_key(field): value for field, value in updated.items()}
+            removed = [aliases.decode_key(field) for field in removed]
+        compressed_fields = mongokat_collection.compressed_fields
+        if compressed_fields:
+            updated = {
+                field: decompress_value(value) if field in compressed_fields and is_compressed(value) else value
+                for field, value in updated.items()
+            }
+
+    update = {}
+    if updated:
+        update["$set"] = updated
+    if removed:
+        update["$unset"] = {field: "" for field in removed}
+    return update
+
+
+class ChangeStreamDispatcher(object):
+    """
+      Watches a Collection with full_document="updateLookup" and calls the hooks of its Document class
+      on batches of changes:
+
+       - after_save(update=..., replacements=...) on the fullDocument of inserts, updates and replaces.
+         Updates whose document was deleted before the lookup are skipped.
+       - after_delete() on a Document containing only the _id.
+
+      Batches contain up to batch_size changes, or the changes received during flush_interval seconds.
+      With coalesce=True, only the last change of each _id in a batch runs hooks. The resume token of
+      the last change is saved in checkpoint_store after each batch, so a restarted dispatcher resumes
+      where it stopped (at least once delivery).
+
+      While it runs, inline after_save and after_delete hooks are disabled on this Collection instance,
+      unless replace_inline_hooks=False.
+    """
+
+    def __init__(self, mongokat_collection, name=None, checkpoint_store=None, batch_size=100, flush_interval=0.5,
+                 coalesce=True, replace_inline_hooks=True, max_await_time_ms=1000, retry_interval=5,
+                 on_error=None):
+        self.mongokat_collection = mongokat_collection
+        self.name = name or mongokat_collection.collection.full_name
+        self.checkpoint_store = checkpoint_store or MemoryCheckpointStore()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.coalesce = coalesce
+        self.replace_inline_hooks = replace_inline_hooks
+        self.max_await_time_ms = max_await_time_ms
+        self.retry_interval = retry_interval
+        self.on_error = on_error
+
+        self.changes = 0
+        self.batches = 0
+        self.errors = 0
+        self.last_error = None
+
+        self._stopped = threading.Event()
+        self._stream = None
+        self._thread = None
+
+    def start(self):
+        if self.replace_inline_hooks:
+            self.mongokat_collection.dispatched_events = ("after_save", "after_delete")
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="mongokat-change-stream")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        stream = self._stream
+        if stream is not None:
+            stream.close()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.replace_inline_hooks:
+            self.mongokat_collection.dispatched_events = ()
+
+    def watch(self):
+        """ Opens the change stream, resuming after the saved checkpoint """
+        return self.mongokat_collection.collection.watch(
+            full_document="updateLookup",
+            resume_after=self.checkpoint_store.load(self.name),
+            max_await_time_ms=self.max_await_time_ms,
+            batch_size=self.batch_size
+        )
+
+    def run(self):
+        """ Dispatches changes until stop() is called, reopening the stream after errors """
+        while not self._stopped.is_set():
+            try:
+                self._stream = self.watch()
+                self._dispatch_stream(self._stream)
+            except Exception as e:  # pylint: disable=broad-except
+                if self._stopped.is_set():
+                    return
+                self._failed(e, None)
+                self._stopped.wait(self.retry_interval)
+            finally:
+                if self._stream is not None:
+                    self._stream.close()
+                    self._stream = None
+
+    def _dispatch_stream(self, stream):
+        """ Reads the stream in a thread, so that batches can be flushed when no change arrives """
+
+        changes = queue.Queue(maxsize=self.batch_size * 2)
+        stopped = threading.Event()
+
+        def put(item):
+            # Gives up once the dispatching loop exited, so that the reader never stays blocked on a full queue
+            while not stopped.is_set():
+                try:
+                    changes.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for change in stream:
+                    if not put(change):
+                        return
+            except Exception as e:  # pylint: disable=broad-except
+                put(e)
+            put(_END)
+
+        reader = threading.Thread(target=read, name="mongokat-change-stream-reader")
+        reader.daemon = True
+        reader.start()
+
+        try:
+            batch = []
+            deadline = None
+            while True:
+                timeout = max(0, deadline - time.time()) if deadline is not None else self.flush_interval
+                try:
+                    change = changes.get(timeout=timeout)
+                except queue.Empty:
+                    change = None
+
+                if change is not None and change is not _END and not isinstance(change, Exception):
+                    batch.append(change)
+                    if deadline is None:
+                        deadline = time.time() + self.flush_interval
+
+                if batch and (change is None or change is _END or isinstance(change, Exception) or
+                              len(batch) >= self.batch_size or time.time() >= deadline):
+                    self.dispatch(batch)
+                    batch = []
+                    deadline = None
+
+                if isinstance(change, Exception):
+                    raise change
+                if change is _END:
+                    return
+        finally:
+            # A reader waiting for the next change returns after max_await_time_ms
+            stopped.set()
+            reader.join(self.max_await_time_ms / 1000.0 + 1)
+
+    def dispatch(self, changes):
+        """ Runs the hooks of a batch of change events, then saves the resume token of the last one """
+
+        if not changes:
+            return
+
+        if metrics.enabled:
+            metrics.call(self.mongokat_collection, "change_stream", self._run_hooks, (changes, ), {})
+        else:
+            self._run_hooks(changes)
+
+        self.changes += len(changes)
+        self.batches += 1
+        self.checkpoint_store.save(self.name, changes[-1]["_id"])
+
+    def _run_hooks(self, changes):
+
+        if self.coalesce:
+            last = {}
+            for i, change in enumerate(changes):
+                if "documentKey" in change:
+                    last[repr(change["documentKey"])] = i
+            changes = [change for i, change in enumerate(changes)
+                       if "documentKey" not in change or last[repr(change["documentKey"])] == i]
+
+        mongokat_collection = self.mongokat_collection
+        has_save = hasattr(mongokat_collection.document_class, "after_save")
+        has_delete = hasattr(mongokat_collection.document_class, "after_delete")
+
+        for change in changes:
+            operation = change.get("operationType")
+            try:
+                if operation in SAVE_OPERATIONS and has_save:
+                    full_document = change.get("fullDocument")
+                    if full_document is None:
+                        continue
+                    doc = mongokat_collection(mongokat_collection._decode_document(full_document))
+                    if operation == "update":
+                        update = update_from_description(change.get("updateDescription") or {}, mongokat_collection)
+                        doc.after_save(update=update, replacements=None)
+                    else:
+                        doc.after_save(update=None, replacements=[doc])
+                elif operation == "delete" and has_delete:
+                    doc = mongokat_collection(change["documentKey"], fetched_fields={"_id": True})
+                    doc.after_delete(update=None, replacements=None)
+            except Exception as e:  # pylint: disable=broad-except
+                self._failed(e, change)
+
+    def _failed(self, error, change):
+        self.errors += 1
+        self.last_error = error
+        if self.on_error is not None:
+            self.on_error(error, change)
@@ -0,0 +1,123 @@
+"""
+Coalescing of concurrent find_by_id() and find_by_ids() calls, see Collection.enable_coalescing()
+"""
+import copy
+import threading
+
+# find_by_id() kwargs that can be coalesced: the others are passed to find_one() as usual
+COALESCED_KWARGS = frozenset(["projection", "read_use", "read_preference"])
+
+
+class _Batch(object):
+    """ Ids requested by concurrent calls with the same projection and read preference """
+
+    def __init__(self):
+        self.ids = []
+        self.seen = set()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.callers = 0
+        self.results = None
+        self.error = None
+
+
+class FindByIdCoalescer(object):
+    """
+      The first caller of a batch waits up to `window` seconds (or until `max_ids` ids were requested)
+      for other threads to add their ids, then runs a single _id:$in query for all of them.
+      Each caller gets its own Document instances.
+    """
+
+    def __init__(self, mongokat_collection, window=0.002, max_ids=100):
+        self.mongokat_collection = mongokat_collection
+        self.window = window
+        self.max_ids = max_ids
+        self.calls = 0
+        self.queries = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def accepts(self, kwargs):
+        return all(k in COALESCED_KWARGS for k in kwargs)
+
+    def _batch_key(self, kwargs):
+        projection = kwargs.get("projection")
+        return (
+            repr(sorted(projection.items())) if projection is not None else None,
+            repr(kwargs.get("read_use")),
+            repr(kwargs.get("read_preference"))
+        )
+
+    def find_by_id(self, _id, **kwargs):
+        return self._fetch([_id], kwargs)[0]
+
+    def find_by_ids(self, ids, **kwargs):
+        """ Returns the list of found documents, in the order of ids """
+        return [doc for doc in self._fetch(ids, kwargs) if doc is not None]
+
+    def _fetch(self, ids, kwargs):
+
+        key = self._batch_key(kwargs)
+
+        with self._lock:
+            self.calls += 1
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = _Batch()
+            batch.callers += 1
+            for _id in ids:
+                if _id not in batch.seen:
+                    batch.seen.add(_id)
+                    batch.ids.append(_id)
+            if len(batch.ids) >= self.max_ids:
+                del self._pending[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            try:
+                batch.results = self._query(batch.ids, kwargs)
+            except Exception as e:  # pylint: disable=broad-except
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+        # batch.results are never returned when other callers copy them: no caller sees the changes of another
+        shared = batch.callers > 1
+        docs = []
+        returned = set()
+        for _id in ids:
+            doc = batch.results.get(_id)
+            if doc is not None and (shared or _id in returned):
+                doc = copy.deepcopy(doc)
+            returned.add(_id)
+            docs.append(doc)
+        return docs
+
+    def _query(self, ids, kwargs):
+
+        kwargs = dict(kwargs)
+        projection = kwargs.get("projection")
+        hide_id = False
+        if projection is not None:
+            # We need the _ids to dispatch the results
+            hide_id = not projection.get("_id", True)
+            kwargs["projection"] = dict(projection, _id=True)
+
+        self.queries += 1
+        results = {}
+        for doc in self.mongokat_collection.find({"_id": {"$in": ids}}, **kwargs):
+            _id = doc["_id"]
+            if hide_id:
+                del doc["_id"]
+            results[_id] = doc
+        return results
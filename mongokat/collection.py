@@ -1,11 +1,31 @@
-from .utils import dotdict, json_clone
-from bson import ObjectId
-from bson.codec_options import CodecOptions
+from .utils import Path, json_clone
+from bson import ObjectId, BSON
 from pymongo import ReadPreference, WriteConcern, ReturnDocument, read_preferences
+from pymongo.errors import OperationFailure
 import collections
+import functools
 import base64
 from .document import Document
-from .exceptions import MultipleResultsFound, ImmutableDocumentError, ProtectedFieldsError
+from .exceptions import MultipleResultsFound, ImmutableDocumentError, ProtectedFieldsError, InvalidPageTokenError, \
+    UnsupportedQueryError
+from .metrics import metrics, instrumented
+from .profiling import slow_queries
+from .cursor import Cursor, PrefetchingCursor
+from .aliases import get_aliases
+from .compression import compress_document, compress_update
+from .counts import CountCache
+from .indexes import index_advisor, ensure_indexes
+from .records import record_class, projection_fields
+from ._bson import CodecOptionsWithoutCheck
+from .read_scope import read_scope, current_read_scope, invalidates_read_scope
+from .hooks import hook_queue, is_deferred
+from .projections import projection_learner, TRACKED_METHODS
+from .registry import LazyHandle
+import time
+import threading
+
+# Creation of the CountCache of Collection instances
+_count_cache_lock = threading.Lock()
 
 
 def _param_fields(kwargs, fields):
@@ -29,7 +49,11 @@ def find_method(func):
      - json: performs a json_clone on the results. Beware of performance!
      - timeout
      - return_document
+
+    Calls are also recorded in mongokat.metrics when enabled, and find()/find_one() calls without
+    a projection in mongokat.projections when learning.
   """
+  @functools.wraps(func)
   def wrapped(*args, **kwargs):
 
     # Normalize the fields argument if passed as a positional param.
@@ -50,12 +74,31 @@ def find_method(func):
       kwargs["filter"] = kwargs["spec"]
       del kwargs["spec"]
 
+    if projection_learner.mode != "off" and func.__name__ in TRACKED_METHODS:
+      projection_learner.prepare(args[0], func.__name__, kwargs)
+
     if kwargs.get("return_document") == "after":
         kwargs["return_document"] = ReturnDocument.AFTER
     elif kwargs.get("return_document") == "before":
         kwargs["return_document"] = ReturnDocument.BEFORE
 
-    ret = func(*args, **kwargs)
+    if index_advisor.enabled and func.__name__ in ("find", "find_one", "find_one_and_delete",
+                                                    "find_one_and_replace", "find_one_and_update"):
+      index_advisor.record(args[0], args[1] if len(args) > 1 else kwargs.get("filter"),
+                           sort=kwargs.get("sort"), projection=kwargs.get("projection"))
+
+    # find_one() is observed in _find_one() with the filter actually sent, pipelines aren't encoded
+    if slow_queries.enabled and func.__name__ == "aggregate":
+      start = time.time()
+
+    if metrics.enabled:
+      ret = metrics.call(args[0], func.__name__, func, args, kwargs)
+    else:
+      ret = func(*args, **kwargs)
+
+    if slow_queries.enabled and func.__name__ == "aggregate":
+      slow_queries.observe(args[0], "aggregate", time.time() - start,
+                           pipeline=args[1] if len(args) > 1 else kwargs.get("pipeline"))
 
     if kwargs.get("json"):
       ret = json_clone(ret)
@@ -65,13 +108,21 @@ def find_method(func):
   return wrapped
 
 
-def patch_cursor(cursor, batch_size=None, limit=None, skip=None, sort=None, **kwargs):
+def patch_cursor(cursor, batch_size=None, limit=None, skip=None, sort=None, prefetch=None, **kwargs):
   """
-    Adds batch_size, limit, sort parameters to a DB cursor
+    Adds batch_size, limit, sort parameters to a DB cursor.
+
+    batch_size="auto" adapts the size of each batch to the size of the documents and the speed at which
+    they are consumed (see AdaptiveBatchSize). Only supported on mongokat.cursor.Cursor, returned by find().
+
+    prefetch: True or a number of batches to fetch in a background thread while the current one is consumed.
+    The cursor is then wrapped in a PrefetchingCursor, which is returned.
   """
 
   if type(batch_size) == int:
     cursor.batch_size(batch_size)
+  elif batch_size == "auto":
+    cursor.adaptive_batch_size()
 
   if limit is not None:
     cursor.limit(limit)
@@ -82,20 +133,82 @@ def patch_cursor(cursor, batch_size=None, limit=None, skip=None, sort=None, **kw
   if skip is not None:
     cursor.skip(skip)
 
+  if prefetch:
+    return PrefetchingCursor(cursor, depth=1 if prefetch is True else prefetch)
+
+  return cursor
+
+
+def _encode_page_token(values):
+  """ Encodes the sort values of the last document of a page """
+  return base64.urlsafe_b64encode(BSON.encode({"v": values})).decode("ascii")
+
+
+def _decode_page_token(token, sort):
+  try:
+    values = BSON(base64.urlsafe_b64decode(str(token))).decode()["v"]
+  except Exception:
+    raise InvalidPageTokenError("Invalid page token: %r" % token)
+  if len(values) != len(sort):
+    raise InvalidPageTokenError("Page token doesn't match the sort: %r" % token)
+  return values
+
+
+def _get_sort_value(doc, key):
+  return Path(key).get(doc, None)
+
+
+def _keyset_query(sort, values):
+  """
+    Returns the query matching the documents after `values` in this sort order:
+    {"$or": [{k1: {"$gt": v1}}, {k1: v1, k2: {"$gt": v2}}, ...]}
+  """
+  clauses = []
+  for i, (key, direction) in enumerate(sort):
+    clause = {sort[j][0]: values[j] for j in range(i)}
+    clause[key] = {"$gt" if direction > 0 else "$lt": values[i]}
+    clauses.append(clause)
+  return {"$or": clauses}
+
 
 class Collection(object):
     """ mongokat.Collection wraps a pymongo.collection.Collection """
 
     __collection__ = None
     __database__ = None
+    __indexes__ = None
     document_class = Document
     structure = None
     immutable = False
     protected_fields = ()
 
+    # Long to short field names, e.g. {"description": "d"}. See mongokat.aliases
+    short_names = None
+
+    # Fields stored compressed, e.g. {"html": "zlib"}. See mongokat.compression
+    compressed_fields = None
+
+    # FindByIdCoalescer, see enable_coalescing()
+    _coalescer = None
+
+    # In-memory Mirror, see mirror()
+    _mirror = None
+
+    # CountCache of count(mode="cached"), created on first use
+    _count_cache = None
+
+    # Hooks run by a ChangeStreamDispatcher instead of trigger()
+    dispatched_events = ()
+
+    # Resolved on first use from mongokat.registry when no handle was given to the constructor
+    client = LazyHandle("client")
+    database = LazyHandle("database")
+    collection = LazyHandle("collection")
+
     def __init__(self, collection=None, database=None, client=None):
         """ You can pass a pymongo collection object directly, or rely
-            on the __collection__ and/or __database__ attributes
+            on the __collection__ and/or __database__ attributes.
+            Without arguments, the client is taken lazily from mongokat.registry.
         """
 
         if collection:
@@ -110,6 +223,8 @@ class Collection(object):
             self.client = client
             self.database = self.client[self.__database__]
             self.collection = self.database[self.__collection__]
+        elif self.__database__ and self.__collection__:
+            pass
         else:
             raise Exception("Not enough parameters given to identify the right collection!")
 
@@ -130,11 +245,70 @@ class Collection(object):
         """
         return bool(self.find(query, **args).limit(1).count())
 
+    @instrumented
     def count(self, *args, **kwargs):
-        return self._collection_with_options(kwargs).count(*args, **kwargs)
+        """
+            Counts the documents matching a query. The `mode` argument can be:
+
+             - "exact" (default): runs the count command
+             - "estimated": uses the collection metadata when there is no filter, which is very fast
+               but may be inaccurate after an unclean shutdown or with orphaned documents on sharded clusters.
+               Falls back to "exact" otherwise.
+             - "cached": returns the last count computed for this query, refreshing it in the background
+               when it is older than `max_staleness` seconds (default 60).
+        """
+
+        mode = kwargs.pop("mode", "exact")
+        max_staleness = kwargs.pop("max_staleness", 60)
+        query = args[0] if args else kwargs.get("filter")
+
+        if self._mirror is not None and len(args) <= 1 and set(kwargs) <= set(["filter"]) and mode != "cached":
+            try:
+                return self._mirror.count(query)
+            except UnsupportedQueryError:
+                self._mirror.server_queries += 1
+
+        if mode == "estimated" and not query:
+            return self._collection_with_options(kwargs).estimated_document_count()
+
+        if mode == "cached":
+            if self._count_cache is None:
+                with _count_cache_lock:
+                    if self._count_cache is None:
+                        self._count_cache = CountCache()
+            return self._count_cache.get(
+                query, kwargs, max_staleness,
+                lambda: self.count(*args, **dict(kwargs))
+            )
 
-    def distinct(self, *args, **kwargs):
-        return self._collection_with_options(kwargs).distinct(*args, **kwargs)
+        if mode not in ("exact", "estimated"):
+            raise ValueError("Unknown count mode: %s" % mode)
+
+        collection = self._collection_with_options(kwargs)
+        encoded_args, kwargs = self._encode_find_args(args, kwargs)
+
+        if not slow_queries.enabled:
+            return collection.count(*encoded_args, **kwargs)
+
+        start = time.time()
+        ret = collection.count(*encoded_args, **kwargs)
+        slow_queries.observe(self, "count", time.time() - start,
+                             filter=encoded_args[0] if encoded_args else kwargs.get("filter"))
+        return ret
+
+    @instrumented
+    def distinct(self, key, filter=None, **kwargs):
+        if self._mirror is not None and not kwargs:
+            try:
+                return self._mirror.distinct(key, filter)
+            except UnsupportedQueryError:
+                self._mirror.server_queries += 1
+
+        collection = self._collection_with_options(kwargs)
+        if self._aliases is not None:
+            key = self._aliases.encode_key(key)
+            filter = self._aliases.encode_filter(filter)
+        return collection.distinct(key, filter, **kwargs)
 
     def group(self, *args, **kwargs):
         return self._collection_with_options(kwargs).group(*args, **kwargs)
@@ -147,13 +321,87 @@ class Collection(object):
             kwargs["batchSize"] = kwargs["batch_size"]
             del kwargs["batch_size"]
 
-        return self._collection_with_options(kwargs).aggregate(*args, **kwargs)
+        prefetch = kwargs.pop("prefetch", None)
+
+        return patch_cursor(self._collection_with_options(kwargs).aggregate(*args, **kwargs), prefetch=prefetch)
 
     @find_method
     def find(self, *args, **kwargs):
-        return self._collection_with_options(kwargs).find(*args, **kwargs)
+        """
+            as_records=True returns read-only Record objects with __slots__ instead of Documents,
+            using much less memory. It needs an inclusion projection, see mongokat.records
+        """
+        if self._mirror is not None and len(args) <= 1 and self._mirror.accepts(kwargs):
+            try:
+                return self._mirror.find(args[0] if args else kwargs.get("filter"), projection=kwargs.get("projection"),
+                                         sort=kwargs.get("sort"), limit=kwargs.get("limit"), skip=kwargs.get("skip"))
+            except UnsupportedQueryError:
+                self._mirror.server_queries += 1
+
+        prefetch = kwargs.pop("prefetch", None)
+        batch_size = kwargs.pop("batch_size") if kwargs.get("batch_size") == "auto" else None
+
+        document_class = None
+        if kwargs.pop("as_records", False):
+            document_class = record_class(projection_fields(kwargs.get("projection")))
+
+        collection = self._collection_with_options(kwargs, document_class=document_class)
+        args, kwargs = self._encode_find_args(args, kwargs)
 
-    def _collection_with_options(self, kwargs):
+        return patch_cursor(Cursor(collection, *args, **kwargs), batch_size=batch_size, prefetch=prefetch)
+
+    @property
+    def is_lazy(self):
+        """ Were the handles of this collection left to mongokat.registry? """
+        return "collection" not in self.__dict__
+
+    @property
+    def _aliases(self):
+        return get_aliases(self.__class__)
+
+    def _encode_find_args(self, args, kwargs):
+        """ Translates the filter, projection and sort of a find-like call to short field names """
+
+        aliases = self._aliases
+        if aliases is None:
+            return args, kwargs
+
+        if args:
+            args = (aliases.encode_filter(args[0]), ) + tuple(args[1:])
+        if kwargs.get("filter") is not None:
+            kwargs["filter"] = aliases.encode_filter(kwargs["filter"])
+        if kwargs.get("projection") is not None:
+            kwargs["projection"] = aliases.encode_projection(kwargs["projection"])
+        if kwargs.get("sort") is not None:
+            kwargs["sort"] = aliases.encode_sort(kwargs["sort"])
+
+        return args, kwargs
+
+    def _encode_filter(self, filter):
+        if self._aliases is None:
+            return filter
+        return self._aliases.encode_filter(filter)
+
+    def _encode_update(self, update):
+        if self.compressed_fields:
+            update = compress_update(update, self.compressed_fields)
+        if self._aliases is None:
+            return update
+        return self._aliases.encode_update(update)
+
+    def _encode_document(self, document):
+        if self.compressed_fields:
+            document = compress_document(document, self.compressed_fields)
+        if self._aliases is None:
+            return document
+        return self._aliases.encode_document(document)
+
+    def _decode_document(self, document):
+        if self._aliases is None or document is None:
+            return document
+        return self._aliases.decode_document(document)
+
+    def _collection_with_options(self, kwargs, document_class=None):
         """ Returns a copy of the pymongo collection with various options set up """
 
         # class DocumentClassWithFields(self.document_class):
@@ -183,15 +431,20 @@ class Collection(object):
         elif kwargs.get("write_concern"):
             write_concern = kwargs.get("write_concern")
 
-        codec_options = CodecOptions(
-            document_class=(
-                self.document_class,
-                {
-                    "fetched_fields": kwargs.get("projection"),
-                    "mongokat_collection": self
-                }
-            )
-        )
+        document_kwargs = {
+            "fetched_fields": kwargs.get("projection"),
+            "mongokat_collection": self
+        }
+        if "access_tracker" in kwargs:
+            document_kwargs["access_tracker"] = kwargs.pop("access_tracker")
+
+        document_class = (document_class or self.document_class, document_kwargs)
+
+        # The decoder will attribute decoded documents to the running operation
+        if metrics.enabled:
+            document_class += ((self.__class__.__name__, metrics.current_operation() or "other"), )
+
+        codec_options = CodecOptionsWithoutCheck(document_class=document_class)
         return self.collection.with_options(
             codec_options=codec_options,
             read_preference=read_preference,
@@ -203,10 +456,35 @@ class Collection(object):
         """
         Get a single document from the database.
         """
-        doc = self._collection_with_options(kwargs).find_one(*args, **kwargs)
-        if doc is None:
-            return None
-
+        if self._mirror is not None and len(args) <= 1 and self._mirror.accepts(kwargs):
+            filter = args[0] if args else kwargs.get("filter")
+            if filter is None or isinstance(filter, dict):
+                try:
+                    return self._mirror.find_one(filter, projection=kwargs.get("projection"), sort=kwargs.get("sort"))
+                except UnsupportedQueryError:
+                    self._mirror.server_queries += 1
+
+        scope = current_read_scope()
+        if scope is not None and len(args) <= 1:
+            filter = args[0] if args else kwargs.get("filter")
+            scope_kwargs = {k: v for k, v in kwargs.items() if k != "filter"}
+            if (type(filter) == dict and list(filter.keys()) == ["_id"] and not isinstance(filter["_id"], dict) and
+                    scope.accepts(scope_kwargs)):
+                return scope.find_one(self, filter["_id"], scope_kwargs, lambda: self._find_one(args, dict(kwargs)))
+
+        return self._find_one(args, kwargs)
+
+    def _find_one(self, args, kwargs):
+        collection = self._collection_with_options(kwargs)
+        args, kwargs = self._encode_find_args(args, kwargs)
+
+        if not slow_queries.enabled:
+            return collection.find_one(*args, **kwargs)
+
+        start = time.time()
+        doc = collection.find_one(*args, **kwargs)
+        slow_queries.observe(self, "find_one", time.time() - start,
+                             filter=args[0] if args else kwargs.get("filter"), sort=kwargs.get("sort"))
         return doc
 
     @find_method
@@ -216,7 +494,10 @@ class Collection(object):
         """
 
         if type(_id) == dict and _id.get("_id"):
-            return self.find_one({"_id": ObjectId(_id["_id"])}, **kwargs)
+            _id = _id["_id"]
+
+        if self._coalescer is not None and self._coalescer.accepts(kwargs) and current_read_scope() is None:
+            return self._coalescer.find_by_id(ObjectId(_id), **kwargs)
 
         return self.find_one({"_id": ObjectId(_id)}, **kwargs)
 
@@ -235,9 +516,46 @@ class Collection(object):
         # Be mindful this might not filter missing documents that may not have been returned, had we done the query.
         if projection is not None and list(projection.keys()) == ["_id"]:
             return [self({"_id": x}, fetched_fields={"_id": True}) for x in id_list]
+        elif current_read_scope() is not None and current_read_scope().accepts(kwargs):
+            return current_read_scope().find_by_ids(self, id_list, dict(kwargs, projection=projection))
+        elif self._coalescer is not None and self._coalescer.accepts(kwargs):
+            return self._coalescer.find_by_ids(id_list, projection=projection, **kwargs)
         else:
             return self.find({"_id": {"$in": id_list}}, projection=projection, **kwargs)
 
+    def reload_many(self, documents, fields=None, chunk_size=1000):
+        """
+            Refreshes documents from the primary with one _id:$in query per chunk.
+            With a list of fields, only those are refreshed (see Document.reload)
+
+            Raises OperationFailure before modifying any document if some of them are not in the database.
+        """
+
+        documents_by_id = collections.OrderedDict()
+        for document in documents:
+            documents_by_id.setdefault(document["_id"], []).append(document)
+
+        projection = None
+        if fields is not None:
+            fields = list(fields)
+            projection = {f: True for f in fields}
+            projection["_id"] = True
+
+        ids = list(documents_by_id)
+        db_docs = {}
+        for i in range(0, len(ids), chunk_size):
+            for db_doc in self.find({"_id": {"$in": ids[i:i + chunk_size]}}, projection=projection, read_use="primary"):
+                db_docs[db_doc["_id"]] = db_doc
+
+        missing = [_id for _id in ids if _id not in db_docs]
+        if missing:
+            raise OperationFailure('Can not reload unsaved documents.'
+                                   ' %s not found in the database. Maybe _id was a string and not ObjectId?' % missing)
+
+        for _id, docs in documents_by_id.items():
+            for document in docs:
+                document._reload_from(db_docs[_id], fields=fields)
+
     @find_method
     def find_by_b64id(self, _id, **kwargs):
         """
@@ -260,6 +578,7 @@ class Collection(object):
         """
         return list(self.iter_column(*args, **kwargs))
 
+    @instrumented
     def iter_column(self, query=None, field="_id", **kwargs):
         """
             Return one field as an iterator.
@@ -270,11 +589,52 @@ class Collection(object):
         }
         find_kwargs["projection"][field] = True
 
-        cursor = self._collection_with_options(kwargs).find(query, **find_kwargs)  # We only want 1 field: bypass the ORM
+        collection = self._collection_with_options(kwargs)
+        (query, ), find_kwargs = self._encode_find_args((query, ), find_kwargs)
+
+        cursor = Cursor(collection, query, **find_kwargs)  # We only want 1 field: bypass the ORM
+
+        cursor = patch_cursor(cursor, **kwargs)
+
+        path = Path(field)
+        return (path.get(x) for x in cursor)
+
+    def paginate(self, query=None, sort=None, page_size=20, after=None, fields=None, **kwargs):
+        """
+            Keyset pagination: returns (documents, next_token) for the page following `after`,
+            which must be a next_token returned by a previous call with the same query and sort.
+            next_token is None on the last page.
+
+            Instead of skipping documents, the next page is a range query starting from the sort values
+            of the last document, so it should be supported by an index on the sort fields.
+            _id is added to the sort to break ties. Documents with missing sort fields are not supported.
+        """
+
+        sort = list(sort or [])
+        if "_id" not in [key for key, _ in sort]:
+            sort.append(("_id", sort[-1][1] if sort else 1))
+
+        # The sort fields are needed to build the next token.
+        if fields is not None:
+            if type(fields) == dict:
+                fields = dict(fields)
+                if any(fields.values()):
+                    fields.update({key: True for key, _ in sort})
+            else:
+                fields = list(fields) + [key for key, _ in sort if key not in fields]
+
+        if after is not None:
+            keyset = _keyset_query(sort, _decode_page_token(after, sort))
+            query = {"$and": [query, keyset]} if query else keyset
 
-        patch_cursor(cursor, **kwargs)
+        documents = list(self.find(query, fields=fields, sort=sort, limit=page_size + 1, **kwargs))
 
-        return (dotdict(x)[field] for x in cursor)
+        next_token = None
+        if len(documents) > page_size:
+            documents = documents[:page_size]
+            next_token = _encode_page_token([_get_sort_value(documents[-1], key) for key, _ in sort])
+
+        return documents, next_token
 
     def find_random(self, **kwargs):
         """
@@ -286,6 +646,129 @@ class Collection(object):
             num = random.randint(0, max - 1)
             return next(self.find(**kwargs).skip(num))
 
+    def parallel_map(self, query, func, workers=None, fields=None, reduce=None, initial=None, combine=None,
+                     partitions=None, client_factory=None):
+        """
+            Runs func(document) on all the documents matching query, in a pool of `workers` processes.
+
+            The collection is split in _id ranges using $sample, and each range is scanned by a worker
+            with its own MongoClient, decoding into this Collection's Document class.
+            func, reduce and combine must be picklable (i.e. defined at module level), as well as this Collection class.
+
+             - Without reduce: returns an iterator over the results of func, in no particular order.
+             - With reduce: each worker computes reduce(acc, func(doc)) starting from initial, and the partial
+               results are merged with combine(acc, partial) (defaults to reduce). Returns the final value.
+
+            client_factory: picklable callable returning a MongoClient. Defaults to a client with the same hosts
+            and options (credentials, TLS, replicaSet, read preference...) as this collection's, or to its
+            mongokat.registry entry.
+        """
+        from .parallel import parallel_map
+        return parallel_map(self, query, func, workers=workers, fields=fields, reduce=reduce, initial=initial,
+                            combine=combine, partitions=partitions, client_factory=client_factory)
+
+    def read_scope(self):
+        """
+            Context manager memoizing find_one({"_id": ...}), find_by_id(), find_by_ids() and
+            Document.ensure_fields() in the current thread until it exits:
+
+                with Tasks.read_scope():
+                    task = Tasks.find_by_id(_id)
+                    ...
+                    task = Tasks.find_by_id(_id)  # No query
+
+            The scope covers all the MongoKat collections used in this thread. Writes made through MongoKat
+            evict what they wrote. Writes made elsewhere aren't seen until the scope exits.
+        """
+        return read_scope()
+
+    def mirror(self, refresh_interval=60, indexes=None, updated_field=None):
+        """
+            Loads the whole collection in memory, and answers find(), find_one(), count() and distinct() locally.
+            For small collections only, e.g. currencies or categories.
+
+             - indexes: list of fields to build hash indexes on, for equality and $in queries
+             - updated_field: a date field set on each write, to only fetch the updated documents on refresh.
+               Otherwise, the whole collection is reloaded every refresh_interval seconds.
+
+            Queries outside the subset supported by mongokat.query, calls with other options than
+            filter/projection/sort/limit/skip, and calls with a read preference are sent to the server.
+            Writes are only seen locally after the next refresh, or a call to refresh().
+        """
+        from .mirror import Mirror
+        self.unmirror()
+        self._mirror = Mirror(self, refresh_interval=refresh_interval, indexes=indexes,
+                              updated_field=updated_field).start()
+        return self._mirror
+
+    def unmirror(self):
+        if self._mirror is not None:
+            self._mirror.stop()
+            self._mirror = None
+
+    def enable_coalescing(self, window=0.002, max_ids=100):
+        """
+            Coalesces concurrent find_by_id() and find_by_ids() calls from several threads on this instance:
+            calls within `window` seconds (or until max_ids ids are requested) with the same projection and
+            read preference are resolved by a single _id:$in query. Each caller gets its own Documents.
+
+            Calls with other arguments than fields/projection/read_use/read_preference are not coalesced.
+            find_by_ids() then returns a list instead of a cursor.
+        """
+        from .coalescing import FindByIdCoalescer
+        self._coalescer = FindByIdCoalescer(self, window=window, max_ids=max_ids)
+        return self._coalescer
+
+    def disable_coalescing(self):
+        self._coalescer = None
+
+    def write_buffer(self, flush_interval=1.0, max_ops=1000):
+        """
+            Returns a WriteBuffer, coalescing frequent $set/$unset/$inc/$max updates by _id and writing them
+            with one unordered bulk_write every flush_interval seconds, or every max_ops buffered updates.
+
+                with Counters.write_buffer(flush_interval=5) as buf:
+                    buf.update_one({"_id": _id}, {"$inc": {"views": 1}})
+
+            Buffered writes are not acknowledged until flushed: call close() or flush() before shutdown.
+            Only after_save hooks are called, once per flushed document.
+        """
+        from .write_buffer import WriteBuffer
+        return WriteBuffer(self, flush_interval=flush_interval, max_ops=max_ops)
+
+    def change_stream_dispatcher(self, **kwargs):
+        """
+            Returns a ChangeStreamDispatcher, running the after_save and after_delete hooks of this collection
+            from a change stream once started, including for writes made outside of MongoKat:
+
+                dispatcher = Products.change_stream_dispatcher(checkpoint_store=MongoCheckpointStore(db.checkpoints))
+                dispatcher.start()
+
+            Inline after_* hooks are disabled on this instance while it runs. Needs a replica set.
+        """
+        from .change_streams import ChangeStreamDispatcher
+        return ChangeStreamDispatcher(self, **kwargs)
+
+    def iter_bson_file(self, path, fields=None, filter=None):
+        """
+            Iterates over the documents of a mongodump .bson file as Documents of this collection,
+            without a database. The file is memory-mapped and decoded by chunks.
+
+             - fields: only keep these fields, like a find() projection
+             - filter: only yield the documents matching this query, evaluated with mongokat.query
+        """
+        from .bson_files import iter_bson_file
+        return iter_bson_file(self, path, fields=fields, filter=filter)
+
+    def dump_bson_file(self, query, path, fields=None, **kwargs):
+        """
+            Writes the documents matching query to a .bson file readable by mongorestore and iter_bson_file(),
+            streaming raw BSON batches from the server. Returns the number of documents written.
+        """
+        from .bson_files import dump_bson_file
+        _param_fields(kwargs, fields)
+        return dump_bson_file(self, query, path, **kwargs)
+
     def one(self, *args, **kwargs):
         bson_obj = self.find(*args, **kwargs)
         count = bson_obj.count()
@@ -300,6 +783,8 @@ class Collection(object):
     #
     #
 
+    @instrumented
+    @invalidates_read_scope
     def insert(self, data, return_object=False):
         """ Inserts the data as a new document. """
 
@@ -313,20 +798,37 @@ class Collection(object):
 
     # http://api.mongodb.org/python/current/api/pymongo/collection.html
 
+    @instrumented
+    @invalidates_read_scope
     def bulk_write(self, *args, **kwargs):
         """ Hook are not supported for this method! """
         return self.collection.bulk_write(*args, **kwargs)
 
+    @instrumented
+    @invalidates_read_scope
     def insert_one(self, document, **kwargs):
-        ret = self.collection.insert_one(document, **kwargs)
+        encoded = self._encode_document(document)
+        ret = self.collection.insert_one(encoded, **kwargs)
+        if encoded is not document:
+            document["_id"] = ret.inserted_id
         self.trigger("after_save", ids=[ret.inserted_id], replacements=[document])
         return ret
 
+    @instrumented
+    @invalidates_read_scope
     def insert_many(self, documents, **kwargs):
-        ret = self.collection.insert_many(documents, **kwargs)
+        if self._aliases is None and not self.compressed_fields:
+            ret = self.collection.insert_many(documents, **kwargs)
+        else:
+            documents = list(documents)
+            ret = self.collection.insert_many([self._encode_document(document) for document in documents], **kwargs)
+            for document, _id in zip(documents, ret.inserted_ids):
+                document["_id"] = _id
         self.trigger("after_save", ids=ret.inserted_ids, replacements=documents)
         return ret
 
+    @instrumented
+    @invalidates_read_scope
     def replace_one(self, filter, replacement, **kwargs):
 
         if self.immutable:
@@ -343,7 +845,7 @@ class Collection(object):
             if before_doc:
                 self.trigger("before_save", replacements=[replacement], ids=[before_doc["_id"]])
 
-        ret = self.collection.replace_one(filter, replacement, **kwargs)
+        ret = self.collection.replace_one(self._encode_filter(filter), self._encode_document(replacement), **kwargs)
 
         if ret.modified_count is 0:
             return ret
@@ -354,6 +856,8 @@ class Collection(object):
 
         return ret
 
+    @instrumented
+    @invalidates_read_scope
     def update_one(self, filter, update, **kwargs):
 
         if self.immutable:
@@ -371,7 +875,7 @@ class Collection(object):
             if before_doc:
                 self.trigger("before_save", update=update, ids=[before_doc["_id"]])
 
-        ret = self.collection.update_one(filter, update, **kwargs)
+        ret = self.collection.update_one(self._encode_filter(filter), self._encode_update(update), **kwargs)
 
         if ret.modified_count is 0:
             return ret
@@ -382,6 +886,8 @@ class Collection(object):
 
         return ret
 
+    @instrumented
+    @invalidates_read_scope
     def update_many(self, filter, update, **kwargs):
 
         if self.immutable:
@@ -399,7 +905,7 @@ class Collection(object):
             if before_ids:
                 self.trigger("before_save", update=update, ids=before_ids)
 
-        ret = self.collection.update_many(filter, update, **kwargs)
+        ret = self.collection.update_many(self._encode_filter(filter), self._encode_update(update), **kwargs)
 
         if ret.modified_count is 0:
             return ret
@@ -408,26 +914,30 @@ class Collection(object):
 
         return ret
 
+    @instrumented
+    @invalidates_read_scope
     def delete_one(self, filter, **kwargs):
         doc = None
         if self.has_trigger("before_delete") or self.has_trigger("after_delete"):
             doc = self.find_one(filter, read_use="primary")
             self.trigger("before_delete", documents=[doc])
 
-        ret = self.collection.delete_one(filter, **kwargs)
+        ret = self.collection.delete_one(self._encode_filter(filter), **kwargs)
 
         if doc is not None:
             self.trigger("after_delete", documents=[doc])
 
         return ret
 
+    @instrumented
+    @invalidates_read_scope
     def delete_many(self, filter, **kwargs):
         docs = []
         if self.has_trigger("before_delete") or self.has_trigger("after_delete"):
             docs = list(self.find(filter, read_use="primary"))
             self.trigger("before_delete", documents=docs)
 
-        ret = self.collection.delete_many(filter, **kwargs)
+        ret = self.collection.delete_many(self._encode_filter(filter), **kwargs)
 
         if len(docs) > 0:
             self.trigger("after_delete", documents=docs)
@@ -435,16 +945,20 @@ class Collection(object):
         return ret
 
     @find_method
+    @invalidates_read_scope
     def find_one_and_delete(self, filter, **kwargs):
         self.trigger("before_delete", filter=filter)
-        ret = self.collection.find_one_and_delete(filter, **kwargs)
+        fetched_fields = kwargs.get("projection")
+        _, kwargs = self._encode_find_args((), kwargs)
+        ret = self.collection.find_one_and_delete(self._encode_filter(filter), **kwargs)
         if ret is None:
             return None
-        doc = self(ret, fetched_fields=kwargs.get("projection"))
+        doc = self(self._decode_document(ret), fetched_fields=fetched_fields)
         self.trigger("after_delete", documents=[doc])
         return doc
 
     @find_method
+    @invalidates_read_scope
     def find_one_and_replace(self, filter, replacement, **kwargs):
 
         if self.immutable:
@@ -455,14 +969,17 @@ class Collection(object):
         else:
             del kwargs["allow_protected_fields"]
 
-        ret = self.collection.find_one_and_replace(filter, replacement, **kwargs)
+        fetched_fields = kwargs.get("projection")
+        _, kwargs = self._encode_find_args((), kwargs)
+        ret = self.collection.find_one_and_replace(self._encode_filter(filter), self._encode_document(replacement), **kwargs)
         if ret is None:
             return None
-        doc = self(ret, fetched_fields=kwargs.get("projection"))
+        doc = self(self._decode_document(ret), fetched_fields=fetched_fields)
         self.trigger("after_save", documents=[doc], replacements=[replacement])
         return doc
 
     @find_method
+    @invalidates_read_scope
     def find_one_and_update(self, filter, update, **kwargs):
 
         if self.immutable:
@@ -479,13 +996,24 @@ class Collection(object):
             if before_id:
                 self.trigger("before_save", update=update, ids=[before_id["_id"]])
 
-        ret = self.collection.find_one_and_update(filter, update, **kwargs)
+        fetched_fields = kwargs.get("projection")
+        _, kwargs = self._encode_find_args((), kwargs)
+        ret = self.collection.find_one_and_update(self._encode_filter(filter), self._encode_update(update), **kwargs)
         if ret is None:
             return None
-        doc = self(ret, fetched_fields=kwargs.get("projection"))
+        doc = self(self._decode_document(ret), fetched_fields=fetched_fields)
         self.trigger("after_save", documents=[doc], update=update)
         return doc
 
+    def ensure_indexes(self, dry_run=False):
+        """
+            Creates the indexes declared in __indexes__ that don't exist yet. Existing indexes are never
+            modified nor dropped. Returns a report: {"create": [...], "exists": [...], "conflicts": [...], "undeclared": [...]}
+            where conflicts are indexes with the same fields but different options.
+            With dry_run=True, only the report is computed.
+        """
+        return ensure_indexes(self, dry_run=dry_run)
+
     #
     #
     # EVENTS MANAGEMENT
@@ -494,14 +1022,20 @@ class Collection(object):
 
     def has_trigger(self, event):
         """ Does this trigger need to run? """
-        return hasattr(self.document_class, event)
+        return hasattr(self.document_class, event) and event not in self.dispatched_events
 
     def trigger(self, event, filter=None, update=None, documents=None, ids=None, replacements=None):
-        """ Trigger the after_save hook on documents, if present. """
+        """ Trigger the after_save hook on documents, if present. Deferred hooks are queued, see mongokat.hooks """
 
         if not self.has_trigger(event):
             return
 
+        if is_deferred(self.document_class, event) and hook_queue.put(
+                self, event, filter=filter, update=update, documents=documents, ids=ids, replacements=replacements):
+            return
+
+        fetched = documents is None
+
         if documents is not None:
             pass
         elif ids is not None:
@@ -511,8 +1045,13 @@ class Collection(object):
         else:
             raise Exception("Trigger couldn't filter documents")
 
+        count = 0
         for doc in documents:
+            count += 1
             getattr(doc, event)(update=update, replacements=replacements)
+
+        if fetched and metrics.enabled:
+            metrics.record_trigger_reads(self, count)
     #
     #
     # FOR BACKWARDS-COMPATIBILITY
@@ -527,6 +1066,8 @@ class Collection(object):
     def db(self):
         return self.database
 
+    @instrumented
+    @invalidates_read_scope
     def save(self, to_save, **kwargs):
 
         if self.immutable and "_id" in to_save:
@@ -544,11 +1085,16 @@ class Collection(object):
         if self.has_trigger("before_save") and "_id" in to_save:
             self.trigger("before_save", replacements=[to_save], ids=[to_save["_id"]])
 
-        _id = self.collection.save(to_save, **kwargs)
+        encoded = self._encode_document(to_save)
+        _id = self.collection.save(encoded, **kwargs)
+        if encoded is not to_save:
+            to_save["_id"] = _id
 
         self.trigger("after_save", replacements=[to_save], ids=[_id])
         return _id
 
+    @instrumented
+    @invalidates_read_scope
     def update(self, spec, document, **kwargs):
 
         if self.immutable:
@@ -566,10 +1112,12 @@ class Collection(object):
             if before_ids:
                 self.trigger("before_save", ids=before_ids, update=document)
 
-        ret = self.collection.update(spec, document, **kwargs)
+        ret = self.collection.update(self._encode_filter(spec), self._encode_update(document), **kwargs)
         self.trigger("after_save", ids=before_ids, update=document)
         return ret
 
+    @instrumented
+    @invalidates_read_scope
     def remove(self, spec_or_id=None, **kwargs):
         docs = []
 
@@ -586,6 +1134,9 @@ class Collection(object):
             docs = list(self.find(filter, read_use="primary", limit=limit))
             self.trigger("before_delete", documents=docs)
 
+        if isinstance(spec_or_id, collections.Mapping):
+            spec_or_id = self._encode_filter(spec_or_id)
+
         ret = self.collection.remove(spec_or_id=spec_or_id, **kwargs)
 
         if len(docs) > 0:
@@ -593,6 +1144,8 @@ class Collection(object):
 
         return ret
 
+    @instrumented
+    @invalidates_read_scope
     def find_and_modify(self, query={}, update=None, **kwargs):
 
         if self.immutable:
@@ -604,11 +1157,18 @@ class Collection(object):
             else:
                 del kwargs["allow_protected_fields"]
 
-        ret = self.collection.find_and_modify(query=query, update=update, **kwargs)
+        fetched_fields = kwargs.get("projection")
+        if self._aliases is not None:
+            if kwargs.get("fields") is not None:
+                kwargs["fields"] = self._aliases.encode_projection(kwargs["fields"])
+            if kwargs.get("sort") is not None:
+                kwargs["sort"] = self._aliases.encode_sort(kwargs["sort"])
+
+        ret = self.collection.find_and_modify(query=self._encode_filter(query), update=self._encode_update(update), **kwargs)
         if ret is None:
             return None
         self.trigger("after_save", ids=[ret["_id"]], update=update)
-        return self(ret, fetched_fields=kwargs.get("projection"))
+        return self(self._decode_document(ret), fetched_fields=fetched_fields)
 
     def get_from_id(self, _id):
         return self.find_one({"_id": _id})
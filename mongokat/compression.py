@@ -0,0 +1,95 @@
+"""
+Transparent compression of large fields, declared with Collection.compressed_fields = {"html": "zlib", ...}
+
+Values are stored as BSON Binary with a user-defined subtype, whose payload is one byte for the codec,
+one byte for the type of the original value, and the compressed data. They are compressed on every
+write path of the Collection, and decompressed by Document on first access.
+
+Compressed fields can't be queried on, and raw Binary values are seen by dict(doc) or doc.items()
+until the fields are accessed.
+"""
+import bz2
+import zlib
+from bson import BSON
+from bson.binary import Binary
+from bson.py3compat import text_type
+
+COMPRESSED_SUBTYPE = 0x80
+
+# name: (id, compress, decompress)
+CODECS = {
+    "zlib": (1, zlib.compress, zlib.decompress),
+    "bz2": (2, bz2.compress, bz2.decompress)
+}
+
+_CODECS_BY_ID = {codec[0]: codec for codec in CODECS.values()}
+
+_TYPE_BYTES = 0
+_TYPE_TEXT = 1
+_TYPE_BSON = 2
+
+
+def is_compressed(value):
+    return value.__class__ is Binary and value.subtype == COMPRESSED_SUBTYPE
+
+
+def compress_value(value, codec="zlib"):
+    """ Returns a compressed Binary for a str, bytes, or any BSON-encodable value """
+
+    if value is None or is_compressed(value):
+        return value
+
+    codec_id, compress, _ = CODECS[codec]
+
+    if isinstance(value, text_type):
+        value_type, data = _TYPE_TEXT, value.encode("utf-8")
+    elif isinstance(value, bytes):
+        value_type, data = _TYPE_BYTES, value
+    else:
+        value_type, data = _TYPE_BSON, BSON.encode({"v": value})
+
+    return Binary(bytes(bytearray([codec_id, value_type])) + compress(data), COMPRESSED_SUBTYPE)
+
+
+def decompress_value(value):
+    """ Reverse of compress_value() """
+
+    header = bytearray(value[:2])
+    _, _, decompress = _CODECS_BY_ID[header[0]]
+    data = decompress(bytes(value[2:]))
+
+    if header[1] == _TYPE_TEXT:
+        return data.decode("utf-8")
+    if header[1] == _TYPE_BSON:
+        return BSON(data).decode()["v"]
+    return data
+
+
+def compress_document(document, compressed_fields):
+    """ Returns a copy of document with compressed fields, or document itself if there was nothing to compress """
+
+    to_compress = [k for k in compressed_fields if k in document and not is_compressed(dict.__getitem__(document, k))]
+    if not to_compress:
+        return document
+
+    compressed = dict(document)
+    for k in to_compress:
+        compressed[k] = compress_value(compressed[k], compressed_fields[k])
+    return compressed
+
+
+def compress_update(update, compressed_fields):
+    """ Compresses the values of $set and $setOnInsert, or a replacement document """
+
+    if not any(k.startswith("$") for k in update):
+        return compress_document(update, compressed_fields)
+
+    compressed = update
+    for operator in ("$set", "$setOnInsert"):
+        if operator in update:
+            fields = compress_document(update[operator], compressed_fields)
+            if fields is not update[operator]:
+                if compressed is update:
+                    compressed = dict(update)
+                compressed[operator] = fields
+    return compressed
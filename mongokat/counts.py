@@ -0,0 +1,67 @@
+import time
+import threading
+from collections import OrderedDict
+from bson import BSON
+
+
+class CountCache(object):
+    """
+      Keeps the results of count() by query. Stale results are returned immediately
+      while a background thread refreshes them. Only the max_entries most recently used queries are kept.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()
+        self._refreshing = set()
+
+    def _key(self, query, kwargs):
+        return (BSON.encode(query or {}), repr(sorted(kwargs.items())))
+
+    def get(self, query, kwargs, max_staleness, compute):
+        """ Returns the cached count, calling compute() synchronously only if there is none yet """
+
+        key = self._key(query, kwargs)
+        with self._lock:
+            cached = self._counts.pop(key, None)
+            if cached is not None:
+                self._counts[key] = cached
+
+        if cached is None:
+            value = compute()
+            self._store(key, value)
+            return value
+
+        value, computed_at = cached
+        if time.time() - computed_at > max_staleness:
+            self._refresh(key, compute)
+        return value
+
+    def _store(self, key, value):
+        with self._lock:
+            self._counts.pop(key, None)
+            self._counts[key] = (value, time.time())
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def _refresh(self, key, compute):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._store(key, compute())
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=run, name="mongokat-count")
+        thread.daemon = True
+        thread.start()
+
+    def clear(self):
+        with self._lock:
+            self._counts = OrderedDict()
@@ -0,0 +1,229 @@
+import time
+import threading
+from pymongo.cursor import Cursor as PymongoCursor
+from pymongo.command_cursor import CommandCursor
+from .profiling import slow_queries
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class AdaptiveBatchSize(object):
+    """
+      Computes the batch size of each getMore from the previous batches:
+
+       - the average size of the documents, so that a batch weighs about target_bytes
+       - the time the consumer took to process them, so that a batch lasts about target_seconds
+
+      The smallest of both is used, bounded by min_size and max_size, and can at most double at each step.
+    """
+
+    def __init__(self, target_bytes=4 * 1024 * 1024, target_seconds=1.0, min_size=10, max_size=10000, initial=100):
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = initial
+        self.avg_document_size = None
+        self.documents_per_second = None
+        self._last_documents = 0
+        self._last_fetched_at = None
+
+    def consumed(self, now):
+        """ Called when the consumer needs the next batch """
+        if self._last_fetched_at is None or not self._last_documents:
+            return
+        elapsed = now - self._last_fetched_at
+        if elapsed > 0:
+            self.documents_per_second = self._ema(self.documents_per_second, self._last_documents / elapsed)
+
+    def fetched(self, documents, nbytes, now):
+        """ Called after each batch is received """
+        self._last_documents = documents
+        self._last_fetched_at = now
+        if documents and nbytes:
+            self.avg_document_size = self._ema(self.avg_document_size, float(nbytes) / documents)
+        self.size = self._next_size()
+
+    def _ema(self, previous, value):
+        if previous is None:
+            return value
+        return 0.7 * previous + 0.3 * value
+
+    def _next_size(self):
+        size = self.max_size
+        if self.avg_document_size:
+            size = min(size, self.target_bytes / self.avg_document_size)
+        if self.documents_per_second:
+            size = min(size, self.documents_per_second * self.target_seconds)
+        size = min(size, self.size * 2)
+        return int(max(self.min_size, min(self.max_size, size)))
+
+
+class Cursor(PymongoCursor):
+    """ pymongo Cursor returned by Collection.find() """
+
+    _adaptive_batch_size = None
+    _last_response_bytes = 0
+
+    @property
+    def mongokat_collection(self):
+        return self.collection.codec_options.document_class[1]["mongokat_collection"]
+
+    def adaptive_batch_size(self, **kwargs):
+        """ Lets an AdaptiveBatchSize choose the size of each batch. kwargs are passed to it. """
+        self._adaptive_batch_size = AdaptiveBatchSize(**kwargs)
+        self.batch_size(self._adaptive_batch_size.size)
+        return self
+
+    def _unpack_response(self, response, cursor_id, codec_options):
+        self._last_response_bytes = len(getattr(response, "payload_document", None) or getattr(response, "documents", b""))
+        return PymongoCursor._unpack_response(self, response, cursor_id, codec_options)
+
+    def _refresh(self):
+
+        adaptive = self._adaptive_batch_size
+        if adaptive is None or len(self._Cursor__data):
+            return self._timed_refresh()
+
+        adaptive.consumed(time.time())
+        if self.cursor_id:
+            self._Cursor__batch_size = adaptive.size
+
+        retrieved = self.retrieved
+        ret = self._timed_refresh()
+        adaptive.fetched(self.retrieved - retrieved, self._last_response_bytes, time.time())
+        return ret
+
+    def _timed_refresh(self):
+
+        # Only time the initial query
+        if not slow_queries.enabled or self.cursor_id is not None:
+            return PymongoCursor._refresh(self)
+
+        start = time.time()
+        ret = PymongoCursor._refresh(self)
+        slow_queries.observe(
+            self.mongokat_collection, "find", time.time() - start,
+            filter=self._Cursor__spec, sort=self._Cursor__ordering
+        )
+        return ret
+
+
+def _buffered_count(cursor):
+    """ Number of documents already fetched by a pymongo cursor, that next() can return without a getMore """
+    if isinstance(cursor, PymongoCursor):
+        return len(cursor._Cursor__data)
+    if isinstance(cursor, CommandCursor):
+        return len(cursor._CommandCursor__data)
+    return 1
+
+
+def _put(batches, stopped, item):
+    """ Blocks until item is queued, unless the PrefetchingCursor was closed or garbage collected """
+    while not stopped.is_set():
+        try:
+            batches.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _prefetch(cursor, batches, stopped):
+    """
+      Target of the PrefetchingCursor thread. It doesn't reference the PrefetchingCursor, so that
+      an abandoned one can be garbage collected, which stops the thread.
+    """
+    try:
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            # Hand over the batch before blocking on the next getMore
+            if _buffered_count(cursor) == 0:
+                if not _put(batches, stopped, batch):
+                    return
+                batch = []
+        if batch:
+            _put(batches, stopped, batch)
+        _put(batches, stopped, PrefetchingCursor._END)
+    except Exception as e:  # pylint: disable=broad-except
+        _put(batches, stopped, e)
+    finally:
+        cursor.close()
+
+
+class PrefetchingCursor(object):
+    """
+      Iterates over a cursor from a background thread, so that the next batches are fetched and
+      decoded while the current one is being consumed. At most `depth` batches are kept in memory.
+
+      The thread starts on the first next(). Options like sort() or limit() must be set before wrapping
+      the cursor. Closing or garbage collecting the PrefetchingCursor stops the thread and closes the cursor.
+    """
+
+    _END = object()
+
+    def __init__(self, cursor, depth=1):
+        self.cursor = cursor
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._stopped = threading.Event()
+        self._batch = []
+        self._position = 0
+        self._closed = False
+        self._thread = None
+
+    def _start(self):
+        self._thread = threading.Thread(target=_prefetch, args=(self.cursor, self._queue, self._stopped),
+                                        name="mongokat-prefetch")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._position >= len(self._batch):
+            if self._closed:
+                raise StopIteration
+            if self._thread is None:
+                self._start()
+            item = self._queue.get()
+            if item is self._END:
+                self._closed = True
+                raise StopIteration
+            if isinstance(item, Exception):
+                self._closed = True
+                raise item
+            self._batch = item
+            self._position = 0
+
+        doc = self._batch[self._position]
+        self._batch[self._position] = None
+        self._position += 1
+        return doc
+
+    __next__ = next
+
+    def close(self):
+        """ Stops the background thread and closes the underlying cursor """
+        self._closed = True
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.cursor.close()
+
+    def __del__(self):
+        # The thread closes the cursor when it stops, a getMore in progress can't be interrupted
+        self._closed = True
+        self._stopped.set()
+        if self._thread is None:
+            self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,8 +1,11 @@
 import base64
 import copy
-from .utils import dotdict
+from .utils import Path
+from .compression import is_compressed, decompress_value, COMPRESSED_SUBTYPE
+from .parallel import process_collection
+from .registry import reference_client_factory
 from uuid import UUID, uuid4
-from bson import BSON
+from bson import BSON, Binary
 from pymongo.errors import OperationFailure
 import collections
 
@@ -26,14 +29,120 @@ def _flatten_fetched_fields(fields_arg):
         return tuple(sorted(fields_arg))
 
 
+def _unpickle_document(collection_class, document_class, client_factory, database_name, collection_name,
+                       data, fetched_fields, initialized_with_doc):
+    """ Rebuilds a pickled Document, bound to a Collection instance of the current process """
+    mongokat_collection = process_collection(collection_class, client_factory, database_name, collection_name)
+    doc = document_class(BSON(data).decode(), mongokat_collection=mongokat_collection,
+                         fetched_fields=fetched_fields, gen_skel=False)
+    doc._initialized_with_doc = initialized_with_doc
+    return doc
+
+
+class _CompressedFields(object):
+    """ dict overrides of the Documents of Collections declaring compressed_fields, see mongokat.compression """
+
+    def __getitem__(self, key):
+        value = super(_CompressedFields, self).__getitem__(key)
+        if value.__class__ is Binary and value.subtype == COMPRESSED_SUBTYPE and \
+                key in self.mongokat_collection.compressed_fields:
+            value = self._decompress_field(key, value)
+        return value
+
+    def get(self, key, default=None):
+        value = super(_CompressedFields, self).get(key, default)
+        if value.__class__ is Binary and value.subtype == COMPRESSED_SUBTYPE and \
+                key in self.mongokat_collection.compressed_fields:
+            value = self._decompress_field(key, value)
+        return value
+
+
+class _AccessTracking(object):
+    """ dict overrides of the Documents with an access tracker, see mongokat.projections """
+
+    def __getitem__(self, key):
+        if self._access_tracker is not None:
+            self._track_access(key)
+        return super(_AccessTracking, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        if self._access_tracker is not None:
+            self._track_access(key)
+        return super(_AccessTracking, self).get(key, default)
+
+    def __contains__(self, key):
+        if self._access_tracker is not None:
+            self._track_access(key)
+        return super(_AccessTracking, self).__contains__(key)
+
+    def keys(self):
+        if self._access_tracker is not None:
+            self._track_all()
+        return super(_AccessTracking, self).keys()
+
+    def items(self):
+        if self._access_tracker is not None:
+            self._track_all()
+        return super(_AccessTracking, self).items()
+
+    def values(self):
+        if self._access_tracker is not None:
+            self._track_all()
+        return super(_AccessTracking, self).values()
+
+    def __iter__(self):
+        if self._access_tracker is not None:
+            self._track_all()
+        return super(_AccessTracking, self).__iter__()
+
+    def __len__(self):
+        if self._access_tracker is not None:
+            self._track_all()
+        return super(_AccessTracking, self).__len__()
+
+    # `if doc:` doesn't need all the fields
+    def __bool__(self):
+        return dict.__len__(self) > 0
+
+    __nonzero__ = __bool__
+
+    def copy(self):
+        if self._access_tracker is not None:
+            self._track_all()
+        return super(_AccessTracking, self).copy()
+
+
+_DOCUMENT_SUBCLASSES = {}
+
+
+def _document_subclass(document_class, compressed, tracked):
+    """
+      Returns document_class with the dict overrides needed by compressed fields and/or access tracking.
+      Other Documents keep the plain dict methods. Subclasses are created once and keep the name of document_class.
+    """
+    key = (document_class, compressed, tracked)
+    subclass = _DOCUMENT_SUBCLASSES.get(key)
+    if subclass is None:
+        bases = ((_AccessTracking, ) if tracked else ()) + ((_CompressedFields, ) if compressed else ())
+        subclass = _DOCUMENT_SUBCLASSES.setdefault(key, type(document_class.__name__, bases + (document_class, ), {
+            "__module__": document_class.__module__,
+            "_document_class": document_class
+        }))
+    return subclass
+
+
 class Document(dict):
 
+    # Set on the subclasses created by _document_subclass()
+    _document_class = None
     _initialized_with_doc = False
     _fetched_fields = None
+    _compressed_sizes = None
+    _access_tracker = None
     mongokat_collection = None
     gen_skel = True
 
-    def __init__(self, doc=None, mongokat_collection=None, fetched_fields=None, gen_skel=None):
+    def __init__(self, doc=None, mongokat_collection=None, fetched_fields=None, gen_skel=None, access_tracker=None):
 
         if mongokat_collection is not None:
             self.mongokat_collection = mongokat_collection
@@ -56,9 +165,64 @@ class Document(dict):
         if self.gen_skel:
             self.generate_skeleton()
 
+        # Set last, so that only the accesses made by the caller are tracked, see mongokat.projections
+        if access_tracker is not None:
+            access_tracker.documents += 1
+            self._access_tracker = access_tracker
+
+        compressed = bool(getattr(self.mongokat_collection, "compressed_fields", None))
+        if compressed or access_tracker is not None:
+            self.__class__ = _document_subclass(self._document_class or self.__class__, compressed,
+                                                access_tracker is not None)
+
     def __str__(self):
         return "%s(%s)" % (self.__class__.__name__, dict(self))
 
+    def _track_access(self, key):
+        """ Records a key read by the call site, fetching it if it wasn't in the learned projection """
+        self._access_tracker.add(key)
+        fetched_fields = self._fetched_fields
+        if fetched_fields is not None and key not in fetched_fields and not dict.__contains__(self, key):
+            tracker, self._access_tracker = self._access_tracker, None
+            try:
+                self.ensure_fields([key])
+            finally:
+                self._access_tracker = tracker
+
+    def _track_all(self):
+        """ The call site needs all the fields: fetch the ones outside of the learned projection """
+        self._access_tracker.needs_full()
+        if self._fetched_fields is None or self._initialized_with_doc:
+            return
+        tracker, self._access_tracker = self._access_tracker, None
+        try:
+            excluded = {field: False for field in self._fetched_fields if "." not in field}
+            excluded["_id"] = False
+            db_doc = self.mongokat_collection.find_one({"_id": self["_id"]}, projection=excluded)
+            for k, v in (db_doc or {}).items():
+                if not dict.__contains__(self, k):
+                    dict.__setitem__(self, k, v)
+            self._fetched_fields = None
+            self._initialized_with_doc = True
+        finally:
+            self._access_tracker = tracker
+
+    def _decompress_field(self, key, value):
+        """ Replaces a compressed field by its value, keeping its stored size """
+        if self._compressed_sizes is None:
+            self._compressed_sizes = {}
+        self._compressed_sizes[key] = len(value)
+        value = decompress_value(value)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def get_compressed_size(self, key):
+        """ Returns the stored size in bytes of a compressed field, or None if it wasn't compressed """
+        value = dict.get(self, key)
+        if is_compressed(value):
+            return len(value)
+        return (self._compressed_sizes or {}).get(key)
+
     def __hash__(self):
         if '_id' in self:
             value = self['_id']
@@ -69,10 +233,30 @@ class Document(dict):
     def __deepcopy__(self, memo={}):
         obj = self.__class__(doc=cPickle.loads(cPickle.dumps(self.copy())), gen_skel=self.gen_skel, mongokat_collection=self.mongokat_collection, fetched_fields=self._fetched_fields)
         obj.__dict__ = self.__dict__.copy()
+        obj.__class__ = self.__class__
         return obj
 
-    # def __reduce__(self):
-    #     return (self.__class__, (self.copy(), self.mongokat_collection, self._fetched_fields, self.gen_skel))
+    def __copy__(self):
+        """ Shallow copy, bound to the same Collection instance """
+        obj = self.__class__.__new__(self.__class__)
+        obj.__dict__.update(self.__dict__)
+        dict.update(obj, dict.items(self))
+        return obj
+
+    def __reduce__(self):
+        """
+            Documents are pickled as BSON along with the path of their Collection class and a reference to
+            its client, without credentials, and are bound to a per-process instance of that Collection when
+            unpickled. The pickling process reuses the original client, other processes use the
+            mongokat.registry client of the database, which must be registered there.
+        """
+        mongokat_collection = self.mongokat_collection
+        client_factory = reference_client_factory(mongokat_collection)
+        return (_unpickle_document, (
+            mongokat_collection.__class__, self._document_class or self.__class__, client_factory,
+            mongokat_collection.database.name, mongokat_collection.collection.name,
+            BSON.encode(self), self._fetched_fields, self._initialized_with_doc
+        ))
 
     @property
     def b64id(self):
@@ -122,26 +306,37 @@ class Document(dict):
             if f in self:
                 del self[f]
 
-    def reload(self):
+    def reload(self, fields=None):
         """
         allow to refresh the document, so after using update(), it could reload
         its value from the database.
 
         Be carreful : reload() will erase all unsaved values.
+        With a list of fields, only those are refreshed, and added to the fetched fields.
 
         If no _id is set in the document, a KeyError is raised.
 
         """
 
-        old_doc = self.mongokat_collection.find_one({"_id": self['_id']}, read_use="primary")
+        self.mongokat_collection.reload_many([self], fields=fields)
 
-        if not old_doc:
-            raise OperationFailure('Can not reload an unsaved document.'
-                                   ' %s is not found in the database. Maybe _id was a string and not ObjectId?' % self['_id'])
-        else:
+    def _reload_from(self, db_doc, fields=None):
+        """ Replaces the values of this document (or only `fields`) by those of db_doc """
+
+        if fields is None:
             for k in list(self.keys()):
                 del self[k]
-            self.update(dotdict(old_doc))
+            self.update(db_doc)
+            self._fetched_fields = None
+        else:
+            for field in fields:
+                path = Path(field)
+                if path.contains(db_doc):
+                    path.set(self, path.get(db_doc))
+                elif path.contains(self):
+                    path.delete(self)
+            if self._fetched_fields is not None:
+                self._fetched_fields += tuple(f for f in fields if f not in self._fetched_fields)
 
         self._initialized_with_doc = False
 
@@ -156,6 +351,9 @@ class Document(dict):
           REPLACES the object in DB. This is forbidden with objects from find() methods unless force=True is given.
         """
 
+        if self._access_tracker is not None:
+            self._track_all()
+
         if not self._initialized_with_doc and not force:
             raise Exception("Cannot save a document not initialized from a Python dict. This might remove fields from the DB!")
 
@@ -176,10 +374,9 @@ class Document(dict):
 
         if data is None:
 
-            data = dotdict(self)
-            if "_id" not in data:
+            if "_id" not in self:
                 raise KeyError("_id must be set in order to do a save_partial()")
-            del data["_id"]
+            data = {k: v for k, v in self.items() if k != "_id"}
 
         if len(data) == 0:
           return
@@ -187,16 +384,12 @@ class Document(dict):
         if not allow_protected_fields:
             self.mongokat_collection._check_protected_fields(data)
 
-        apply_on = dotdict(self)
-
         self._initialized_with_doc = False
 
         self.mongokat_collection.update_one({"_id": self["_id"]}, {"$set": data}, **kwargs)
 
         for k, v in data.items():
-            apply_on[k] = v
-
-        self.update(dict(apply_on))
+            Path(k).set(self, v)
 
     def __generate_skeleton(self, doc, struct, path=""):
 
@@ -10,3 +10,15 @@ class ImmutableDocumentError(Exception):
 
 class ProtectedFieldsError(Exception):
   pass
+
+
+class InvalidPageTokenError(Exception):
+  pass
+
+
+class UnsupportedQueryError(Exception):
+  pass
+
+
+class HookQueueFullError(Exception):
+  pass
@@ -0,0 +1,294 @@
+"""
+Deferred execution of after_save and after_delete hooks.
+
+Hooks run inline by default: the caller of a write waits for the documents to be fetched and for each hook
+to return. Hooks decorated with @deferred are instead queued to a pool of worker threads once
+``hook_queue.enable()`` was called, which fetch the written documents and call the hook in batches::
+
+    class MyDocument(Document):
+
+        @deferred
+        def after_save(self, update=None, **kwargs):
+            purge_cache(self["_id"])
+
+    hook_queue.enable(workers=4, max_size=10000)
+
+The queue is bounded: when it is full, writes block (``when_full="block"``), run their hooks inline
+(``"inline"``) or raise HookQueueFullError (``"raise"``). ``hook_queue.drain()`` waits for the queued hooks
+and ``hook_queue.shutdown()``, also called at exit, drains the queue then stops the workers.
+
+When the queue isn't enabled, deferred hooks run inline like the others.
+"""
+import atexit
+import threading
+import time
+from .exceptions import HookQueueFullError
+from .metrics import metrics
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+DEFERRABLE_EVENTS = ("after_save", "after_delete")
+
+# Tells a worker to stop
+_STOP = object()
+
+
+def deferred(func):
+    """ Decorator for after_save and after_delete Document methods that don't need to block writes """
+    if func.__name__ not in DEFERRABLE_EVENTS:
+        raise ValueError("Only %s hooks can be deferred" % " and ".join(DEFERRABLE_EVENTS))
+    func.deferred = True
+    return func
+
+
+def is_deferred(document_class, event):
+    return event in DEFERRABLE_EVENTS and getattr(getattr(document_class, event, None), "deferred", False)
+
+
+class _Task(object):
+    """ One call to Collection.trigger: documents are either given or fetched by the worker """
+
+    __slots__ = ("mongokat_collection", "event", "documents", "ids", "filter", "update", "replacements")
+
+    def __init__(self, mongokat_collection, event, documents=None, ids=None, filter=None, update=None,
+                 replacements=None):
+        self.mongokat_collection = mongokat_collection
+        self.event = event
+        self.documents = documents
+        self.ids = ids
+        self.filter = filter
+        self.update = update
+        self.replacements = replacements
+
+
+class HookQueue(object):
+    """ Bounded queue of deferred hooks. A global instance is available as mongokat.hooks.hook_queue """
+
+    def __init__(self):
+        self.enabled = False
+        self.workers = 0
+        self.batch_size = 100
+        self.when_full = "block"
+        self.put_timeout = None
+        self.on_error = None
+        self.exit_timeout = 30
+        self.last_error = None
+
+        self.enqueued = 0
+        self.processed = 0
+        self.errors = 0
+        self.batches = 0
+        self.inline = 0
+        self.max_depth = 0
+
+        self._queue = None
+        self._threads = []
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._atexit_registered = False
+
+    def enable(self, workers=4, max_size=10000, batch_size=100, when_full="block", put_timeout=None,
+               on_error=None, exit_timeout=30):
+        """
+          workers: number of worker threads
+          max_size: maximum number of queued trigger calls
+          batch_size: maximum number of queued calls a worker processes together, with one query per
+                      (collection, event)
+          when_full: "block", "inline" or "raise", when the queue is full. With put_timeout, "block" waits
+                     at most put_timeout seconds then raises, and the others wait that long before acting.
+          on_error: callable receiving (exception, mongokat_collection, event) when a hook raises
+          exit_timeout: maximum number of seconds to wait for the queued hooks when the interpreter exits
+        """
+        if when_full not in ("block", "inline", "raise"):
+            raise ValueError("when_full must be block, inline or raise")
+
+        if self.enabled:
+            self.shutdown()
+
+        self.workers = workers
+        self.batch_size = batch_size
+        self.when_full = when_full
+        self.put_timeout = put_timeout
+        self.on_error = on_error
+        self.exit_timeout = exit_timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name="mongokat-hooks-%s" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        if not self._atexit_registered:
+            atexit.register(self._shutdown_at_exit)
+            self._atexit_registered = True
+
+        self.enabled = True
+
+    def disable(self):
+        self.shutdown()
+
+    def depth(self):
+        """ Number of queued or running trigger calls """
+        return self._pending
+
+    def stats(self):
+        return {
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "errors": self.errors,
+            "batches": self.batches,
+            "inline": self.inline,
+            "depth": self._pending,
+            "max_depth": self.max_depth
+        }
+
+    def put(self, mongokat_collection, event, **kwargs):
+        """ Queues a trigger call. Returns False if the hooks must be run inline by the caller. """
+
+        if not self.enabled:
+            return False
+
+        task = _Task(mongokat_collection, event, **kwargs)
+
+        with self._condition:
+            self._pending += 1
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self._pending)
+
+        try:
+            if self.when_full == "block":
+                self._queue.put(task, True, self.put_timeout)
+            else:
+                self._queue.put(task, self.put_timeout is not None, self.put_timeout)
+        except queue.Full:
+            with self._condition:
+                self._pending -= 1
+                self.enqueued -= 1
+                self._condition.notify_all()
+            if self.when_full == "inline":
+                self.inline += 1
+                return False
+            raise HookQueueFullError("%s hooks are queued" % self._queue.maxsize)
+
+        return True
+
+    def drain(self, timeout=None):
+        """ Waits until all the queued hooks ran. Returns False on timeout. """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while self._pending:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining if remaining is not None else 1)
+        return True
+
+    def shutdown(self, timeout=None):
+        """ Stops accepting hooks, waits for the queued ones then stops the workers """
+        if not self.enabled:
+            return True
+        self.enabled = False
+        drained = self.drain(timeout=timeout)
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        return drained
+
+    def _shutdown_at_exit(self):
+        self.shutdown(timeout=self.exit_timeout)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is _STOP:
+                return
+
+            tasks = [task]
+            stop = False
+            while len(tasks) < self.batch_size:
+                try:
+                    task = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if task is _STOP:
+                    stop = True
+                    break
+                tasks.append(task)
+
+            try:
+                self._process(tasks)
+            finally:
+                with self._condition:
+                    self._pending -= len(tasks)
+                    self._condition.notify_all()
+
+            if stop:
+                return
+
+    def _process(self, tasks):
+
+        groups = {}
+        for task in tasks:
+            groups.setdefault((id(task.mongokat_collection), task.event), []).append(task)
+
+        for group in groups.values():
+            mongokat_collection, event = group[0].mongokat_collection, group[0].event
+            try:
+                if metrics.enabled:
+                    metrics.call(mongokat_collection, "deferred_%s" % event, self._run_group, (group, ), {})
+                else:
+                    self._run_group(group)
+            except Exception as e:  # pylint: disable=broad-except
+                self._failed(e, mongokat_collection, event)
+
+        with self._condition:
+            self.batches += 1
+            self.processed += len(tasks)
+
+    def _failed(self, error, mongokat_collection, event):
+        with self._condition:
+            self.errors += 1
+            self.last_error = error
+        if self.on_error is not None:
+            self.on_error(error, mongokat_collection, event)
+
+    def _run_group(self, group):
+        """ Runs the hooks of trigger calls on the same collection and event, fetching their _ids at once """
+
+        mongokat_collection = group[0].mongokat_collection
+
+        ids = []
+        for task in group:
+            if task.documents is None and task.ids is not None:
+                ids.extend(task.ids)
+
+        fetched = {}
+        if ids:
+            for doc in mongokat_collection.find_by_ids(list(set(ids)), read_use="primary"):
+                fetched[doc["_id"]] = doc
+            if metrics.enabled:
+                metrics.record_trigger_reads(mongokat_collection, len(fetched))
+
+        for task in group:
+            if task.documents is not None:
+                documents = task.documents
+            elif task.ids is not None:
+                documents = [fetched[_id] for _id in task.ids if _id in fetched]
+            else:
+                documents = list(mongokat_collection.find(task.filter, read_use="primary"))
+
+            # A failing hook doesn't prevent the others from running
+            for doc in documents:
+                try:
+                    getattr(doc, task.event)(update=task.update, replacements=task.replacements)
+                except Exception as e:  # pylint: disable=broad-except
+                    self._failed(e, mongokat_collection, task.event)
+
+
+hook_queue = HookQueue()
@@ -0,0 +1,201 @@
+"""
+Declarative indexes and query-shape index advisor.
+
+Collections can declare their indexes::
+
+    class SampleCollection(Collection):
+        __indexes__ = [
+            {"fields": [("url", 1)], "unique": True},
+            {"fields": ["store", "date"]},
+            {"fields": "name", "sparse": True}
+        ]
+
+and apply them with ``SampleCollection(...).ensure_indexes()``, or just get a report with ``dry_run=True``.
+
+When ``index_advisor.enable()`` has been called, the filter, sort and projection of the queries going through
+find methods are recorded, and ``index_advisor.report()`` lists the query shapes no declared index supports.
+"""
+import threading
+import pymongo
+from bson.py3compat import string_type
+
+_EQUALITY_OPERATORS = ("$eq", "$in")
+
+# Index options compared with the existing indexes
+_COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def normalize_index_fields(fields):
+    """ Returns a list of (field, direction) from a string, a list of strings, or a list of tuples """
+    if isinstance(fields, string_type):
+        return [(fields, pymongo.ASCENDING)]
+    return [(f, pymongo.ASCENDING) if isinstance(f, string_type) else tuple(f) for f in fields]
+
+
+def declared_indexes(mongokat_collection, short_names=True):
+    """ Returns a list of (key, options) for the declared indexes """
+
+    aliases = mongokat_collection._aliases if short_names else None
+    indexes = []
+    for index in mongokat_collection.__indexes__ or []:
+        options = {k: v for k, v in index.items() if k != "fields"}
+        key = normalize_index_fields(index["fields"])
+        if aliases is not None:
+            key = [(aliases.encode_key(f), d) for f, d in key]
+        indexes.append((key, options))
+    return indexes
+
+
+def ensure_indexes(mongokat_collection, dry_run=False):
+    """ See Collection.ensure_indexes() """
+
+    existing = {}
+    for name, info in mongokat_collection.collection.index_information().items():
+        existing[tuple(tuple(k) for k in info["key"])] = (name, info)
+
+    report = {"create": [], "exists": [], "conflicts": [], "undeclared": []}
+    declared_keys = set()
+
+    for key, options in declared_indexes(mongokat_collection):
+        declared_keys.add(tuple(key))
+        if tuple(key) not in existing:
+            report["create"].append({"fields": key, "options": options})
+            if not dry_run:
+                mongokat_collection.collection.create_index(key, **options)
+            continue
+
+        name, info = existing[tuple(key)]
+        differences = {k: v for k, v in options.items() if k in _COMPARED_OPTIONS and info.get(k, False) != v}
+        if differences:
+            report["conflicts"].append({"fields": key, "name": name, "options": differences})
+        else:
+            report["exists"].append({"fields": key, "name": name})
+
+    for key, (name, info) in existing.items():
+        if key not in declared_keys and name != "_id_":
+            report["undeclared"].append({"fields": list(key), "name": name})
+
+    return report
+
+
+def query_shape(query):
+    """ Returns the equality and range fields of a filter, and the shapes of its $or branches """
+
+    shape = {"equality": set(), "range": set(), "or": []}
+    for k, v in (query or {}).items():
+        if k == "$and":
+            for sub in v:
+                sub_shape = query_shape(sub)
+                shape["equality"] |= sub_shape["equality"]
+                shape["range"] |= sub_shape["range"]
+                shape["or"] += sub_shape["or"]
+        elif k in ("$or", "$nor"):
+            shape["or"] += [query_shape(sub) for sub in v]
+        elif k.startswith("$"):
+            continue
+        elif isinstance(v, dict) and any(op.startswith("$") for op in v):
+            if all(op in _EQUALITY_OPERATORS for op in v):
+                shape["equality"].add(k)
+            else:
+                shape["range"].add(k)
+        else:
+            shape["equality"].add(k)
+    return shape
+
+
+def is_supported(shape, sort_fields, index_keys):
+    """
+      Simple heuristic: a query is supported when the first field of an index is filtered on, or is
+      the first sort field. All the $or branches must be supported.
+    """
+
+    filter_fields = shape["equality"] | shape["range"]
+
+    if shape["or"] and not filter_fields:
+        return all(is_supported(branch, [], index_keys) for branch in shape["or"])
+
+    for key in index_keys:
+        if key[0][0] in filter_fields:
+            return True
+        if sort_fields and key[0][0] == sort_fields[0]:
+            return True
+
+    return not filter_fields and not sort_fields and not shape["or"]
+
+
+class IndexAdvisor(object):
+    """ Records query shapes. A global instance is available as mongokat.indexes.index_advisor """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._shapes = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._shapes = {}
+
+    def record(self, mongokat_collection, query=None, sort=None, projection=None):
+
+        if sort is None:
+            sort_fields = ()
+        elif isinstance(sort, string_type):
+            sort_fields = (sort, )
+        else:
+            sort_fields = tuple(f if isinstance(f, string_type) else f[0] for f in sort)
+
+        shape = query_shape(query)
+        key = (
+            mongokat_collection.__class__,
+            _freeze_shape(shape),
+            sort_fields,
+            tuple(sorted(k for k, v in (projection or {}).items() if v))
+        )
+
+        with self._lock:
+            entry = self._shapes.get(key)
+            if entry is None:
+                entry = self._shapes[key] = {"count": 0, "shape": shape, "collection": mongokat_collection}
+            entry["count"] += 1
+
+    def report(self, unsupported_only=True):
+        """ Returns the recorded query shapes, by default only those without a supporting declared index """
+
+        report = []
+        with self._lock:
+            items = list(self._shapes.items())
+
+        for (collection_class, _, sort_fields, projection), entry in items:
+            index_keys = [key for key, _ in declared_indexes(entry["collection"], short_names=False)] + [[("_id", 1)]]
+            supported = is_supported(entry["shape"], list(sort_fields), index_keys)
+            if unsupported_only and supported:
+                continue
+            report.append({
+                "collection": collection_class.__name__,
+                "equality": sorted(entry["shape"]["equality"]),
+                "range": sorted(entry["shape"]["range"]),
+                "or": len(entry["shape"]["or"]),
+                "sort": list(sort_fields),
+                "projection": list(projection),
+                "count": entry["count"],
+                "supported": supported
+            })
+
+        return sorted(report, key=lambda x: -x["count"])
+
+
+def _freeze_shape(shape):
+    return (
+        tuple(sorted(shape["equality"])),
+        tuple(sorted(shape["range"])),
+        tuple(_freeze_shape(branch) for branch in shape["or"])
+    )
+
+
+index_advisor = IndexAdvisor()
@@ -0,0 +1,215 @@
+"""
+Per-collection operation metrics.
+
+Instrumentation is disabled by default and costs a single attribute check per call in that state.
+Once enabled with ``metrics.enable()``, every find method and write method of a Collection records:
+
+ - the number of calls and errors, and a latency histogram
+ - the number of documents and bytes decoded for the cursors it created
+ - the number of extra documents read by ``trigger`` to run hooks
+
+Stats are aggregated per (Collection class name, method name). Note that for ``find()``, the latency
+only covers the creation of the cursor: batches fetched later are accounted in documents/bytes.
+
+Exporters are plain callables receiving a snapshot: ``metrics.add_exporter(my_callback)`` then
+``metrics.export()``. ``format_statsd`` and ``format_prometheus`` render a snapshot as text.
+"""
+import bisect
+import functools
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class OperationStats(object):
+    """ Counters for one (Collection class, method) pair """
+
+    __slots__ = ("calls", "errors", "total_time", "buckets", "documents", "bytes", "trigger_reads")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.documents = 0
+        self.bytes = 0
+        self.trigger_reads = 0
+
+    def observe(self, duration, error=False):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_time += duration
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_time": self.total_time,
+            "buckets": list(self.buckets),
+            "documents": self.documents,
+            "bytes": self.bytes,
+            "trigger_reads": self.trigger_reads
+        }
+
+
+class Metrics(object):
+    """ Registry of OperationStats. A global instance is available as mongokat.metrics.metrics """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._exporters = []
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def _get(self, key):
+        stats = self._stats.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(key, OperationStats())
+        return stats
+
+    def current_operation(self):
+        """ Returns the outermost instrumented method running in this thread, or None """
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            return stack[0]
+        return None
+
+    def call(self, mongokat_collection, method, func, args, kwargs):
+        """ Runs func(*args, **kwargs) and records it as a call to `method` """
+
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(method)
+
+        error = False
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            duration = time.time() - start
+            stack.pop()
+            stats = self._get((mongokat_collection.__class__.__name__, method))
+            with self._lock:
+                stats.observe(duration, error=error)
+
+    def record_decoded(self, key, documents, nbytes):
+        """ Called by the BSON decoder for each batch of documents """
+        stats = self._get(key)
+        with self._lock:
+            stats.documents += documents
+            stats.bytes += nbytes
+
+    def record_trigger_reads(self, mongokat_collection, documents):
+        """ Called by Collection.trigger when it had to fetch documents to run hooks """
+        key = (mongokat_collection.__class__.__name__, self.current_operation() or "trigger")
+        stats = self._get(key)
+        with self._lock:
+            stats.trigger_reads += documents
+
+    def snapshot(self):
+        """ Returns a dict of {(collection_class_name, method): stats_dict} """
+        with self._lock:
+            return {key: stats.as_dict() for key, stats in self._stats.items()}
+
+    def add_exporter(self, exporter):
+        """ Registers a callable that will receive the snapshot on each export() """
+        self._exporters.append(exporter)
+
+    def remove_exporter(self, exporter):
+        self._exporters.remove(exporter)
+
+    def export(self):
+        """ Sends the current snapshot to all the exporters """
+        snapshot = self.snapshot()
+        for exporter in self._exporters:
+            exporter(snapshot)
+        return snapshot
+
+
+metrics = Metrics()
+
+
+def instrumented(func):
+    """
+      Decorator for Collection methods, recording them in the global metrics when enabled.
+    """
+    method = func.__name__
+
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        if not metrics.enabled:
+            return func(self, *args, **kwargs)
+        return metrics.call(self, method, func, (self, ) + args, kwargs)
+
+    return wrapped
+
+
+def format_statsd(snapshot, prefix="mongokat"):
+    """ Renders a snapshot as StatsD lines. Counters are absolute: use a gauge-aware backend or reset() after export. """
+    lines = []
+    for (collection_name, method), stats in sorted(snapshot.items()):
+        name = "%s.%s.%s" % (prefix, collection_name, method)
+        lines.append("%s.calls:%d|c" % (name, stats["calls"]))
+        lines.append("%s.errors:%d|c" % (name, stats["errors"]))
+        lines.append("%s.documents:%d|c" % (name, stats["documents"]))
+        lines.append("%s.bytes:%d|c" % (name, stats["bytes"]))
+        lines.append("%s.trigger_reads:%d|c" % (name, stats["trigger_reads"]))
+        if stats["calls"]:
+            lines.append("%s.latency:%.3f|ms" % (name, 1000.0 * stats["total_time"] / stats["calls"]))
+    return "\n".join(lines)
+
+
+def format_prometheus(snapshot, prefix="mongokat"):
+    """ Renders a snapshot in the Prometheus text exposition format """
+
+    counters = (
+        ("calls", "calls_total", "Number of calls"),
+        ("errors", "errors_total", "Number of calls that raised"),
+        ("documents", "documents_decoded_total", "Number of documents decoded"),
+        ("bytes", "bytes_decoded_total", "Number of BSON bytes decoded"),
+        ("trigger_reads", "trigger_reads_total", "Number of documents fetched to run hooks")
+    )
+
+    items = sorted(snapshot.items())
+    lines = []
+
+    for field, suffix, help_text in counters:
+        metric = "%s_%s" % (prefix, suffix)
+        lines.append("# HELP %s %s" % (metric, help_text))
+        lines.append("# TYPE %s counter" % metric)
+        for (collection_name, method), stats in items:
+            lines.append('%s{collection="%s",method="%s"} %d' % (metric, collection_name, method, stats[field]))
+
+    metric = "%s_duration_seconds" % prefix
+    lines.append("# HELP %s Latency of calls" % metric)
+    lines.append("# TYPE %s histogram" % metric)
+    for (collection_name, method), stats in items:
+        labels = 'collection="%s",method="%s"' % (collection_name, method)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf", ), stats["buckets"]):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (metric, labels, bound, cumulative))
+        lines.append("%s_sum{%s} %s" % (metric, labels, repr(stats["total_time"])))
+        lines.append("%s_count{%s} %d" % (metric, labels, stats["calls"]))
+
+    return "\n".join(lines) + "\n"
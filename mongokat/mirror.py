@@ -0,0 +1,255 @@
+"""
+In-memory mirror of a small collection, see Collection.mirror()
+"""
+import copy
+import threading
+import time
+from bson.py3compat import string_type
+from .query import compile_filter, values_at, candidates, type_class, sort_documents, project
+from .utils import Path
+
+# find() kwargs answered locally. Calls with a read preference always go to the server.
+LOCAL_FIND_KWARGS = frozenset(["filter", "projection", "sort", "limit", "skip"])
+
+
+def _index_key(value):
+    try:
+        hash(value)
+    except TypeError:
+        return None
+    return (type_class(value), value)
+
+
+class MirrorCursor(object):
+    """ Minimal cursor over the documents matched by a Mirror """
+
+    def __init__(self, mirror, docs, projection=None, sort=None, limit=None, skip=None):
+        self._mirror = mirror
+        self._docs = docs
+        self._projection = projection
+        self._sort = sort
+        self._limit = limit or 0
+        self._skip = skip or 0
+        self._results = None
+        self._iterator = None
+
+    def sort(self, key_or_list, direction=1):
+        self._sort = [(key_or_list, direction)] if isinstance(key_or_list, string_type) else key_or_list
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if not with_limit_and_skip:
+            return len(self._docs)
+        return len(self._get_results())
+
+    def close(self):
+        pass
+
+    def _get_results(self):
+        if self._results is None:
+            docs = list(self._docs)
+            if self._sort:
+                sort_documents(docs, self._sort)
+            docs = docs[self._skip:self._skip + self._limit if self._limit else None]
+            self._results = [self._mirror.make_document(doc, self._projection) for doc in docs]
+        return self._results
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._iterator is None:
+            self._iterator = iter(self._get_results())
+        return next(self._iterator)
+
+    __next__ = next
+
+    def __len__(self):
+        return len(self._get_results())
+
+
+class Mirror(object):
+    """
+      Keeps all the documents of a collection in memory, with hash indexes on some fields.
+
+      Refreshes every refresh_interval seconds in a background thread: with updated_field, only the documents
+      updated since the last refresh are fetched (plus a scan of the _ids to detect deletions), otherwise
+      the whole collection is reloaded.
+    """
+
+    def __init__(self, mongokat_collection, refresh_interval=60, indexes=None, updated_field=None):
+        self.mongokat_collection = mongokat_collection
+        self.refresh_interval = refresh_interval
+        self.index_fields = list(indexes or [])
+        self.updated_field = updated_field
+
+        self.documents = {}
+        self.indexes = {}
+        self.last_refresh = None
+        self.local_queries = 0
+        self.server_queries = 0
+
+        self._last_updated = None
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.refresh(full=True)
+        if self.refresh_interval:
+            self._thread = threading.Thread(target=self._run, name="mongokat-mirror")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+    def _server_find(self, query):
+        return self.mongokat_collection.find(query, read_use="primary")
+
+    def refresh(self, full=False):
+
+        if full or self.updated_field is None or self._last_updated is None:
+            documents = {doc["_id"]: doc for doc in self._server_find({})}
+            with self._lock:
+                self.documents = documents
+                self._rebuild_indexes()
+        else:
+            updated = list(self._server_find({self.updated_field: {"$gte": self._last_updated}}))
+            ids = set(self.mongokat_collection.collection.distinct("_id"))
+            with self._lock:
+                for _id in list(self.documents):
+                    if _id not in ids:
+                        self._remove(_id)
+                for doc in updated:
+                    self._remove(doc["_id"])
+                    self._add(doc)
+
+        if self.updated_field is not None:
+            values = [Path(self.updated_field).get(doc, None) for doc in self.documents.values()]
+            values = [v for v in values if v is not None]
+            if values:
+                self._last_updated = max(values)
+
+        self.last_refresh = time.time()
+
+    def _rebuild_indexes(self):
+        self.indexes = {field: {} for field in self.index_fields}
+        for doc in self.documents.values():
+            self._index(doc, add=True)
+
+    def _index(self, doc, add):
+        for field, index in self.indexes.items():
+            for value in candidates(values_at(doc, Path(field).parts)):
+                key = _index_key(value)
+                if key is None:
+                    continue
+                if add:
+                    index.setdefault(key, set()).add(doc["_id"])
+                elif key in index:
+                    index[key].discard(doc["_id"])
+
+    def _add(self, doc):
+        self.documents[doc["_id"]] = doc
+        self._index(doc, add=True)
+
+    def _remove(self, _id):
+        doc = self.documents.pop(_id, None)
+        if doc is not None:
+            self._index(doc, add=False)
+
+    def _candidate_ids(self, query):
+        """ Uses _id or a hash index to restrict the documents to test, or returns None """
+
+        for field, condition in (query or {}).items():
+            if field.startswith("$"):
+                continue
+
+            if isinstance(condition, dict) and list(condition.keys()) == ["$in"]:
+                values = condition["$in"]
+            elif isinstance(condition, dict):
+                continue
+            else:
+                values = [condition]
+
+            if any(v is None or isinstance(v, (dict, list)) for v in values):
+                continue
+
+            if field == "_id":
+                return set(v for v in values if v in self.documents)
+
+            if field in self.indexes:
+                ids = set()
+                for value in values:
+                    ids |= self.indexes[field].get(_index_key(value), set())
+                return ids
+
+        return None
+
+    def match(self, query):
+        """ Returns the list of stored documents matching the query. Raises UnsupportedQueryError """
+        predicate = compile_filter(query)
+        with self._lock:
+            ids = self._candidate_ids(query)
+            if ids is None:
+                docs = list(self.documents.values())
+            else:
+                docs = [self.documents[_id] for _id in ids]
+            self.local_queries += 1
+            return [doc for doc in docs if predicate(doc)]
+
+    def make_document(self, doc, projection=None):
+        """ Returns a new Document, so that the caller can't modify the mirror """
+        mongokat_collection = self.mongokat_collection
+        document = mongokat_collection.document_class(mongokat_collection=mongokat_collection, fetched_fields=projection)
+        document.update(copy.deepcopy(project(doc, projection)))
+        return document
+
+    def accepts(self, kwargs):
+        return all(k in LOCAL_FIND_KWARGS for k in kwargs)
+
+    def find(self, query=None, projection=None, sort=None, limit=None, skip=None):
+        return MirrorCursor(self, self.match(query), projection=projection, sort=sort, limit=limit, skip=skip)
+
+    def find_one(self, query=None, projection=None, sort=None):
+        for doc in self.find(query, projection=projection, sort=sort, limit=1):
+            return doc
+        return None
+
+    def count(self, query=None):
+        return len(self.match(query))
+
+    def distinct(self, key, query=None):
+        values = []
+        seen = set()
+        parts = Path(key).parts
+        for doc in self.match(query):
+            for value in values_at(doc, parts):
+                for item in (value if isinstance(value, list) else [value]):
+                    index_key = _index_key(item)
+                    if index_key is None:
+                        if item not in values:
+                            values.append(item)
+                    elif index_key not in seen:
+                        seen.add(index_key)
+                        values.append(item)
+        return values
@@ -0,0 +1,190 @@
+"""
+Parallel collection scans with a process pool, used by Collection.parallel_map()
+"""
+import os
+import multiprocessing
+from pymongo import MongoClient
+from .registry import RegistryClientFactory
+
+# Per-process clients and Collection instances, created lazily in the workers.
+_PROCESS_CLIENTS = {}
+_PROCESS_COLLECTIONS = {}
+
+
+class HostsClientFactory(object):
+    """
+      Picklable factory for a MongoClient connecting to a list of hosts, with the options of the original
+      client (credentials, TLS, replicaSet, read preference, write concern, pool size...).
+      Pickling it pickles these options, including the password.
+    """
+
+    def __init__(self, hosts, options=None):
+        self.hosts = tuple(sorted(hosts))
+        self.options = dict(options or {})
+        self.options["connect"] = False
+
+    def __call__(self):
+        return MongoClient(list(self.hosts), **self.options)
+
+    def _key(self):
+        return (self.hosts, repr(sorted(self.options.items())))
+
+    def __eq__(self, other):
+        return isinstance(other, HostsClientFactory) and other._key() == self._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+def client_factory_for(client):
+    """
+      Returns a HostsClientFactory building clients like an existing MongoClient, without connecting it.
+      Raises ValueError when its options can't be copied: pass an explicit client_factory instead.
+    """
+    client_options = client._MongoClient__options
+    options = dict(client_options._options)
+
+    credentials = client_options.credentials
+    if credentials is not None and "username" not in options:
+        if credentials.mechanism_properties:
+            raise ValueError("Can't copy authMechanismProperties, pass an explicit client_factory")
+        options["username"] = credentials.username
+        options["password"] = credentials.password
+        options["authsource"] = credentials.source
+        options["authmechanism"] = credentials.mechanism
+
+    nodes = client.nodes or client._topology_settings.seeds
+    return HostsClientFactory(["%s:%s" % node for node in nodes], options)
+
+
+def collection_client_factory(mongokat_collection):
+    """ Returns a client factory for a Collection: its registry entry if it is lazy, else its hosts """
+    if mongokat_collection.is_lazy:
+        return RegistryClientFactory(mongokat_collection.__database__)
+    return client_factory_for(mongokat_collection.client)
+
+
+def _process_client(client_factory):
+    """ Returns a MongoClient for this process, never one inherited from the parent """
+    key = (os.getpid(), client_factory)
+    client = _PROCESS_CLIENTS.get(key)
+    if client is None:
+        client = _PROCESS_CLIENTS[key] = client_factory()
+    return client
+
+
+def process_collection(collection_class, client_factory, database_name, collection_name):
+    """ Returns a Collection instance for this process, bound to the client of _process_client() """
+    key = (os.getpid(), collection_class, client_factory, database_name, collection_name)
+    mongokat_collection = _PROCESS_COLLECTIONS.get(key)
+    if mongokat_collection is None:
+        client = _process_client(client_factory)
+        mongokat_collection = _PROCESS_COLLECTIONS[key] = collection_class(
+            collection=client[database_name][collection_name])
+    return mongokat_collection
+
+
+def id_ranges(collection, partitions, sample_per_partition=10):
+    """
+      Splits a pymongo collection into at most `partitions` _id ranges of similar sizes,
+      using a $sample of its _ids. Returns a list of (min_id, max_id) tuples, bounds may be None.
+    """
+    if partitions <= 1:
+        return [(None, None)]
+
+    sample = collection.aggregate([
+        {"$sample": {"size": partitions * sample_per_partition}},
+        {"$project": {"_id": 1}}
+    ])
+
+    try:
+        ids = sorted(set(x["_id"] for x in sample))
+    except TypeError:
+        # _ids of different types can't be compared in Python 3.
+        return [(None, None)]
+
+    bounds = []
+    for i in range(1, partitions):
+        bound = ids[(i * len(ids)) // partitions] if ids else None
+        if bound is not None and (not bounds or bounds[-1] != bound):
+            bounds.append(bound)
+
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def range_query(query, min_id, max_id):
+    """ Restricts a query to a range of _ids: min_id <= _id < max_id """
+
+    id_range = {}
+    if min_id is not None:
+        id_range["$gte"] = min_id
+    if max_id is not None:
+        id_range["$lt"] = max_id
+
+    if not id_range:
+        return query or {}
+    if not query:
+        return {"_id": id_range}
+    return {"$and": [query, {"_id": id_range}]}
+
+
+def _worker(task):
+    """ Runs in a worker process: maps (and optionally reduces) one range of _ids """
+
+    (collection_class, client_factory, database_name, collection_name, query, fields,
+     func, reduce, initial) = task
+
+    mongokat_collection = process_collection(collection_class, client_factory, database_name, collection_name)
+
+    cursor = mongokat_collection.find(query, fields=fields)
+
+    if reduce is None:
+        return [func(doc) for doc in cursor]
+
+    acc = initial
+    for doc in cursor:
+        acc = reduce(acc, func(doc))
+    return acc
+
+
+def parallel_map(mongokat_collection, query, func, workers=None, fields=None, reduce=None, initial=None,
+                 combine=None, partitions=None, client_factory=None):
+    """ See Collection.parallel_map() """
+
+    workers = workers or multiprocessing.cpu_count()
+    partitions = partitions or workers * 4
+
+    ranges = id_ranges(mongokat_collection.collection, partitions)
+
+    if client_factory is None:
+        client_factory = collection_client_factory(mongokat_collection)
+
+    tasks = [
+        (
+            mongokat_collection.__class__, client_factory,
+            mongokat_collection.database.name, mongokat_collection.collection.name,
+            range_query(query, min_id, max_id), fields, func, reduce, initial
+        )
+        for min_id, max_id in ranges
+    ]
+
+    def iter_results():
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap_unordered(_worker, tasks):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    if reduce is None:
+        return (item for result in iter_results() for item in result)
+
+    combine = combine or reduce
+    acc = initial
+    for partial in iter_results():
+        acc = combine(acc, partial)
+    return acc
@@ -0,0 +1,217 @@
+"""
+Slow-query capture.
+
+When enabled with ``slow_queries.enable(threshold_ms=...)``, every ``find``, ``find_one``, ``aggregate`` and ``count``
+going through MongoKat that takes longer than the threshold is recorded in an in-memory ring buffer, with:
+
+ - the Collection class and method
+ - the normalized query shape (values replaced by 1, operators and field names kept)
+ - the first calling site outside of MongoKat and PyMongo
+ - for a sample of them, the explain() plan, run asynchronously in a background thread, with flags for
+   COLLSCANs and large docsExamined/nReturned ratios.
+
+For ``find()``, the duration is the one of the initial query, measured when the cursor is first iterated.
+"""
+import datetime
+import os
+import random
+import sys
+import threading
+import collections
+from bson.son import SON
+from .utils import _CUSTOM_JSON_ENCODER
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_MONGOKAT_DIR = os.path.dirname(os.path.abspath(__file__))
+_PYMONGO_DIRS = tuple(
+    os.path.dirname(os.path.abspath(m.__file__)) for m in (__import__("pymongo"), __import__("bson"))
+)
+
+
+def normalize_query_shape(query):
+    """ Replaces all the values in a query or pipeline by 1, keeping field names and operators """
+    if isinstance(query, dict):
+        return {k: normalize_query_shape(v) for k, v in query.items()}
+    if isinstance(query, (list, tuple)) and len(query) > 0 and all(isinstance(x, (dict, list, tuple)) for x in query):
+        return [normalize_query_shape(x) for x in query]
+    return 1
+
+
+def _call_site():
+    """ Returns "file:line in function" for the first frame outside of MongoKat and PyMongo """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if not filename.startswith(_MONGOKAT_DIR) and not filename.startswith(_PYMONGO_DIRS):
+            return "%s:%s in %s" % (filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def _find_stages(plan, stage):
+    """ Does a stage named `stage` appear anywhere in this explain output? """
+    if isinstance(plan, dict):
+        if plan.get("stage") == stage:
+            return True
+        return any(_find_stages(v, stage) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_find_stages(v, stage) for v in plan)
+    return False
+
+
+def _find_key(plan, key):
+    """ Returns the first value of `key` found in this explain output """
+    if isinstance(plan, dict):
+        if key in plan:
+            return plan[key]
+        for v in plan.values():
+            found = _find_key(v, key)
+            if found is not None:
+                return found
+    elif isinstance(plan, list):
+        for v in plan:
+            found = _find_key(v, key)
+            if found is not None:
+                return found
+    return None
+
+
+class SlowQueryLog(object):
+    """ Ring buffer of slow queries. A global instance is available as mongokat.profiling.slow_queries """
+
+    def __init__(self):
+        self.enabled = False
+        self.threshold_ms = 100
+        self.explain_sample_rate = 0.1
+        self.examined_ratio_threshold = 100
+        self.dump_path = None
+        self.entries = collections.deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._explain_queue = queue.Queue(maxsize=100)
+        self._explain_thread = None
+
+    def enable(self, threshold_ms=100, capacity=1000, explain_sample_rate=0.1, examined_ratio_threshold=100,
+               dump_path=None):
+        """
+          threshold_ms: queries faster than this are ignored
+          capacity: size of the ring buffer
+          explain_sample_rate: ratio of slow queries that will be explained (0 to disable)
+          examined_ratio_threshold: docsExamined/nReturned ratio above which a query is flagged
+          dump_path: if set, each slow query is also appended to this file as a JSON line
+        """
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.examined_ratio_threshold = examined_ratio_threshold
+        self.dump_path = dump_path
+        if capacity != self.entries.maxlen:
+            self.entries = collections.deque(self.entries, maxlen=capacity)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.entries.clear()
+
+    def observe(self, mongokat_collection, method, duration, filter=None, pipeline=None, sort=None):
+        """ Records a query if it was slower than the threshold """
+
+        if duration * 1000 < self.threshold_ms:
+            return None
+
+        entry = {
+            "time": datetime.datetime.utcnow(),
+            "collection": mongokat_collection.__class__.__name__,
+            "namespace": mongokat_collection.collection.full_name,
+            "method": method,
+            "duration_ms": duration * 1000,
+            "shape": normalize_query_shape(pipeline if pipeline is not None else (filter or {})),
+            "sort": normalize_query_shape(sort) if sort else None,
+            "call_site": _call_site(),
+            "explain": None,
+            "collscan": None,
+            "docs_examined": None,
+            "n_returned": None,
+            "large_examined_ratio": None
+        }
+
+        self.entries.append(entry)
+
+        if self.dump_path:
+            self._dump_entries([entry], self.dump_path, "a")
+
+        if self.explain_sample_rate and random.random() < self.explain_sample_rate:
+            try:
+                self._explain_queue.put_nowait((entry, mongokat_collection, method, filter, pipeline, sort))
+            except queue.Full:
+                pass
+            else:
+                self._ensure_explain_thread()
+
+        return entry
+
+    def _ensure_explain_thread(self):
+        with self._lock:
+            if self._explain_thread is None or not self._explain_thread.is_alive():
+                self._explain_thread = threading.Thread(target=self._explain_worker, name="mongokat-explain")
+                self._explain_thread.daemon = True
+                self._explain_thread.start()
+
+    def _explain_worker(self):
+        while True:
+            job = self._explain_queue.get()
+            try:
+                self.explain(*job)
+            except Exception:  # pylint: disable=broad-except
+                pass
+            finally:
+                self._explain_queue.task_done()
+
+    def wait_for_explains(self):
+        """ Blocks until all the queued explain() calls are done """
+        self._explain_queue.join()
+
+    def explain(self, entry, mongokat_collection, method, filter=None, pipeline=None, sort=None):
+        """ Runs explain() for a recorded entry and updates it with the results """
+
+        collection = mongokat_collection.collection
+
+        if method == "aggregate":
+            cmd = SON([("aggregate", collection.name), ("pipeline", pipeline or []), ("cursor", {})])
+        elif method == "count":
+            cmd = SON([("count", collection.name), ("query", filter or {})])
+        else:
+            cmd = SON([("find", collection.name), ("filter", filter or {})])
+            if sort:
+                cmd["sort"] = SON(sort)
+
+        explain = collection.database.command(SON([("explain", cmd), ("verbosity", "executionStats")]))
+
+        docs_examined = _find_key(explain, "totalDocsExamined")
+        n_returned = _find_key(explain, "nReturned")
+
+        entry["explain"] = explain
+        entry["collscan"] = _find_stages(explain, "COLLSCAN")
+        entry["docs_examined"] = docs_examined
+        entry["n_returned"] = n_returned
+        if docs_examined is not None:
+            entry["large_examined_ratio"] = docs_examined > self.examined_ratio_threshold * max(n_returned or 0, 1)
+
+        return entry
+
+    def dump(self, path):
+        """ Writes all the entries of the ring buffer to a file, as JSON lines """
+        self._dump_entries(list(self.entries), path, "w")
+
+    def _dump_entries(self, entries, path, mode):
+        with self._lock:
+            with open(path, mode) as f:
+                for entry in entries:
+                    f.write(_CUSTOM_JSON_ENCODER.encode(entry) + "\n")
+
+
+slow_queries = SlowQueryLog()
@@ -0,0 +1,116 @@
+"""
+Projections learned from the fields that call sites actually read.
+
+Instead of adding fields=[...] to every find() by hand, enable learning for a while::
+
+    projection_learner.enable("learn")
+
+Documents returned by find() and find_one() calls made without a projection then record the keys read with
+doc[key], doc.get(key) and `key in doc`, per call site (the file and line of the find, outside of MongoKat).
+A call site whose documents are saved with save(), copied, or iterated (for key in doc, dict(doc), len(doc),
+keys()/items()/values()) needs all the fields and is never projected.
+
+Switching to "auto" mode applies the learned projections to the call sites that produced at least
+min_documents documents. Accessing a key outside the projection fetches it with ensure_fields() and adds it
+to the projection of the call site, so results stay correct, at the cost of one query per document:
+
+    projection_learner.enable("auto")
+    print(projection_learner.learned())
+"""
+import os
+import sys
+import threading
+
+_MONGOKAT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TRACKED_METHODS = ("find", "find_one")
+
+# Calls with these kwargs never return Documents that could be tracked
+_UNTRACKED_KWARGS = ("projection", "as_records", "json")
+
+
+class AccessTracker(object):
+    """ Keys read on the documents returned by one call site """
+
+    __slots__ = ("site", "fields", "documents", "full")
+
+    def __init__(self, site):
+        self.site = site
+        self.fields = set(["_id"])
+        self.documents = 0
+        self.full = False
+
+    def add(self, key):
+        if key not in self.fields:
+            self.fields.add(key)
+
+    def needs_full(self):
+        self.full = True
+
+
+class ProjectionLearner(object):
+    """ A global instance is available as mongokat.projections.projection_learner """
+
+    def __init__(self):
+        self.mode = "off"
+        self.min_documents = 20
+        self._trackers = {}
+        self._lock = threading.Lock()
+
+    def enable(self, mode="learn", min_documents=20):
+        """
+          mode: "learn" only records the keys read, "auto" also applies the learned projections
+          min_documents: number of documents a call site must have returned before it is projected
+        """
+        if mode not in ("learn", "auto"):
+            raise ValueError("mode must be learn or auto")
+        self.mode = mode
+        self.min_documents = min_documents
+
+    def disable(self):
+        self.mode = "off"
+
+    def reset(self):
+        with self._lock:
+            self._trackers = {}
+
+    def learned(self):
+        """ Returns {(collection class name, method, call site): sorted list of fields, or None for all fields} """
+        with self._lock:
+            trackers = list(self._trackers.items())
+        return {
+            key: None if tracker.full else sorted(tracker.fields, key=str)
+            for key, tracker in trackers
+        }
+
+    def _tracker(self, key):
+        tracker = self._trackers.get(key)
+        if tracker is None:
+            with self._lock:
+                tracker = self._trackers.setdefault(key, AccessTracker(key[2]))
+        return tracker
+
+    def prepare(self, mongokat_collection, method, kwargs):
+        """
+          Called by find_method: adds an access_tracker and, in auto mode, the learned projection to the
+          kwargs of find calls made without a projection from outside of MongoKat.
+        """
+
+        if any(kwargs.get(k) for k in _UNTRACKED_KWARGS):
+            return
+
+        # wrapped() in find_method, then the caller of the find method
+        frame = sys._getframe(2)
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(_MONGOKAT_DIR):
+            return
+
+        site = "%s:%s in %s" % (filename, frame.f_lineno, frame.f_code.co_name)
+        tracker = self._tracker((mongokat_collection.__class__.__name__, method, site))
+        kwargs["access_tracker"] = tracker
+
+        if self.mode == "auto" and not tracker.full and tracker.documents >= self.min_documents:
+            kwargs["projection"] = dict.fromkeys(list(tracker.fields), True)
+
+
+projection_learner = ProjectionLearner()
@@ -0,0 +1,425 @@
+"""
+In-process evaluation of a subset of the MongoDB query language, on Documents and plain dicts.
+
+Supported: equality (including on sub-documents), $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists, $not,
+$elemMatch, $and, $or, $nor, dotted paths and array semantics. Anything else raises UnsupportedQueryError.
+
+matches() interprets a filter at each call, compile_filter() turns it into a cached predicate, which is
+much faster when the same filter is tested on many documents.
+
+Values of different types never match range operators, like in MongoDB. Booleans are not numbers.
+"""
+import datetime
+import numbers
+import operator
+from bson.py3compat import string_type
+from .exceptions import UnsupportedQueryError
+from .utils import Path
+
+_RANGE_OPERATORS = {
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le
+}
+
+# BSON comparison order, used for sorting
+_TYPE_RANKS = {"null": 1, "number": 2, "string": 3, "object": 4, "array": 5, "binary": 6, "objectid": 7,
+               "bool": 8, "date": 9}
+
+
+def type_class(value):
+    """ Values of the same type class can be compared """
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, numbers.Number):
+        return "number"
+    if isinstance(value, string_type):
+        return "string"
+    if isinstance(value, dict):
+        return "object"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, bytes):
+        return "binary"
+    if isinstance(value, datetime.datetime):
+        return "date"
+    return value.__class__.__name__.lower()
+
+
+def values_at(doc, parts):
+    """ All the values of a dotted path, traversing arrays of sub-documents. [] when missing """
+
+    if not parts:
+        return [doc]
+
+    head, rest = parts[0], parts[1:]
+
+    if isinstance(doc, dict):
+        if head in doc:
+            return values_at(doc[head], rest)
+        return []
+
+    if isinstance(doc, list):
+        values = []
+        if head.isdigit() and int(head) < len(doc):
+            values.extend(values_at(doc[int(head)], rest))
+        for item in doc:
+            if isinstance(item, dict):
+                values.extend(values_at(item, parts))
+        return values
+
+    return []
+
+
+def candidates(values):
+    """ Values compared by operators: the values themselves, and the elements of arrays """
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for item in value:
+                yield item
+
+
+def equals(a, b):
+    return type_class(a) == type_class(b) and a == b
+
+
+def _check_value(value):
+    if isinstance(value, dict):
+        if any(k.startswith("$") for k in value):
+            raise UnsupportedQueryError("Operators are not allowed in values: %r" % value)
+    elif not isinstance(value, (list, string_type, numbers.Number, datetime.datetime)) and value is not None:
+        # ObjectId, Binary, ... compare with ==, but regular expressions must not be seen as equality
+        if hasattr(value, "pattern"):
+            raise UnsupportedQueryError("Regular expressions are not supported: %r" % value)
+
+
+def _match_eq(values, expected):
+    _check_value(expected)
+    if expected is None and not values:
+        return True
+    return any(equals(value, expected) for value in candidates(values))
+
+
+def _match_operators(values, operators):
+
+    for op, arg in operators.items():
+
+        if op == "$eq":
+            ok = _match_eq(values, arg)
+        elif op == "$ne":
+            ok = not _match_eq(values, arg)
+        elif op in _RANGE_OPERATORS:
+            _check_value(arg)
+            compare = _RANGE_OPERATORS[op]
+            cls = type_class(arg)
+            ok = any(type_class(value) == cls and compare(value, arg) for value in candidates(values))
+        elif op == "$in":
+            ok = any(_match_eq(values, x) for x in arg)
+        elif op == "$nin":
+            ok = not any(_match_eq(values, x) for x in arg)
+        elif op == "$exists":
+            ok = bool(values) == bool(arg)
+        elif op == "$not":
+            if not isinstance(arg, dict):
+                raise UnsupportedQueryError("Unsupported $not: %r" % arg)
+            ok = not _match_operators(values, arg)
+        elif op == "$elemMatch":
+            items = [item for value in values if isinstance(value, list) for item in value]
+            if arg and all(k.startswith("$") for k in arg):
+                ok = any(_match_operators([item], arg) for item in items)
+            else:
+                ok = any(isinstance(item, dict) and matches(item, arg) for item in items)
+        else:
+            raise UnsupportedQueryError("Unsupported operator: %s" % op)
+
+        if not ok:
+            return False
+
+    return True
+
+
+def matches(doc, query):
+    """ Does doc match the query? Interprets the query at each call """
+
+    for key, condition in (query or {}).items():
+
+        if key == "$and":
+            ok = all(matches(doc, q) for q in condition)
+        elif key == "$or":
+            ok = any(matches(doc, q) for q in condition)
+        elif key == "$nor":
+            ok = not any(matches(doc, q) for q in condition)
+        elif key.startswith("$"):
+            raise UnsupportedQueryError("Unsupported operator: %s" % key)
+        else:
+            values = values_at(doc, Path(key).parts)
+            if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+                ok = _match_operators(values, condition)
+            else:
+                ok = _match_eq(values, condition)
+
+        if not ok:
+            return False
+
+    return True
+
+
+def sort_key(value):
+    """ Orders values of different types like MongoDB """
+    cls = type_class(value)
+    if cls in ("object", "array"):
+        value = repr(value)
+    return (_TYPE_RANKS.get(cls, 10), value if cls != "null" else 0)
+
+
+def sort_documents(docs, sort):
+    """ Sorts a list of documents in place by a list of (field, direction). Missing fields sort as null. """
+    for field, direction in reversed(list(sort)):
+        parts = Path(field).parts
+        docs.sort(key=lambda doc: sort_key(next(iter(values_at(doc, parts)), None)), reverse=direction < 0)
+    return docs
+
+
+def project(doc, projection):
+    """ Returns a dict with the fields of an inclusion or exclusion projection """
+
+    if not projection:
+        return dict(doc)
+
+    include_id = projection.get("_id", True)
+    fields = [k for k in projection if k != "_id"]
+
+    if fields and projection[fields[0]]:
+        projected = {}
+        if include_id and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        for field in fields:
+            path = Path(field)
+            if path.contains(doc):
+                path.set(projected, path.get(doc))
+        return projected
+
+    projected = dict(doc)
+    if not include_id:
+        projected.pop("_id", None)
+    for field in fields:
+        path = Path(field)
+        if path.contains(projected):
+            # Don't modify the sub-documents of doc
+            parent = projected
+            for part in path.parents:
+                parent[part] = dict(parent[part])
+                parent = parent[part]
+            path.delete(projected)
+    return projected
+
+
+# Compiled predicates by repr() of their filter
+_COMPILED = {}
+_MAX_COMPILED = 1000
+
+
+def compile_filter(query):
+    """
+      Returns a cached predicate, predicate(doc) -> bool, equivalent to matches(doc, query).
+      Raises UnsupportedQueryError when compiling an unsupported filter.
+    """
+    key = repr(query)
+    predicate = _COMPILED.get(key)
+    if predicate is None:
+        predicate = _compile_query(query or {})
+        if len(_COMPILED) >= _MAX_COMPILED:
+            _COMPILED.clear()
+        _COMPILED[key] = predicate
+    return predicate
+
+
+def _all(predicates):
+    if not predicates:
+        return lambda doc: True
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def predicate(doc):
+        for p in predicates:
+            if not p(doc):
+                return False
+        return True
+    return predicate
+
+
+def _compile_query(query):
+    return _all([_compile_clause(key, condition) for key, condition in query.items()])
+
+
+def _compile_clause(key, condition):
+
+    if key in ("$and", "$or", "$nor"):
+        subqueries = [_compile_query(q) for q in condition]
+        if key == "$and":
+            return _all(subqueries)
+        if key == "$or":
+            return lambda doc: any(q(doc) for q in subqueries)
+        return lambda doc: not any(q(doc) for q in subqueries)
+
+    if key.startswith("$"):
+        raise UnsupportedQueryError("Unsupported operator: %s" % key)
+
+    get_values = _compile_getter(key)
+
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        test = _compile_operators(condition)
+    else:
+        test = _compile_eq(condition)
+
+    return lambda doc: test(get_values(doc))
+
+
+def _compile_getter(key):
+    """ Returns a function doc -> list of values, with a fast path for top-level fields """
+
+    if "." not in key:
+        def get_values(doc):
+            if key in doc:
+                return [doc[key]]
+            return []
+        return get_values
+
+    parts = Path(key).parts
+    return lambda doc: values_at(doc, parts)
+
+
+def _compile_eq(expected):
+
+    _check_value(expected)
+
+    if expected is None:
+        def test(values):
+            if not values:
+                return True
+            for value in values:
+                if value is None or (isinstance(value, list) and any(item is None for item in value)):
+                    return True
+            return False
+        return test
+
+    cls = type_class(expected)
+
+    def test(values):
+        for value in values:
+            if value == expected and type_class(value) == cls:
+                return True
+            if isinstance(value, list):
+                for item in value:
+                    if item == expected and type_class(item) == cls:
+                        return True
+        return False
+    return test
+
+
+def _compile_in(expected):
+    """ Uses sets by type class for hashable values """
+
+    by_class = {}
+    others = []
+    for x in expected:
+        _check_value(x)
+        try:
+            hash(x)
+        except TypeError:
+            others.append(_compile_eq(x))
+        else:
+            by_class.setdefault(type_class(x), set()).add(x)
+
+    match_none = None in by_class.get("null", ())
+
+    def test_one(value):
+        values = by_class.get(type_class(value))
+        try:
+            return values is not None and value in values
+        except TypeError:
+            return False
+
+    def test(values):
+        if match_none and not values:
+            return True
+        for value in values:
+            if test_one(value):
+                return True
+            if isinstance(value, list):
+                for item in value:
+                    if test_one(item):
+                        return True
+        if others:
+            return any(other(values) for other in others)
+        return False
+    return test
+
+
+def _compile_range(compare, arg):
+
+    _check_value(arg)
+    cls = type_class(arg)
+
+    def test(values):
+        for value in candidates(values):
+            if type_class(value) == cls and compare(value, arg):
+                return True
+        return False
+    return test
+
+
+def _compile_elem_match(arg):
+
+    if arg and all(k.startswith("$") for k in arg):
+        item_test = _compile_operators(arg)
+        match_item = lambda item: item_test([item])
+    else:
+        subquery = _compile_query(arg)
+        match_item = lambda item: isinstance(item, dict) and subquery(item)
+
+    def test(values):
+        for value in values:
+            if isinstance(value, list):
+                for item in value:
+                    if match_item(item):
+                        return True
+        return False
+    return test
+
+
+def _negate(test):
+    return lambda values: not test(values)
+
+
+def _compile_operators(operators):
+
+    tests = []
+    for op, arg in operators.items():
+        if op == "$eq":
+            tests.append(_compile_eq(arg))
+        elif op == "$ne":
+            tests.append(_negate(_compile_eq(arg)))
+        elif op in _RANGE_OPERATORS:
+            tests.append(_compile_range(_RANGE_OPERATORS[op], arg))
+        elif op == "$in":
+            tests.append(_compile_in(arg))
+        elif op == "$nin":
+            tests.append(_negate(_compile_in(arg)))
+        elif op == "$exists":
+            exists = bool(arg)
+            tests.append(lambda values: bool(values) == exists)
+        elif op == "$not":
+            if not isinstance(arg, dict):
+                raise UnsupportedQueryError("Unsupported $not: %r" % arg)
+            tests.append(_negate(_compile_operators(arg)))
+        elif op == "$elemMatch":
+            tests.append(_compile_elem_match(arg))
+        else:
+            raise UnsupportedQueryError("Unsupported operator: %s" % op)
+
+    return _all(tests)
@@ -0,0 +1,203 @@
+"""
+Unit-of-work read cache, see Collection.read_scope()
+
+Inside a scope, find_one({"_id": ...}), find_by_id(), find_by_ids() and Document.ensure_fields() are memoized
+per thread, by _id, projection and read preference. Writes made through MongoKat in the same thread evict
+the _ids they target, or all the entries of their collection when the _ids aren't known.
+"""
+import contextlib
+import copy
+import functools
+import threading
+from .utils import Path
+
+_local = threading.local()
+
+# find kwargs that can be memoized: calls with other ones always query the database
+CACHED_KWARGS = frozenset(["projection", "read_use", "read_preference"])
+
+
+def current_read_scope():
+    return getattr(_local, "scope", None)
+
+
+@contextlib.contextmanager
+def read_scope():
+    """ Opens a read scope for the current thread. Nested scopes share the outermost one. """
+
+    scope = current_read_scope()
+    if scope is not None:
+        yield scope
+        return
+
+    scope = _local.scope = ReadScope()
+    try:
+        yield scope
+    finally:
+        _local.scope = None
+
+
+def _projection_key(projection):
+    return repr(sorted(projection.items())) if projection is not None else None
+
+
+def _filter_ids(filter):
+    """ Returns the list of _ids a write filter is restricted to, or None if it can't be known """
+    if filter is None:
+        return None
+    if not isinstance(filter, dict):
+        return [filter]
+    if "_id" not in filter:
+        return None
+    value = filter["_id"]
+    if not isinstance(value, dict):
+        return [value]
+    if list(value.keys()) == ["$in"]:
+        return list(value["$in"])
+    return None
+
+
+class ReadScope(object):
+
+    def __init__(self):
+        # {collection full name: {_id: {(document class, projection key, read key): document or None}}}
+        self._collections = {}
+        self.hits = 0
+        self.misses = 0
+
+    def accepts(self, kwargs):
+        return all(k in CACHED_KWARGS for k in kwargs)
+
+    def _entries(self, mongokat_collection):
+        return self._collections.setdefault(mongokat_collection.collection.full_name, {})
+
+    def _read_key(self, kwargs):
+        return (repr(kwargs.get("read_use")), repr(kwargs.get("read_preference")))
+
+    def get(self, mongokat_collection, _id, kwargs):
+        """ Returns (found, document), with a copy of the cached document """
+
+        by_id = self._entries(mongokat_collection).get(_id)
+        if by_id is None:
+            return False, None
+
+        projection = kwargs.get("projection")
+        document_class = mongokat_collection.document_class
+        read_key = self._read_key(kwargs)
+
+        key = (document_class, _projection_key(projection), read_key)
+        if key in by_id:
+            self.hits += 1
+            doc = by_id[key]
+            return True, copy.deepcopy(doc) if doc is not None else None
+
+        # Derive an inclusion projection from the full document, e.g. for ensure_fields()
+        full_key = (document_class, None, read_key)
+        if full_key in by_id and projection and all(v for k, v in projection.items() if k != "_id"):
+            self.hits += 1
+            full = by_id[full_key]
+            if full is None:
+                return True, None
+            doc = document_class(mongokat_collection=mongokat_collection, fetched_fields=projection)
+            if projection.get("_id", True):
+                doc["_id"] = full["_id"]
+            for field in projection:
+                path = Path(field)
+                if field != "_id" and path.contains(full):
+                    path.set(doc, copy.deepcopy(path.get(full)))
+            return True, doc
+
+        return False, None
+
+    def set(self, mongokat_collection, _id, kwargs, doc):
+        """ Caches a copy of doc, which can then be returned to the caller """
+        self.misses += 1
+        key = (mongokat_collection.document_class, _projection_key(kwargs.get("projection")), self._read_key(kwargs))
+        self._entries(mongokat_collection).setdefault(_id, {})[key] = copy.deepcopy(doc) if doc is not None else None
+
+    def find_one(self, mongokat_collection, _id, kwargs, fetch):
+        found, doc = self.get(mongokat_collection, _id, kwargs)
+        if not found:
+            doc = fetch()
+            self.set(mongokat_collection, _id, kwargs, doc)
+        return doc
+
+    def find_by_ids(self, mongokat_collection, ids, kwargs):
+        """ Returns the list of found documents, in the order of ids """
+
+        docs = {}
+        missing = []
+        for _id in ids:
+            found, doc = self.get(mongokat_collection, _id, kwargs)
+            if found:
+                docs[_id] = doc
+            elif _id not in docs:
+                missing.append(_id)
+                docs[_id] = None
+
+        if missing:
+            query_kwargs = dict(kwargs)
+            projection = kwargs.get("projection")
+            hide_id = projection is not None and not projection.get("_id", True)
+            if hide_id:
+                query_kwargs["projection"] = dict(projection, _id=True)
+
+            for doc in mongokat_collection.find({"_id": {"$in": missing}}, **query_kwargs):
+                _id = doc["_id"]
+                if hide_id:
+                    del doc["_id"]
+                docs[_id] = doc
+
+            for _id in missing:
+                self.set(mongokat_collection, _id, kwargs, docs[_id])
+
+        return [docs[_id] for _id in ids if docs[_id] is not None]
+
+    def evict(self, mongokat_collection, ids=None):
+        """ Evicts some _ids of a collection, or all of them """
+        entries = self._entries(mongokat_collection)
+        if ids is None:
+            entries.clear()
+        else:
+            for _id in ids:
+                entries.pop(_id, None)
+
+    def evict_written(self, mongokat_collection, method, args, kwargs):
+
+        ids = None
+        if method in ("insert_one", "save"):
+            document = args[0] if args else None
+            if isinstance(document, dict) and "_id" in document:
+                ids = [document["_id"]]
+        elif method in ("insert", "insert_many", "bulk_write"):
+            ids = None
+        else:
+            filter = args[0] if args else None
+            for name in ("filter", "spec", "query", "spec_or_id"):
+                if name in kwargs:
+                    filter = kwargs[name]
+            ids = _filter_ids(filter)
+
+        self.evict(mongokat_collection, ids)
+
+
+def invalidates_read_scope(func):
+    """
+      Decorator for Collection write methods, evicting what they wrote from the current read scope.
+      The scope is suspended during the write, so that hooks read fresh documents.
+    """
+    method = func.__name__
+
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        scope = getattr(_local, "scope", None)
+        if scope is None:
+            return func(self, *args, **kwargs)
+        _local.scope = None
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            _local.scope = scope
+            scope.evict_written(self, method, args, kwargs)
+
+    return wrapped
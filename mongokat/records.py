@@ -0,0 +1,109 @@
+"""
+Read-only records with __slots__, returned by find(..., as_records=True) instead of Documents.
+
+A record class is generated and cached for each projection. Records don't have a __dict__ nor a reference
+to their Collection, so they use several times less memory than Documents for large result sets.
+"""
+import re
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Record classes by tuple of field names
+_CACHE = {}
+
+
+class Record(object):
+    """ Base class of generated record classes. Missing fields raise AttributeError or KeyError. """
+
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, doc):
+        setter = object.__setattr__
+        for field in self._fields:
+            if field in doc:
+                setter(self, field, doc[field])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read-only" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is read-only" % self.__class__.__name__)
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key not in self._fields:
+            return default
+        return getattr(self, key, default)
+
+    def __contains__(self, key):
+        return key in self._fields and hasattr(self, key)
+
+    def keys(self):
+        return [field for field in self._fields if hasattr(self, field)]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.to_dict())
+
+    def __reduce__(self):
+        return (_unpickle_record, (self._fields, self.to_dict()))
+
+
+def _unpickle_record(fields, data):
+    return record_class(fields)(data)
+
+
+def projection_fields(projection):
+    """ Returns the sorted top-level fields returned by an inclusion projection """
+
+    if isinstance(projection, dict):
+        fields = set(k.split(".", 1)[0] for k, v in projection.items() if v)
+        if "_id" not in projection:
+            fields.add("_id")
+    elif projection:
+        fields = set(k.split(".", 1)[0] for k in projection) | set(["_id"])
+    else:
+        raise ValueError("Records need an inclusion projection, e.g. fields=['a', 'b']")
+    return tuple(sorted(fields))
+
+
+def record_class(fields):
+    """ Returns the cached Record subclass with these field names """
+
+    fields = tuple(fields)
+    cls = _CACHE.get(fields)
+    if cls is None:
+        for field in fields:
+            if not _IDENTIFIER.match(field) or field.startswith("__") or hasattr(Record, field):
+                raise ValueError("Can't use a record for field name %r" % field)
+        cls = _CACHE[fields] = type("Record", (Record, ), {"__slots__": fields, "_fields": fields})
+    return cls
@@ -0,0 +1,158 @@
+"""
+Registry of MongoClient settings by database name, for Collections built without arguments.
+
+    registry.register("app", "mongodb://db1,db2/?replicaSet=rs0", maxPoolSize=50)
+
+    class Products(Collection):
+        __database__ = "app"
+        __collection__ = "products"
+
+    Products = Products()   # Doesn't connect
+
+Such Collections resolve their client, database and collection on first use. Clients are created lazily
+with connect=False, once per process: a process forked after first use (gunicorn, multiprocessing) gets
+its own client instead of sharing the sockets of its parent. Databases registered with the same settings
+share a client.
+"""
+import os
+import threading
+import weakref
+from pymongo import MongoClient
+
+
+class ClientRegistry(object):
+    """ A global instance is available as mongokat.registry.registry """
+
+    def __init__(self):
+        self._settings = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def register(self, database, host=None, **client_kwargs):
+        """
+          database: database name, or None for the default settings of unregistered databases
+          host, client_kwargs: MongoClient arguments, like maxPoolSize
+        """
+        client_kwargs.setdefault("connect", False)
+        self._settings[database] = (host, client_kwargs)
+
+    def unregister(self, database):
+        self._settings.pop(database, None)
+
+    def is_registered(self, database):
+        return database in self._settings or None in self._settings
+
+    def client(self, database):
+        """ Returns the MongoClient of this process for a database name """
+
+        settings = self._settings.get(database) or self._settings.get(None)
+        if settings is None:
+            raise Exception("No MongoClient registered for database %s, see mongokat.registry" % database)
+
+        host, client_kwargs = settings
+        key = (os.getpid(), repr((host, sorted(client_kwargs.items()))))
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._clients[key] = MongoClient(host, **client_kwargs)
+        return client
+
+    def close(self):
+        """ Closes the clients created by this process. They reconnect if used again. """
+        pid = os.getpid()
+        for (client_pid, _), client in list(self._clients.items()):
+            if client_pid == pid:
+                client.close()
+
+
+registry = ClientRegistry()
+
+
+class RegistryClientFactory(object):
+    """ Picklable factory returning the registry client of a database, in the process calling it """
+
+    def __init__(self, database):
+        self.database = database
+
+    def __call__(self):
+        return registry.client(self.database)
+
+    def __eq__(self, other):
+        return isinstance(other, RegistryClientFactory) and other.database == self.database
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.database)
+
+
+# Clients referenced by a LiveClientFactory, by id()
+_live_clients = weakref.WeakValueDictionary()
+
+
+class LiveClientFactory(object):
+    """
+      Picklable reference to an existing MongoClient, without its credentials: the process that created it
+      gets that client back, other processes get the registry client of the database.
+    """
+
+    def __init__(self, client, database):
+        self.pid = os.getpid()
+        self.client_id = id(client)
+        self.database = database
+        _live_clients[self.client_id] = client
+
+    def __call__(self):
+        client = _live_clients.get(self.client_id) if self.pid == os.getpid() else None
+        if client is None:
+            client = registry.client(self.database)
+        return client
+
+    def _key(self):
+        return (self.pid, self.client_id, self.database)
+
+    def __eq__(self, other):
+        return isinstance(other, LiveClientFactory) and other._key() == self._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+def reference_client_factory(mongokat_collection):
+    """ Returns a credential-free client factory for a Collection, as pickled with its Documents """
+    if mongokat_collection.is_lazy:
+        return RegistryClientFactory(mongokat_collection.__database__)
+    return LiveClientFactory(mongokat_collection.client, mongokat_collection.database.name)
+
+
+class LazyHandle(object):
+    """
+      Collection.client, .database and .collection of Collections built without arguments.
+      Handles passed to the constructor are instance attributes, which take precedence.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, mongokat_collection, cls):
+        if mongokat_collection is None:
+            return self
+
+        handles = mongokat_collection.__dict__.get("_lazy_handles")
+        pid = os.getpid()
+        if handles is None or handles["pid"] != pid:
+            client = registry.client(cls.__database__)
+            database = client[cls.__database__]
+            handles = mongokat_collection._lazy_handles = {
+                "pid": pid,
+                "client": client,
+                "database": database,
+                "collection": database[cls.__collection__]
+            }
+        return handles[self.name]
@@ -100,3 +100,120 @@ class dotdict(dict):
 
   def __deepcopy__(self, memo):
     return copy.deepcopy(dict(self))
+
+
+_MISSING = object()
+
+
+class Path(object):
+  """
+  A dotted field name, parsed once. Instances are interned: Path("a.b") is Path("a.b")
+  Works directly on plain dicts and Documents, without copying them.
+
+  >>> doc = {'bigBang': {'stars': {}}}
+  >>> Path('bigBang.stars.planets').set(doc, 8)
+  >>> Path('bigBang.stars.planets').get(doc)
+  8
+  >>> Path('bigBang.galaxies').get(doc, None) is None
+  True
+  >>> Path('bigBang.stars.planets').contains(doc)
+  True
+  """
+
+  __slots__ = ("key", "parts", "parents", "last")
+
+  _cache = {}
+  _max_cached = 10000
+
+  def __new__(cls, key):
+    path = cls._cache.get(key)
+    if path is not None:
+      return path
+
+    path = object.__new__(cls)
+    path.key = key
+    path.parts = tuple(key.split("."))
+    path.parents = path.parts[:-1]
+    path.last = path.parts[-1]
+
+    if len(cls._cache) >= cls._max_cached:
+      cls._cache.clear()
+    return cls._cache.setdefault(key, path)
+
+  def __repr__(self):
+    return "Path(%r)" % self.key
+
+  def get(self, doc, default=_MISSING):
+    """ Returns the value at this path, or default. Raises KeyError if there is no default """
+    for part in self.parts:
+      if isinstance(doc, dict) and part in doc:
+        doc = doc[part]
+      elif default is _MISSING:
+        raise KeyError(self.key)
+      else:
+        return default
+    return doc
+
+  def contains(self, doc):
+    for part in self.parts:
+      if not isinstance(doc, dict) or part not in doc:
+        return False
+      doc = doc[part]
+    return True
+
+  def _parent(self, doc, create):
+    for part in self.parents:
+      if part in doc:
+        child = doc[part]
+      elif create:
+        child = doc[part] = {}
+      else:
+        raise KeyError(self.key)
+      if not isinstance(child, dict):
+        raise KeyError('cannot access "%s" in "%s" (%s)' % (self.key, part, repr(child)))
+      doc = child
+    return doc
+
+  def set(self, doc, value):
+    """ Sets the value at this path, creating intermediate dicts when missing """
+    self._parent(doc, True)[self.last] = value
+
+  def delete(self, doc):
+    del self._parent(doc, False)[self.last]
+
+
+class dotview(object):
+  """
+  A dotted-key view of a dict, without copying it like dotdict does.
+
+  >>> doc = {'bigBang': {}}
+  >>> dotview(doc)['bigBang.stars'] = 1
+  >>> doc
+  {'bigBang': {'stars': 1}}
+  """
+
+  __slots__ = ("data", )
+
+  def __init__(self, data):
+    self.data = data
+
+  def __getitem__(self, key):
+    return Path(key).get(self.data)
+
+  def __setitem__(self, key, value):
+    Path(key).set(self.data, value)
+
+  def __delitem__(self, key):
+    Path(key).delete(self.data)
+
+  def __contains__(self, key):
+    return Path(key).contains(self.data)
+
+  def get(self, key, default=None):
+    return Path(key).get(self.data, default)
+
+  def setdefault(self, key, default):
+    path = Path(key)
+    if not path.contains(self.data):
+      path.set(self.data, default)
+    return path.get(self.data)
@@ -0,0 +1,251 @@
+"""
+Write-behind buffer coalescing frequent small updates, see Collection.write_buffer()
+"""
+import threading
+from collections import OrderedDict
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from .exceptions import ImmutableDocumentError
+
+SUPPORTED_OPERATORS = ("$set", "$unset", "$inc", "$max")
+
+
+def _overlaps(a, b):
+    """ Are these two distinct dotted paths a prefix of one another? """
+    return a != b and (a.startswith(b + ".") or b.startswith(a + "."))
+
+
+def merge_update(pending, update):
+    """
+      Merges update into the pending update of the same document, in place.
+      Returns False when they can't be expressed as a single update, leaving pending untouched.
+    """
+
+    merged = {op: dict(fields) for op, fields in pending.items()}
+    for op in SUPPORTED_OPERATORS:
+        merged.setdefault(op, {})
+    _set, _unset, _inc, _max = merged["$set"], merged["$unset"], merged["$inc"], merged["$max"]
+
+    for op, fields in update.items():
+        if op not in SUPPORTED_OPERATORS:
+            raise ValueError("Unsupported operator in a write buffer: %s" % op)
+
+        for field, value in fields.items():
+
+            if any(_overlaps(field, other) for values in merged.values() for other in values):
+                return False
+
+            if op == "$set":
+                for other in (_unset, _inc, _max):
+                    other.pop(field, None)
+                _set[field] = value
+
+            elif op == "$unset":
+                for other in (_set, _inc, _max):
+                    other.pop(field, None)
+                _unset[field] = ""
+
+            elif op == "$inc":
+                if field in _set:
+                    _set[field] = _set[field] + value
+                elif field in _unset:
+                    del _unset[field]
+                    _set[field] = value
+                elif field in _max:
+                    return False
+                else:
+                    _inc[field] = _inc.get(field, 0) + value
+
+            elif op == "$max":
+                if field in _set:
+                    _set[field] = max(_set[field], value)
+                elif field in _unset:
+                    del _unset[field]
+                    _set[field] = value
+                elif field in _inc:
+                    return False
+                else:
+                    _max[field] = max(_max[field], value) if field in _max else value
+
+    pending.clear()
+    pending.update({op: fields for op, fields in merged.items() if fields})
+    return True
+
+
+class WriteBuffer(object):
+    """
+      Buffers $set/$unset/$inc/$max updates by _id, merging the ones targeting the same document,
+      and writes them with one unordered bulk_write every flush_interval seconds, or as soon as max_ops
+      updates were buffered.
+
+      Only after_save hooks are supported: they are called once per flushed document, with the merged update.
+      Updates that failed to be written stay buffered, before the ones made since, and are retried by the
+      next flush. Errors during background flushes are kept in last_error.
+    """
+
+    def __init__(self, mongokat_collection, flush_interval=1.0, max_ops=1000):
+
+        if mongokat_collection.immutable:
+            raise ImmutableDocumentError()
+
+        self.mongokat_collection = mongokat_collection
+        self.flush_interval = flush_interval
+        self.max_ops = max_ops
+        self.last_error = None
+        self.flushed_ops = 0
+        self.buffered_ops = 0
+
+        self._pending = OrderedDict()
+        self._retry = OrderedDict()
+        self._ops = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+
+        if flush_interval:
+            self._thread = threading.Thread(target=self._run, name="mongokat-write-buffer")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:  # pylint: disable=broad-except
+                self.last_error = e
+
+    def update_one(self, filter, update, allow_protected_fields=False):
+        """ Buffers an update. filter must be an _id or {"_id": _id} """
+
+        if self._closed.is_set():
+            raise Exception("This write buffer is closed")
+
+        if isinstance(filter, dict):
+            if list(filter) != ["_id"]:
+                raise ValueError("A write buffer filter must be an _id or {\"_id\": _id}, not %s" % filter)
+            _id = filter["_id"]
+        else:
+            _id = filter
+
+        try:
+            hash(_id)
+        except TypeError:
+            raise ValueError("Can't buffer updates of an unhashable _id: %r" % (_id, ))
+
+        if "$set" in update and not allow_protected_fields:
+            self.mongokat_collection._check_protected_fields(update["$set"])
+
+        with self._lock:
+            merged = merge_update(self._pending.setdefault(_id, {}), update)
+            if merged:
+                self._ops += 1
+                self.buffered_ops += 1
+                if self._ops >= self.max_ops:
+                    merged = None
+
+        if merged is None:
+            self.flush()
+        elif not merged:
+            # Conflicting with the pending update: write it first.
+            self.flush()
+            with self._lock:
+                if not merge_update(self._pending.setdefault(_id, {}), update):
+                    raise ValueError("Update can't be merged: %s" % update)
+                self._ops += 1
+                self.buffered_ops += 1
+
+    def save_partial(self, document, data, allow_protected_fields=False):
+        """ Buffered equivalent of Document.save_partial(data) """
+        self.update_one({"_id": document["_id"]}, {"$set": data}, allow_protected_fields=allow_protected_fields)
+        for k, v in data.items():
+            document[k] = v
+
+    def flush(self):
+        """ Writes all the buffered updates synchronously """
+
+        with self._flush_lock:
+
+            # Failed updates that couldn't be merged with the newer ones are written first
+            with self._lock:
+                retry, self._retry = self._retry, OrderedDict()
+            if retry:
+                written, failed, error = self._write(retry)
+                self._written(written)
+                if error is not None:
+                    with self._lock:
+                        self._retry = failed
+                    raise error
+
+            with self._lock:
+                pending = OrderedDict((_id, update) for _id, update in self._pending.items() if update)
+                self._pending = OrderedDict()
+                self._ops = 0
+
+            if not pending:
+                return
+
+            written, failed, error = self._write(pending)
+            if failed:
+                self._requeue(failed)
+            self._written(written)
+            if error is not None:
+                raise error
+
+    def _write(self, updates):
+        """ Writes updates with one bulk_write, returns (written updates, failed updates, error) """
+
+        mongokat_collection = self.mongokat_collection
+        try:
+            mongokat_collection.bulk_write([
+                UpdateOne({"_id": _id}, mongokat_collection._encode_update(update))
+                for _id, update in updates.items()
+            ], ordered=False)
+        except BulkWriteError as e:
+            indexes = set(error["index"] for error in e.details.get("writeErrors", []))
+            written = OrderedDict()
+            failed = OrderedDict()
+            for i, (_id, update) in enumerate(updates.items()):
+                (failed if i in indexes else written)[_id] = update
+            return written, failed, e
+        except Exception as e:  # pylint: disable=broad-except
+            return OrderedDict(), updates, e
+        return updates, OrderedDict(), None
+
+    def _requeue(self, failed):
+        """ Buffers failed updates again, before the ones buffered during the write """
+
+        with self._lock:
+            newer = self._pending
+            pending = OrderedDict()
+            for _id, update in failed.items():
+                newer_update = newer.pop(_id, None)
+                if newer_update is None or merge_update(update, newer_update):
+                    pending[_id] = update
+                else:
+                    self._retry[_id] = update
+                    pending[_id] = newer_update
+            pending.update(newer)
+            self._pending = pending
+            self._ops += len(failed)
+
+    def _written(self, written):
+        self.flushed_ops += len(written)
+
+        mongokat_collection = self.mongokat_collection
+        if written and mongokat_collection.has_trigger("after_save"):
+            for doc in mongokat_collection.find({"_id": {"$in": list(written)}}, read_use="primary"):
+                doc.after_save(update=written[doc["_id"]], replacements=None)
+
+    def close(self):
+        """ Stops the background thread and flushes the remaining updates """
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
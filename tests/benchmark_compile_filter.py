@@ -0,0 +1,52 @@
+"""
+Compares compile_filter() to the matches() interpreter. Doesn't need MongoDB.
+
+    python -m tests.benchmark_compile_filter
+"""
+from __future__ import print_function
+import datetime
+import random
+import timeit
+from mongokat.query import matches, compile_filter
+
+QUERIES = {
+    "equality": {"name": "name42"},
+    "range": {"n": {"$gte": 100, "$lt": 200}},
+    "in": {"tags": {"$in": ["t1", "t7", "t9"]}},
+    "dotted": {"sub.items.y": {"$gt": 8}},
+    "elemMatch": {"sub.items": {"$elemMatch": {"y": {"$gt": 8}, "z": "a"}}},
+    "mixed": {"$or": [{"n": {"$lt": 10}}, {"flag": True, "date": {"$exists": True}}], "missing": None}
+}
+
+
+def make_documents(count, seed=0):
+    rand = random.Random(seed)
+    return [{
+        "_id": i,
+        "name": "name%s" % rand.randint(0, 100),
+        "n": rand.randint(0, 1000),
+        "flag": rand.random() < 0.5,
+        "tags": ["t%s" % rand.randint(0, 10) for _ in range(3)],
+        "sub": {"items": [{"y": rand.randint(0, 10), "z": rand.choice("ab")} for _ in range(3)]},
+        "date": datetime.datetime(2020, 1, 1)
+    } for i in range(count)]
+
+
+def main(count=10000, repeat=5):
+
+    docs = make_documents(count)
+
+    print("%-10s %12s %12s %8s" % ("query", "matches", "compiled", "speedup"))
+    for name, query in sorted(QUERIES.items()):
+
+        predicate = compile_filter(query)
+        assert [matches(doc, query) for doc in docs] == [predicate(doc) for doc in docs]
+
+        interpreted = min(timeit.repeat(lambda: [matches(doc, query) for doc in docs], number=1, repeat=repeat))
+        compiled = min(timeit.repeat(lambda: [predicate(doc) for doc in docs], number=1, repeat=repeat))
+
+        print("%-10s %10.1fms %10.1fms %7.1fx" % (name, interpreted * 1000, compiled * 1000, interpreted / compiled))
+
+
+if __name__ == "__main__":
+    main()
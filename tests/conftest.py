@@ -16,6 +16,22 @@ def db(request):
     return MongoClient("mongodb://127.0.0.1:27017").test
 
 
+@pytest.fixture(scope="function")
+def offline_db(request):
+    # Collection handles don't need a server until a query is run
+    return MongoClient("mongodb://127.0.0.1:27017", connect=False).test
+
+
+@pytest.fixture(scope="function")
+def offline_sample(request, offline_db):
+    return sample_models.SampleCollection(collection=offline_db.sample)
+
+
+@pytest.fixture(scope="function")
+def offline_hooks(request, offline_db):
+    return sample_models.WithHooksCollection(collection=offline_db.sample)
+
+
 @pytest.fixture(scope="function")
 def Sample(request, db):
     db.sample.drop()
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+from mongokat import Document
+
+
+class FakePymongoCollection(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def distinct(self, key):
+        return [doc[key] for doc in self.docs.values()]
+
+
+class FakeCollection(object):
+    """
+      Stands for a Collection in tests that don't need a server. Documents are kept by _id, and queries are
+      recorded as (sorted _ids for _id:$in queries, else the filter, projection).
+    """
+
+    structure = None
+    compressed_fields = None
+
+    def __init__(self, docs, document_class=Document):
+        self.docs = OrderedDict((doc["_id"], doc) for doc in docs)
+        self.document_class = document_class
+        self.collection = FakePymongoCollection(self.docs)
+        self.queries = []
+
+    def find(self, query, projection=None, **kwargs):
+        ids = query["_id"].get("$in") if isinstance(query.get("_id"), dict) else None
+        if ids is None:
+            self.queries.append((query, projection))
+            return [dict(doc) for doc in self.docs.values()]
+        self.queries.append((sorted(ids), projection))
+        return [dict(self.docs[_id]) for _id in ids if _id in self.docs]
+
+    def find_by_ids(self, ids, **kwargs):
+        self.queries.append((sorted(ids), None))
+        return [self.document_class(self.docs[_id], mongokat_collection=self) for _id in ids if _id in self.docs]
@@ -0,0 +1,40 @@
+from mongokat.cursor import AdaptiveBatchSize
+
+
+def test_adaptive_batch_size_bytes():
+
+    adaptive = AdaptiveBatchSize(target_bytes=100000, initial=100, max_size=10000)
+
+    # Small documents: grows, but at most x2 per batch
+    adaptive.fetched(100, 100 * 10, 0)
+    assert adaptive.size == 200
+    adaptive.fetched(200, 200 * 10, 0)
+    assert adaptive.size == 400
+
+    # Wide documents: shrinks right away
+    adaptive = AdaptiveBatchSize(target_bytes=100000, initial=100)
+    adaptive.fetched(100, 100 * 10000, 0)
+    assert adaptive.size == 10
+
+
+def test_adaptive_batch_size_throughput():
+
+    adaptive = AdaptiveBatchSize(target_seconds=1.0, initial=100, max_size=10000)
+
+    # Consumer processes 50 documents per second
+    adaptive.fetched(100, 1000, 0)
+    adaptive.consumed(2)
+    adaptive.fetched(100, 1000, 2)
+    assert adaptive.size == 50
+
+
+def test_find_batch_size_auto(Sample):
+
+    Sample.insert_many([{"a": i} for i in range(2000)])
+
+    cursor = Sample.find({}, sort=[("a", 1)], batch_size="auto")
+    docs = list(cursor)
+    assert [doc["a"] for doc in docs] == list(range(2000))
+    assert cursor._adaptive_batch_size.size > 100
+
+    assert Sample.list_column({}, "a", batch_size="auto", sort=[("a", 1)]) == list(range(2000))
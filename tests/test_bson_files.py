@@ -0,0 +1,99 @@
+import os
+import pytest
+from bson import BSON
+from bson.errors import InvalidBSON
+from mongokat import Collection
+from mongokat.bson_files import iter_chunks, count_documents
+from . import sample_models
+
+
+def write_bson_file(path, docs):
+    with open(str(path), "wb") as f:
+        for doc in docs:
+            f.write(BSON.encode(doc))
+    return str(path)
+
+
+def test_iter_chunks():
+
+    data = b"".join(BSON.encode({"i": i}) for i in range(10))
+    chunks = list(iter_chunks(data, chunk_size=30))
+
+    # Chunks only contain whole documents
+    assert b"".join(chunks) == data
+    assert len(chunks) > 1
+    assert sum(count_documents(chunk) for chunk in chunks) == 10
+
+    with pytest.raises(InvalidBSON):
+        list(iter_chunks(data[:-3]))
+
+
+def test_iter_bson_file(offline_sample, tmpdir):
+
+    path = write_bson_file(tmpdir.join("sample.bson"), [{"_id": i, "name": "n%s" % i, "sub": {"a": i}} for i in range(100)])
+
+    docs = list(offline_sample.iter_bson_file(path))
+    assert len(docs) == 100
+    assert isinstance(docs[0], sample_models.SampleDocument)
+    assert docs[0].my_method() == 1
+    assert docs[42] == {"_id": 42, "name": "n42", "sub": {"a": 42}}
+
+    docs = list(offline_sample.iter_bson_file(path, fields=["sub.a"], filter={"sub.a": {"$gte": 98}}))
+    assert docs == [{"sub": {"a": 98}}, {"sub": {"a": 99}}]
+    assert docs[0]._fetched_fields == ("sub.a", )
+
+    empty = write_bson_file(tmpdir.join("empty.bson"), [])
+    assert list(offline_sample.iter_bson_file(empty)) == []
+
+
+class FakeRawCollection(object):
+
+    def __init__(self, batches, error=None):
+        self.batches = batches
+        self.error = error
+        self.calls = []
+
+    def find_raw_batches(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+        for batch in self.batches:
+            yield batch
+        if self.error:
+            raise self.error
+
+
+class ShortNamesCollection(Collection):
+    short_names = {"description": "d"}
+
+
+def test_dump_bson_file_offline(offline_db, tmpdir):
+
+    SN = ShortNamesCollection(collection=offline_db.short_names)
+    path = str(tmpdir.join("dump.bson"))
+    batch = BSON.encode({"_id": 1, "d": "x"}) + BSON.encode({"_id": 2, "d": "y"})
+
+    # The filter, projection and sort are sent with short field names
+    SN.collection = FakeRawCollection([batch])
+    assert SN.dump_bson_file({"description": "x"}, path, fields=["description"], sort=[("description", 1)]) == 2
+    assert SN.collection.calls == [(({"d": "x"}, ), {"projection": {"d": True, "_id": False}, "sort": [("d", 1)]})]
+    assert [doc["description"] for doc in SN.iter_bson_file(path)] == ["x", "y"]
+
+    # A failed dump leaves the previous file and no temporary file
+    SN.collection = FakeRawCollection([batch], error=ValueError())
+    with pytest.raises(ValueError):
+        SN.dump_bson_file({}, path)
+    assert os.listdir(str(tmpdir)) == ["dump.bson"]
+    assert len(list(SN.iter_bson_file(path))) == 2
+
+
+def test_dump_bson_file(Sample, tmpdir):
+
+    Sample.insert_many([{"_id": i, "name": "n%s" % i} for i in range(10)])
+
+    path = str(tmpdir.join("dump.bson"))
+    assert Sample.dump_bson_file({"_id": {"$lt": 5}}, path) == 5
+
+    docs = list(Sample.iter_bson_file(path))
+    assert sorted(doc["_id"] for doc in docs) == list(range(5))
+
+    assert Sample.dump_bson_file({}, path, fields=["name"]) == 10
+    assert sorted(doc["name"] for doc in Sample.iter_bson_file(path))[0] == "n0"
@@ -0,0 +1,159 @@
+import itertools
+import threading
+import time
+import pytest
+from pymongo.errors import PyMongoError
+from mongokat import Collection
+from mongokat.compression import compress_value
+from mongokat.change_streams import ChangeStreamDispatcher, MemoryCheckpointStore, update_from_description
+from . import sample_models
+from .test_hooks import assert_hooks
+
+
+@pytest.fixture(scope="function")
+def replica_set_db(db):
+    try:
+        if not db.client.admin.command("ismaster").get("setName"):
+            pytest.skip("Change streams need a replica set")
+    except PyMongoError:
+        pytest.skip("No MongoDB server available")
+    return db
+
+
+def change(i, operation, _id, full_document=None, description=None):
+    ret = {"_id": {"_data": "token%s" % i}, "operationType": operation, "documentKey": {"_id": _id}}
+    if full_document is not None:
+        ret["fullDocument"] = full_document
+    if description is not None:
+        ret["updateDescription"] = description
+    return ret
+
+
+def test_update_from_description():
+    assert update_from_description({"updatedFields": {"a": 1}, "removedFields": ["b"]}) == \
+        {"$set": {"a": 1}, "$unset": {"b": ""}}
+    assert update_from_description({"updatedFields": {}, "removedFields": []}) == {}
+
+
+class ShortCompressedCollection(Collection):
+    short_names = {"description": "d"}
+    compressed_fields = {"html": "zlib"}
+
+
+def test_update_from_description_encoded(offline_db):
+
+    collection = ShortCompressedCollection(collection=offline_db.short_compressed)
+    description = {"updatedFields": {"d": "x", "html": compress_value("y" * 100), "d.sub": 1}, "removedFields": ["d"]}
+
+    # Like the updates of inline hooks: long names, uncompressed values
+    assert update_from_description(description, collection) == {
+        "$set": {"description": "x", "html": "y" * 100, "description.sub": 1},
+        "$unset": {"description": ""}
+    }
+
+
+def test_dispatch(offline_hooks):
+
+    sample_models.GLOBAL_HOOK_HISTORY = []
+    store = MemoryCheckpointStore()
+    dispatcher = ChangeStreamDispatcher(offline_hooks, name="test", checkpoint_store=store, coalesce=False)
+
+    dispatcher.dispatch([
+        change(1, "insert", 1, {"_id": 1, "a": 1}),
+        change(2, "update", 1, {"_id": 1, "a": 2}, {"updatedFields": {"a": 2}, "removedFields": []}),
+        change(3, "update", 2, None, {"updatedFields": {"a": 3}, "removedFields": []}),
+        change(4, "delete", 1)
+    ])
+
+    # The deleted document only has an _id
+    assert sample_models.GLOBAL_HOOK_HISTORY[:2] == [["after_save", 1], ["after_save", 2]]
+    assert len(sample_models.GLOBAL_HOOK_HISTORY) == 2
+    assert dispatcher.errors == 1
+    assert isinstance(dispatcher.last_error, KeyError)
+    sample_models.GLOBAL_HOOK_HISTORY = []
+
+    assert store.load("test") == {"_data": "token4"}
+    assert dispatcher.changes == 4
+    assert dispatcher.batches == 1
+
+
+def test_dispatch_coalesce(offline_hooks):
+
+    sample_models.GLOBAL_HOOK_HISTORY = []
+    dispatcher = ChangeStreamDispatcher(offline_hooks, name="test")
+
+    dispatcher.dispatch([
+        change(1, "insert", 1, {"_id": 1, "a": 1}),
+        change(2, "insert", 2, {"_id": 2, "a": 10}),
+        change(3, "replace", 1, {"_id": 1, "a": 3})
+    ])
+
+    assert_hooks([["after_save", 10], ["after_save", 3]])
+    assert dispatcher.checkpoint_store.load("test") == {"_data": "token3"}
+
+
+def test_dispatch_stream(offline_hooks):
+
+    sample_models.GLOBAL_HOOK_HISTORY = []
+    dispatcher = ChangeStreamDispatcher(offline_hooks, name="test", batch_size=2, flush_interval=10)
+
+    batches = []
+    dispatcher.dispatch = lambda changes: batches.append([c["_id"]["_data"] for c in changes])
+
+    stream = iter([change(i, "insert", i, {"_id": i, "a": i}) for i in range(5)])
+    dispatcher._dispatch_stream(stream)
+
+    # Batches are flushed when full, and at the end of the stream
+    assert batches == [["token0", "token1"], ["token2", "token3"], ["token4"]]
+
+
+def test_dispatch_stream_error(offline_hooks):
+
+    dispatcher = ChangeStreamDispatcher(offline_hooks, name="test", batch_size=2, flush_interval=10)
+
+    def dispatch(changes):
+        raise ValueError()
+    dispatcher.dispatch = dispatch
+
+    # The reader is stopped even though the stream never ends and the queue is full
+    stream = (change(i, "insert", i, {"_id": i, "a": i}) for i in itertools.count())
+    with pytest.raises(ValueError):
+        dispatcher._dispatch_stream(stream)
+
+    assert "mongokat-change-stream-reader" not in [thread.name for thread in threading.enumerate()]
+
+
+def test_change_stream_dispatcher(replica_set_db):
+
+    replica_set_db.sample.drop()
+    collection = sample_models.WithHooksCollection(collection=replica_set_db.sample)
+    collection.insert_one({"a": 0})
+    sample_models.GLOBAL_HOOK_HISTORY = []
+
+    store = MemoryCheckpointStore()
+    dispatcher = collection.change_stream_dispatcher(checkpoint_store=store, flush_interval=0.1)
+    dispatcher.start()
+    try:
+        # Let the stream open before writing
+        time.sleep(0.5)
+
+        # Inline hooks are disabled
+        collection.insert_one({"a": 1})
+        assert sample_models.GLOBAL_HOOK_HISTORY == []
+
+        # Writes made outside of MongoKat also run hooks
+        replica_set_db.sample.update_one({"a": 1}, {"$set": {"a": 2}})
+
+        for _ in range(50):
+            if dispatcher.changes >= 2:
+                break
+            time.sleep(0.1)
+    finally:
+        dispatcher.stop()
+
+    assert ["after_save", 2] in sample_models.GLOBAL_HOOK_HISTORY
+    assert store.load(dispatcher.name) is not None
+    sample_models.GLOBAL_HOOK_HISTORY = []
+
+    collection.insert_one({"a": 3})
+    assert_hooks([["after_save", 3]])
@@ -0,0 +1,97 @@
+import threading
+from bson import ObjectId
+from mongokat.coalescing import FindByIdCoalescer
+from .fakes import FakeCollection
+
+
+def test_coalescer():
+
+    fake = FakeCollection([{"_id": i, "a": i * 10} for i in range(10)])
+    coalescer = FindByIdCoalescer(fake, window=0.2, max_ids=100)
+
+    results = {}
+
+    def worker(i):
+        results[i] = coalescer.find_by_id(i)
+
+    threads = [threading.Thread(target=worker, args=(i, )) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(fake.queries) == 1
+    assert fake.queries[0][0] == list(range(8))
+    assert all(results[i]["a"] == i * 10 for i in range(8))
+
+    assert coalescer.find_by_id(42) is None
+    assert coalescer.find_by_ids([3, 42, 1]) == [{"_id": 3, "a": 30}, {"_id": 1, "a": 10}]
+
+    # _id is fetched to dispatch the results, then removed
+    doc = coalescer.find_by_id(2, projection={"a": True, "_id": False})
+    assert doc == {"a": 20}
+    assert fake.queries[-1][1] == {"a": True, "_id": True}
+
+
+def test_coalescer_copies():
+
+    fake = FakeCollection([{"_id": 1, "a": {"b": 1}}])
+    coalescer = FindByIdCoalescer(fake, window=0.2, max_ids=100)
+
+    results = []
+
+    def worker():
+        doc = coalescer.find_by_id(1)
+        results.append(doc)
+        doc["a"]["b"] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # The leader's caller doesn't share its Document with the others
+    assert len(fake.queries) == 1
+    assert len(set(id(doc) for doc in results)) == 4
+    assert [doc["a"]["b"] for doc in results] == [2] * 4
+
+    docs = coalescer.find_by_ids([1, 1])
+    assert docs[0] is not docs[1]
+
+
+def test_coalescer_max_ids():
+
+    fake = FakeCollection([{"_id": i} for i in range(10)])
+    coalescer = FindByIdCoalescer(fake, window=10, max_ids=3)
+
+    # Doesn't wait for the window when the batch is full
+    assert len(coalescer.find_by_ids([1, 2, 3])) == 3
+    assert len(fake.queries) == 1
+
+
+def test_collection_coalescing(Sample):
+
+    ids = Sample.insert_many([{"name": "a"}, {"name": "b"}]).inserted_ids
+
+    Sample.enable_coalescing(window=0.05)
+    try:
+        results = {}
+
+        def worker(i):
+            results[i] = Sample.find_by_id(ids[i % 2])
+
+        threads = [threading.Thread(target=worker, args=(i, )) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert Sample._coalescer.queries == 1
+        assert [results[i]["name"] for i in range(4)] == ["a", "b", "a", "b"]
+        assert results[0] is not results[2]
+        assert results[0].mongokat_collection is Sample
+
+        assert Sample.find_by_id(ObjectId()) is None
+    finally:
+        Sample.disable_coalescing()
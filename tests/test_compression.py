@@ -0,0 +1,80 @@
+from bson import Binary
+from mongokat import Collection, Document
+from mongokat.compression import compress_value, decompress_value, is_compressed, compress_update
+
+
+def test_compress_value():
+
+    for value in [u"héllo" * 100, b"abc" * 100, {"a": [1, 2]}, 5]:
+        compressed = compress_value(value)
+        assert is_compressed(compressed)
+        assert decompress_value(compressed) == value
+
+    assert compress_value("x" * 100, "bz2") != compress_value("x" * 100, "zlib")
+    assert decompress_value(compress_value("x" * 100, "bz2")) == "x" * 100
+
+    assert compress_value(None) is None
+
+    update = {"$set": {"a": 1}}
+    assert compress_update(update, {"html": "zlib"}) is update
+
+    update = compress_update({"$set": {"html": "x" * 100, "a": 1}, "$inc": {"b": 1}}, {"html": "zlib"})
+    assert is_compressed(update["$set"]["html"])
+    assert update["$set"]["a"] == 1
+
+
+class CompressedCollection(Collection):
+    compressed_fields = {"html": "zlib"}
+
+
+def test_compressed_document_class(offline_db):
+
+    C = CompressedCollection(collection=offline_db.test_compression)
+    compressed = compress_value("x" * 100)
+
+    doc = C({"html": compressed, "raw": compressed})
+    assert isinstance(doc, Document)
+    assert doc.__class__ is not Document
+    assert doc.__class__.__name__ == "Document"
+
+    # Only declared fields are decompressed
+    assert doc["html"] == "x" * 100
+    assert doc.get("raw") is compressed
+    assert doc["raw"] is compressed
+
+    # Documents of other collections keep the plain dict methods
+    assert Collection(collection=offline_db.other)({"raw": compressed}).__class__ is Document
+
+
+def test_compressed_fields(db):
+
+    db.test_compression.drop()
+    C = CompressedCollection(collection=db.test_compression)
+
+    html = "<html>" + "x" * 10000 + "</html>"
+
+    doc = C({"html": html, "name": "a"})
+    doc.save()
+    assert doc["html"] == html
+
+    raw = db.test_compression.find_one()
+    assert isinstance(raw["html"], Binary)
+    assert len(raw["html"]) < 1000
+
+    doc = C.find_one()
+    assert doc.get_compressed_size("html") == len(raw["html"])
+    assert isinstance(dict.__getitem__(doc, "html"), Binary)
+    assert doc["html"] == html
+    assert doc.get_compressed_size("html") == len(raw["html"])
+
+    doc.save_partial({"html": "<p>short</p>"})
+    assert isinstance(db.test_compression.find_one()["html"], Binary)
+    assert C.find_one().get("html") == "<p>short</p>"
+
+    C.update_one({"name": "a"}, {"$set": {"html": "<p>updated</p>"}})
+    assert C.find_one()["html"] == "<p>updated</p>"
+
+    C.insert_one({"html": html, "name": "b"})
+    C.replace_one({"name": "b"}, {"html": "<p>replaced</p>", "name": "b"})
+    assert C.find_one({"name": "b"})["html"] == "<p>replaced</p>"
+    assert isinstance(db.test_compression.find_one({"name": "b"})["html"], Binary)
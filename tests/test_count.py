@@ -0,0 +1,58 @@
+import time
+import pytest
+from mongokat.counts import CountCache
+
+
+def test_count_cache():
+
+    cache = CountCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get({"a": 1}, {}, 60, compute) == 1
+    assert cache.get({"a": 1}, {}, 60, compute) == 1
+    assert cache.get({"a": 2}, {}, 60, compute) == 2
+    assert cache.get({"a": 1}, {"read_use": "secondary"}, 60, compute) == 3
+
+    # Stale: the old value is returned while refreshing in the background
+    assert cache.get({"a": 1}, {}, 0, compute) == 1
+    for _ in range(100):
+        if len(calls) == 4:
+            break
+        time.sleep(0.01)
+    time.sleep(0.01)
+    assert cache.get({"a": 1}, {}, 60, compute) == 4
+
+
+def test_count_cache_max_entries():
+
+    cache = CountCache(max_entries=2)
+    cache.get({"a": 1}, {}, 60, lambda: 1)
+    cache.get({"a": 2}, {}, 60, lambda: 2)
+
+    # The least recently used query is evicted
+    assert cache.get({"a": 1}, {}, 60, lambda: 10) == 1
+    cache.get({"a": 3}, {}, 60, lambda: 3)
+    assert len(cache._counts) == 2
+    assert cache.get({"a": 2}, {}, 60, lambda: 20) == 20
+    assert cache.get({"a": 3}, {}, 60, lambda: 30) == 3
+
+
+def test_count_modes(Sample):
+
+    Sample.insert_many([{"a": i % 2} for i in range(10)])
+
+    assert Sample.count() == 10
+    assert Sample.count(mode="estimated") == 10
+    assert Sample.count({"a": 1}, mode="estimated") == 5
+
+    assert Sample.count({"a": 1}, mode="cached") == 5
+    Sample.insert_one({"a": 1})
+    assert Sample.count({"a": 1}, mode="cached") == 5
+    assert Sample.count({"a": 1}, mode="exact") == 6
+
+    with pytest.raises(ValueError):
+        Sample.count(mode="wrong")
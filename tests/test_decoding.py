@@ -0,0 +1,50 @@
+import bson
+import bson.codec_options
+import mongokat
+from mongokat._bson import _decode_all
+from mongokat.projections import AccessTracker
+from . import sample_models
+
+
+REPLY = bson.BSON.encode({"cursor": {"firstBatch": [{"a": 1, "b": [{"c": 1}]}], "id": 0}, "ok": 1})
+
+
+def test_plain_decoding_untouched():
+
+    # MongoKat doesn't replace bson internals, only dispatches decode_all
+    assert bson.codec_options.CodecOptions is not mongokat.CodecOptionsWithoutCheck
+    assert bson._elements_to_dict.__module__ == "bson"
+
+    reply = bson.decode_all(REPLY)[0]
+    assert reply == _decode_all(REPLY)[0]
+    assert type(reply["cursor"]["firstBatch"][0]) is dict
+
+
+def test_collection_decoding(offline_sample):
+
+    Sample = offline_sample
+    codec_options = Sample._collection_with_options({}).codec_options
+    reply = bson.decode_all(REPLY, codec_options)[0]
+
+    doc = reply["cursor"]["firstBatch"][0]
+    assert type(doc) is sample_models.SampleDocument
+    assert doc.mongokat_collection is Sample
+    assert doc == {"a": 1, "b": [{"c": 1}]}
+    assert type(doc["b"][0]) is dict
+
+
+def test_tracked_decoding(offline_sample):
+
+    tracker = AccessTracker("site")
+    codec_options = offline_sample._collection_with_options({"access_tracker": tracker}).codec_options
+    reply = bson.decode_all(REPLY, codec_options)[0]
+
+    # pymongo's reads of the command reply aren't learned as fields
+    assert "ok" in reply
+    assert reply.get("$clusterTime") is None
+    doc = reply["cursor"]["firstBatch"][0]
+    assert tracker.documents == 1
+    assert tracker.fields == set(["_id"])
+
+    assert doc["a"] == 1
+    assert tracker.fields == set(["_id", "a"])
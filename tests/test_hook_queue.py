@@ -0,0 +1,139 @@
+import threading
+import pytest
+from mongokat import Collection, Document, deferred
+from mongokat.hooks import HookQueue, hook_queue, is_deferred
+from mongokat.exceptions import HookQueueFullError
+from .fakes import FakeCollection
+
+DEFERRED_HISTORY = []
+
+
+class DeferredDocument(Document):
+
+    def before_save(self, **kwargs):
+        DEFERRED_HISTORY.append(["before_save", self["a"]])
+
+    @deferred
+    def after_save(self, update=None, **kwargs):
+        DEFERRED_HISTORY.append(["after_save", self["a"], threading.current_thread().name])
+
+    @deferred
+    def after_delete(self, **kwargs):
+        DEFERRED_HISTORY.append(["after_delete", self["a"], threading.current_thread().name])
+
+
+class DeferredCollection(Collection):
+    document_class = DeferredDocument
+
+
+def test_deferred_declaration():
+
+    assert is_deferred(DeferredDocument, "after_save")
+    assert not is_deferred(DeferredDocument, "before_save")
+    assert not is_deferred(Document, "after_save")
+
+    with pytest.raises(ValueError):
+        deferred(DeferredDocument.before_save)
+
+
+def test_hook_queue_batches():
+
+    del DEFERRED_HISTORY[:]
+    fake = FakeCollection([{"_id": i, "a": i} for i in range(10)], document_class=DeferredDocument)
+    queue = HookQueue()
+
+    # Not enabled: the caller runs the hooks
+    assert queue.put(fake, "after_save", ids=[1]) is False
+
+    # Queue calls before starting a worker, which then processes them in one batch
+    queue.enable(workers=0, batch_size=100)
+    for i in range(5):
+        assert queue.put(fake, "after_save", ids=[i, i + 1])
+    assert queue.put(fake, "after_delete", documents=[DeferredDocument({"a": 42}, mongokat_collection=fake)])
+
+    worker = threading.Thread(target=queue._run, name="mongokat-hooks-0")
+    worker.daemon = True
+    worker.start()
+    queue._threads.append(worker)
+    assert queue.drain(timeout=5)
+
+    # One query for all the queued after_save calls
+    assert fake.queries == [(list(range(6)), None)]
+    assert sorted(h[1] for h in DEFERRED_HISTORY if h[0] == "after_save") == [0, 1, 1, 2, 2, 3, 3, 4, 4, 5]
+    assert ["after_delete", 42, "mongokat-hooks-0"] in DEFERRED_HISTORY
+
+    assert queue.stats()["enqueued"] == 6
+    assert queue.stats()["batches"] == 1
+    assert queue.depth() == 0
+    assert queue.shutdown()
+    assert not queue.enabled
+
+
+def test_hook_queue_full():
+
+    fake = FakeCollection([])
+    errors = []
+    queue = HookQueue()
+    queue.enable(workers=0, max_size=1, when_full="raise", on_error=lambda e, c, event: errors.append(e))
+
+    assert queue.put(fake, "after_save", ids=[1])
+    with pytest.raises(HookQueueFullError):
+        queue.put(fake, "after_save", ids=[2])
+
+    queue.when_full = "inline"
+    assert queue.put(fake, "after_save", ids=[2]) is False
+    assert queue.stats()["inline"] == 1
+
+    assert not queue.drain(timeout=0.01)
+    assert not queue.shutdown(timeout=0.01)
+
+
+def test_hook_queue_errors():
+
+    class Failing(Document):
+        @deferred
+        def after_save(self, **kwargs):
+            raise ValueError(self["_id"])
+
+    fake = FakeCollection([{"_id": 1}, {"_id": 2}])
+    fake.find_by_ids = lambda ids, **kwargs: [Failing(fake.docs[_id], mongokat_collection=fake) for _id in ids]
+
+    errors = []
+    queue = HookQueue()
+    queue.enable(workers=1, on_error=lambda e, c, event: errors.append(e.args[0]))
+    queue.put(fake, "after_save", ids=[1, 2])
+    assert queue.shutdown(timeout=5)
+
+    # Each failing hook is reported, the others still run
+    assert sorted(errors) == [1, 2]
+    assert queue.errors == 2
+
+
+def test_collection_deferred_hooks(db):
+
+    db.test_deferred_hooks.drop()
+    collection = DeferredCollection(collection=db.test_deferred_hooks)
+    del DEFERRED_HISTORY[:]
+
+    hook_queue.enable(workers=2)
+    try:
+        collection.insert_one({"a": 1})
+        doc = collection.find_one()
+        doc["a"] = 2
+        doc.save()
+        assert hook_queue.drain(timeout=5)
+
+        assert DEFERRED_HISTORY[0][:2] == ["after_save", 1]
+        assert ["before_save", 1] in DEFERRED_HISTORY
+        assert DEFERRED_HISTORY[-1][:2] == ["after_save", 2]
+        assert DEFERRED_HISTORY[-1][2].startswith("mongokat-hooks")
+
+        collection.delete_one({"_id": doc["_id"]})
+        assert hook_queue.drain(timeout=5)
+        assert DEFERRED_HISTORY[-1][:2] == ["after_delete", 2]
+    finally:
+        hook_queue.shutdown()
+
+    # Back to inline hooks
+    collection.insert_one({"a": 3})
+    assert DEFERRED_HISTORY[-1] == ["after_save", 3, threading.current_thread().name]
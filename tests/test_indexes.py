@@ -0,0 +1,86 @@
+from mongokat import Collection
+from mongokat.indexes import index_advisor, query_shape, is_supported, normalize_index_fields
+
+
+class IndexedCollection(Collection):
+    __indexes__ = [
+        {"fields": [("url", 1)], "unique": True},
+        {"fields": ["store", "date"]},
+        {"fields": "name", "sparse": True}
+    ]
+
+
+def test_normalize_index_fields():
+    assert normalize_index_fields("a") == [("a", 1)]
+    assert normalize_index_fields(["a", "b"]) == [("a", 1), ("b", 1)]
+    assert normalize_index_fields([("a", -1), "b"]) == [("a", -1), ("b", 1)]
+
+
+def test_is_supported():
+
+    indexes = [[("store", 1), ("date", 1)], [("_id", 1)]]
+
+    assert is_supported(query_shape({"store": 1, "x": 2}), [], indexes)
+    assert is_supported(query_shape({"store": {"$in": [1, 2]}}), [], indexes)
+    assert is_supported(query_shape({"$and": [{"store": 1}, {"x": 2}]}), [], indexes)
+    assert not is_supported(query_shape({"date": {"$gt": 1}}), [], indexes)
+    assert is_supported(query_shape({}), ["store"], indexes)
+    assert not is_supported(query_shape({}), ["date"], indexes)
+    assert is_supported(query_shape({}), [], indexes)
+    assert is_supported(query_shape({"$or": [{"store": 1}, {"_id": 2}]}), [], indexes)
+    assert not is_supported(query_shape({"$or": [{"store": 1}, {"x": 2}]}), [], indexes)
+
+
+def test_ensure_indexes(db):
+
+    db.test_indexes.drop()
+    C = IndexedCollection(collection=db.test_indexes)
+    db.test_indexes.create_index("other")
+
+    report = C.ensure_indexes(dry_run=True)
+    assert len(report["create"]) == 3
+    assert [x["name"] for x in report["undeclared"]] == ["other_1"]
+    assert len(db.test_indexes.index_information()) == 2
+
+    report = C.ensure_indexes()
+    assert len(report["create"]) == 3
+    assert len(db.test_indexes.index_information()) == 5
+    assert db.test_indexes.index_information()["url_1"]["unique"] is True
+
+    report = C.ensure_indexes()
+    assert report["create"] == []
+    assert len(report["exists"]) == 3
+
+    db.test_indexes.drop_index("name_1")
+    db.test_indexes.create_index("name")
+    report = C.ensure_indexes()
+    assert report["conflicts"] == [{"fields": [("name", 1)], "name": "name_1", "options": {"sparse": True}}]
+
+
+def test_index_advisor(db):
+
+    C = IndexedCollection(collection=db.test_indexes)
+
+    index_advisor.reset()
+    index_advisor.enable()
+    try:
+        C.find_one({"url": "x"})
+        C.find_one({"url": "y"})
+        list(C.find({"date": {"$gt": 1}}, sort=[("store", 1)]))
+        list(C.find({"date": {"$gt": 1}}, fields=["url"]))
+        C.find_by_id("5c9a1bf2b7d2d7a2f3e0c0e1")
+    finally:
+        index_advisor.disable()
+
+    assert index_advisor.report() == [{
+        "collection": "IndexedCollection",
+        "equality": [],
+        "range": ["date"],
+        "or": 0,
+        "sort": [],
+        "projection": ["url"],
+        "count": 1,
+        "supported": False
+    }]
+
+    assert len(index_advisor.report(unsupported_only=False)) == 4
@@ -0,0 +1,83 @@
+import pytest
+from mongokat.metrics import metrics, Metrics, format_statsd, format_prometheus
+
+
+@pytest.fixture(scope="function")
+def enabled_metrics(request):
+    metrics.reset()
+    metrics.enable()
+
+    def fin():
+        metrics.disable()
+        metrics.reset()
+    request.addfinalizer(fin)
+    return metrics
+
+
+def test_metrics_disabled(Sample):
+
+    metrics.reset()
+    Sample.insert_one({"a": 1})
+    list(Sample.find())
+
+    assert metrics.snapshot() == {}
+
+
+def test_metrics_calls_and_documents(Sample, enabled_metrics):
+
+    Sample.insert_one({"a": 1})
+    Sample.insert_one({"a": 2})
+
+    assert len(list(Sample.find())) == 2
+    Sample.find_one({"a": 1})
+    Sample.update_one({"a": 1}, {"$set": {"b": 1}})
+
+    snapshot = metrics.snapshot()
+
+    assert snapshot[("SampleCollection", "insert_one")]["calls"] == 2
+    assert snapshot[("SampleCollection", "find")]["calls"] == 1
+    assert snapshot[("SampleCollection", "find")]["documents"] == 2
+    assert snapshot[("SampleCollection", "find")]["bytes"] > 0
+    assert snapshot[("SampleCollection", "find_one")]["documents"] == 1
+    assert snapshot[("SampleCollection", "update_one")]["calls"] == 1
+    assert sum(snapshot[("SampleCollection", "update_one")]["buckets"]) == 1
+
+
+def test_metrics_trigger_reads(WithHooks, enabled_metrics):
+
+    WithHooks.insert_one({"a": 1})
+
+    snapshot = metrics.snapshot()
+    assert snapshot[("WithHooksCollection", "insert_one")]["trigger_reads"] == 1
+
+
+def test_metrics_errors(Sample, enabled_metrics):
+
+    with pytest.raises(Exception):
+        Sample.update_one({"a": 1}, {"$inc": {"x": "not a number"}, "$set": {"x": 1}})
+
+    assert metrics.snapshot()[("SampleCollection", "update_one")]["errors"] == 1
+
+
+def test_metrics_exporters():
+
+    m = Metrics()
+    m._get(("C", "find")).observe(0.003)
+    m.record_decoded(("C", "find"), 10, 1000)
+
+    exported = []
+    m.add_exporter(exported.append)
+    snapshot = m.export()
+    assert exported == [snapshot]
+
+    statsd = format_statsd(snapshot).split("\n")
+    assert "mongokat.C.find.calls:1|c" in statsd
+    assert "mongokat.C.find.documents:10|c" in statsd
+    assert "mongokat.C.find.bytes:1000|c" in statsd
+
+    prom = format_prometheus(snapshot).split("\n")
+    assert 'mongokat_calls_total{collection="C",method="find"} 1' in prom
+    assert 'mongokat_duration_seconds_bucket{collection="C",method="find",le="0.0025"} 0' in prom
+    assert 'mongokat_duration_seconds_bucket{collection="C",method="find",le="0.005"} 1' in prom
+    assert 'mongokat_duration_seconds_bucket{collection="C",method="find",le="+Inf"} 1' in prom
+    assert 'mongokat_duration_seconds_count{collection="C",method="find"} 1' in prom
@@ -0,0 +1,78 @@
+import datetime
+from mongokat import Document
+from mongokat.mirror import Mirror
+from .fakes import FakeCollection
+
+
+def test_mirror_local_queries():
+
+    fake = FakeCollection([
+        {"_id": 1, "code": "EUR", "rate": 1.0, "tags": ["eu"]},
+        {"_id": 2, "code": "USD", "rate": 1.1, "tags": ["us", "fx"]},
+        {"_id": 3, "code": "GBP", "rate": 0.9, "tags": ["fx"]}
+    ])
+    mirror = Mirror(fake, refresh_interval=None, indexes=["code", "tags"]).start()
+
+    assert mirror.find_one({"code": "USD"})["rate"] == 1.1
+    assert mirror.find_one({"code": "XXX"}) is None
+    assert mirror.count({"tags": "fx"}) == 2
+    assert mirror.count({"rate": {"$gte": 1}}) == 2
+    assert sorted(mirror.distinct("tags")) == ["eu", "fx", "us"]
+
+    docs = list(mirror.find({"tags": {"$in": ["fx", "eu"]}}, sort=[("rate", -1)], limit=2, projection={"code": 1}))
+    assert docs == [{"_id": 2, "code": "USD"}, {"_id": 1, "code": "EUR"}]
+    assert isinstance(docs[0], Document)
+
+    # Returned documents are copies
+    docs[0]["code"] = "XXX"
+    assert mirror.find_one({"_id": 2})["code"] == "USD"
+
+    assert len(fake.queries) == 1
+
+
+def test_mirrored_collection_cursors(offline_sample):
+
+    fake = FakeCollection([{"_id": 1, "code": "EUR"}, {"_id": 2, "code": "USD"}])
+    offline_sample._mirror = Mirror(fake, refresh_interval=None).start()
+
+    # Methods calling next() on find() cursors
+    assert offline_sample.one({"code": "USD"})["_id"] == 2
+    assert offline_sample.one({"code": "XXX"}) is None
+    assert offline_sample.find_random()["code"] in ("EUR", "USD")
+
+    cursor = offline_sample.find({}, sort=[("_id", 1)])
+    assert next(cursor)["_id"] == 1
+    assert [doc["_id"] for doc in cursor] == [2]
+    assert offline_sample._mirror.server_queries == 0
+
+
+def test_collection_mirror(Sample):
+
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    Sample.insert_many([
+        {"code": "EUR", "n": 1, "updated": now},
+        {"code": "USD", "n": 2, "updated": now}
+    ])
+
+    mirror = Sample.mirror(refresh_interval=None, indexes=["code"], updated_field="updated")
+    try:
+        assert Sample.find_one({"code": "EUR"})["n"] == 1
+        assert Sample.count({"n": {"$gt": 0}}) == 2
+        assert Sample.distinct("code") == ["EUR", "USD"]
+        assert [d["code"] for d in Sample.find({}, sort=[("n", -1)])] == ["USD", "EUR"]
+        assert mirror.server_queries == 0
+
+        # Unsupported queries go to the server
+        assert Sample.find_one({"code": {"$regex": "^U"}})["n"] == 2
+        assert mirror.server_queries == 1
+
+        # Incremental refresh
+        Sample.update_one({"code": "EUR"}, {"$set": {"n": 10, "updated": now + datetime.timedelta(seconds=1)}})
+        Sample.delete_one({"code": "USD"})
+        assert Sample.find_one({"code": "EUR"})["n"] == 1
+
+        mirror.refresh()
+        assert Sample.find_one({"code": "EUR"})["n"] == 10
+        assert Sample.find_one({"code": "USD"}) is None
+    finally:
+        Sample.unmirror()
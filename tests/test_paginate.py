@@ -0,0 +1,55 @@
+import pytest
+from mongokat.collection import _keyset_query
+from mongokat.exceptions import InvalidPageTokenError
+
+
+def test_keyset_query():
+
+    assert _keyset_query([("a", 1), ("_id", 1)], [5, 10]) == {"$or": [
+        {"a": {"$gt": 5}},
+        {"a": 5, "_id": {"$gt": 10}}
+    ]}
+
+    assert _keyset_query([("a", -1), ("b", 1), ("_id", -1)], [5, 6, 10]) == {"$or": [
+        {"a": {"$lt": 5}},
+        {"a": 5, "b": {"$gt": 6}},
+        {"a": 5, "b": 6, "_id": {"$lt": 10}}
+    ]}
+
+
+def test_paginate(Sample):
+
+    Sample.insert_many([{"_id": i, "a": i % 10, "b": i} for i in range(95)])
+
+    expected = sorted(range(95), key=lambda i: (-(i % 10), i))
+
+    seen = []
+    token = None
+    pages = 0
+    while True:
+        docs, token = Sample.paginate({"b": {"$gte": 0}}, sort=[("a", -1), ("_id", 1)], page_size=10,
+                                      after=token, fields=["b"])
+        pages += 1
+        assert len(docs) <= 10
+        assert all(doc.my_method() == 1 for doc in docs)
+        seen += [doc["b"] for doc in docs]
+        if token is None:
+            break
+
+    assert pages == 10
+    assert seen == expected
+
+    with pytest.raises(InvalidPageTokenError):
+        Sample.paginate({}, sort=[("a", 1)], after="garbage")
+
+
+def test_paginate_default_sort(Sample):
+
+    Sample.insert_many([{"_id": i} for i in range(5)])
+
+    docs, token = Sample.paginate(page_size=3)
+    assert [doc["_id"] for doc in docs] == [0, 1, 2]
+
+    docs, token = Sample.paginate(page_size=3, after=token)
+    assert [doc["_id"] for doc in docs] == [3, 4]
+    assert token is None
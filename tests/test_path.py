@@ -0,0 +1,52 @@
+import pytest
+from mongokat.utils import Path, dotview
+
+
+def test_path():
+
+    assert Path("a.b") is Path("a.b")
+    assert Path("a.b").parts == ("a", "b")
+
+    doc = {"a": {"b": 1}, "c": [1, 2]}
+
+    assert Path("a.b").get(doc) == 1
+    assert Path("a").get(doc) == {"b": 1}
+    assert Path("a.x").get(doc, None) is None
+    assert Path("c.x").get(doc, 5) == 5
+
+    with pytest.raises(KeyError):
+        Path("a.x").get(doc)
+
+    assert Path("a.b").contains(doc)
+    assert not Path("a.b.c").contains(doc)
+    assert not Path("x").contains(doc)
+
+    Path("a.d.e").set(doc, 2)
+    assert doc["a"] == {"b": 1, "d": {"e": 2}}
+
+    with pytest.raises(KeyError):
+        Path("c.x").set(doc, 1)
+
+    Path("a.d.e").delete(doc)
+    assert doc["a"] == {"b": 1, "d": {}}
+
+    with pytest.raises(KeyError):
+        Path("a.x.y").delete(doc)
+
+
+def test_dotview():
+
+    doc = {"a": {"b": 1}}
+    view = dotview(doc)
+
+    assert view["a.b"] == 1
+    assert "a.b" in view
+    assert view.get("a.c") is None
+
+    view["a.c"] = 2
+    assert view.setdefault("a.c", 3) == 2
+    assert view.setdefault("a.e", 3) == 3
+    del view["a.b"]
+
+    # The original dict was modified in place
+    assert doc == {"a": {"c": 2, "e": 3}}
@@ -0,0 +1,75 @@
+import gc
+import weakref
+import pytest
+import mongokat.cursor
+from mongokat.cursor import PrefetchingCursor
+
+
+class FakeCursor(object):
+
+    def __init__(self, docs, error=None):
+        self.docs = docs
+        self.error = error
+        self.closed = False
+
+    def __iter__(self):
+        for doc in self.docs:
+            yield doc
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def test_prefetching_cursor():
+
+    cursor = FakeCursor(list(range(1000)))
+    with PrefetchingCursor(cursor, depth=2) as prefetching:
+        assert list(prefetching) == list(range(1000))
+    assert cursor.closed
+
+    with pytest.raises(ValueError):
+        list(PrefetchingCursor(FakeCursor([1, 2], error=ValueError())))
+
+
+def test_prefetching_cursor_lifecycle(monkeypatch):
+
+    # The thread only starts on the first next()
+    cursor = FakeCursor(list(range(10)))
+    prefetching = PrefetchingCursor(cursor)
+    assert prefetching._thread is None
+    prefetching.close()
+    assert cursor.closed
+
+    # An abandoned PrefetchingCursor stops its thread, which closes the cursor
+    monkeypatch.setattr(mongokat.cursor, "_buffered_count", lambda cursor: 0)
+    cursor = FakeCursor(list(range(1000)))
+    prefetching = PrefetchingCursor(cursor)
+    assert next(prefetching) == 0
+    thread = prefetching._thread
+    ref = weakref.ref(prefetching)
+    del prefetching
+    gc.collect()
+    assert ref() is None
+    thread.join(5)
+    assert not thread.is_alive()
+    assert cursor.closed
+
+
+def test_find_prefetch(Sample):
+
+    Sample.insert_many([{"a": i} for i in range(1000)])
+
+    docs = list(Sample.find({}, sort=[("a", 1)], batch_size=10, prefetch=True))
+    assert [doc["a"] for doc in docs] == list(range(1000))
+    assert docs[0].my_method() == 1
+
+    docs = list(Sample.aggregate([{"$sort": {"a": 1}}], batch_size=10, prefetch=3))
+    assert [doc["a"] for doc in docs] == list(range(1000))
+
+    assert list(Sample.iter_column({"a": {"$lt": 5}}, "a", sort=[("a", 1)], batch_size=2, prefetch=True)) == list(range(5))
+
+    cursor = Sample.find({}, batch_size=10, prefetch=True)
+    next(cursor)
+    cursor.close()
@@ -0,0 +1,94 @@
+import json
+import pytest
+from mongokat import Collection
+from mongokat.profiling import slow_queries, normalize_query_shape
+
+
+@pytest.fixture(scope="function")
+def enabled_slow_queries(request):
+    slow_queries.clear()
+    slow_queries.enable(threshold_ms=0, explain_sample_rate=1)
+
+    def fin():
+        slow_queries.disable()
+        slow_queries.clear()
+    request.addfinalizer(fin)
+    return slow_queries
+
+
+def test_normalize_query_shape():
+
+    assert normalize_query_shape({"a": 1, "b": {"$in": [1, 2, 3]}}) == {"a": 1, "b": {"$in": 1}}
+    assert normalize_query_shape({"$or": [{"a": "x"}, {"b": {"$gt": 5}}]}) == {"$or": [{"a": 1}, {"b": {"$gt": 1}}]}
+    assert normalize_query_shape([{"$match": {"a": "x"}}, {"$limit": 5}]) == [{"$match": {"a": 1}}, {"$limit": 1}]
+
+
+def test_slow_queries_find(Sample, enabled_slow_queries):
+
+    Sample.insert_one({"name": "XXX"})
+
+    cursor = Sample.find({"name": "XXX"})
+    assert len(slow_queries.entries) == 0
+
+    assert len(list(cursor)) == 1
+    Sample.find_one({"name": "YYY"})
+    Sample.count({"name": "XXX"})
+    list(Sample.aggregate([{"$match": {"name": "XXX"}}]))
+
+    entries = list(slow_queries.entries)
+    assert [e["method"] for e in entries] == ["find", "find_one", "count", "aggregate"]
+
+    assert entries[0]["collection"] == "SampleCollection"
+    assert entries[0]["shape"] == {"name": 1}
+    assert entries[0]["call_site"].startswith(__file__.replace(".pyc", ".py"))
+    assert entries[3]["shape"] == [{"$match": {"name": 1}}]
+
+    slow_queries.wait_for_explains()
+
+    assert entries[0]["explain"] is not None
+    assert entries[0]["collscan"] is True
+    assert entries[0]["n_returned"] == 1
+
+
+class ShortNamesCollection(Collection):
+    short_names = {"description": "d"}
+
+
+def test_slow_queries_short_names(db, enabled_slow_queries):
+
+    db.test_slow_queries.drop()
+    SN = ShortNamesCollection(collection=db.test_slow_queries)
+    SN.insert_one({"description": "x"})
+
+    # The filters actually sent are recorded, and explained
+    list(SN.find({"description": "x"}))
+    SN.find_one({"description": "x"}, sort=[("description", 1)])
+    SN.count({"description": "x"})
+
+    entries = list(slow_queries.entries)
+    assert [e["method"] for e in entries] == ["find", "find_one", "count"]
+    assert [e["shape"] for e in entries] == [{"d": 1}] * 3
+
+    slow_queries.wait_for_explains()
+    assert entries[1]["n_returned"] == 1
+
+
+def test_slow_queries_threshold(Sample, enabled_slow_queries):
+
+    slow_queries.enable(threshold_ms=100000)
+    list(Sample.find())
+    assert len(slow_queries.entries) == 0
+
+
+def test_slow_queries_dump(Sample, enabled_slow_queries, tmpdir):
+
+    list(Sample.find({"a": 1}))
+
+    path = str(tmpdir.join("slow.json"))
+    slow_queries.dump(path)
+
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+
+    assert len(lines) == 1
+    assert lines[0]["shape"] == {"a": 1}
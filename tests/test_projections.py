@@ -0,0 +1,115 @@
+import pytest
+from mongokat.projections import ProjectionLearner, AccessTracker, projection_learner
+from . import sample_models
+
+
+@pytest.fixture(scope="function")
+def learner():
+    projection_learner.reset()
+    yield projection_learner
+    projection_learner.disable()
+    projection_learner.reset()
+
+
+def test_access_tracking(offline_sample):
+
+    tracker = AccessTracker("site")
+    doc = offline_sample({"_id": 1, "a": 1, "b": 2, "c": 3}, access_tracker=tracker)
+
+    assert tracker.documents == 1
+    assert tracker.fields == set(["_id"])
+
+    assert doc["a"] == 1
+    assert doc.get("b") == 2
+    assert "x" not in doc
+    assert tracker.fields == set(["_id", "a", "b", "x"])
+    assert not tracker.full
+
+    # Untracked documents aren't affected, and keep the plain dict methods
+    untracked = offline_sample({"a": 1})
+    assert "a" in untracked
+    assert untracked.__class__ is sample_models.SampleDocument
+    assert doc.__class__ is not sample_models.SampleDocument
+    assert isinstance(doc, sample_models.SampleDocument)
+
+    # Truth testing doesn't need the whole document
+    assert doc
+
+    # The whole document is needed
+    for read_all in (list, dict, len, lambda doc: doc.copy(), lambda doc: doc.items()):
+        tracker = AccessTracker("site")
+        doc = offline_sample({"_id": 1, "a": 1}, access_tracker=tracker)
+        read_all(doc)
+        assert tracker.full
+
+
+def test_prepare(offline_sample):
+
+    learner = ProjectionLearner()
+    learner.enable("learn")
+
+    def find(**kwargs):
+        # Stands for find_method: prepare() looks 2 frames up for the call site
+        learner.prepare(offline_sample, "find", kwargs)
+        return kwargs
+
+    def call_site():
+        return find()
+
+    kwargs = call_site()
+    tracker = kwargs["access_tracker"]
+    assert "projection" not in kwargs
+    assert "in call_site" in tracker.site
+
+    # Explicit projections aren't tracked
+    assert find(projection={"a": 1}) == {"projection": {"a": 1}}
+    assert "access_tracker" not in find(as_records=True)
+
+    tracker.fields.add("a")
+    tracker.documents = 19
+    learner.enable("auto", min_documents=20)
+    assert "projection" not in call_site()
+
+    tracker.documents = 20
+    assert call_site()["projection"] == {"_id": True, "a": True}
+
+    tracker.needs_full()
+    assert "projection" not in call_site()
+
+    assert list(learner.learned().values()) == [None]
+
+    with pytest.raises(ValueError):
+        learner.enable("sometimes")
+
+
+def find_samples(Sample):
+    return list(Sample.find({}, sort=[("_id", 1)]))
+
+
+def test_projection_learning(Sample, learner):
+
+    Sample.insert_many([{"_id": i, "name": "n%s" % i, "big": "x" * 1000, "other": i} for i in range(5)])
+
+    learner.enable("learn", min_documents=5)
+    assert [doc["name"] for doc in find_samples(Sample)] == ["n%s" % i for i in range(5)]
+    assert list(learner.learned().values()) == [["_id", "name"]]
+
+    learner.enable("auto", min_documents=5)
+    docs = find_samples(Sample)
+    assert not dict.__contains__(docs[0], "big")
+    assert [doc["name"] for doc in docs] == ["n%s" % i for i in range(5)]
+
+    # Fetched on access, then added to the projection
+    assert docs[0]["other"] == 0
+    assert list(learner.learned().values()) == [["_id", "name", "other"]]
+
+    # Reading the whole document fetches the fields outside of the projection
+    assert dict(docs[2]) == {"_id": 2, "name": "n2", "big": "x" * 1000, "other": 2}
+    assert list(learner.learned().values()) == [None]
+
+    # Projected documents can still be saved
+    docs[1]["name"] = "changed"
+    docs[1].save()
+    saved = Sample.find_one({"_id": 1}, fields=["name", "big"])
+    assert saved["name"] == "changed"
+    assert saved["big"] == "x" * 1000
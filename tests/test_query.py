@@ -0,0 +1,122 @@
+import datetime
+import re
+import pytest
+from bson import ObjectId
+from mongokat.query import matches, compile_filter, sort_documents, project
+from mongokat.exceptions import UnsupportedQueryError
+
+
+DOC = {
+    "_id": 1,
+    "name": "paris",
+    "n": 5,
+    "flag": True,
+    "tags": ["a", "b"],
+    "sub": {"x": 1, "items": [{"y": 1}, {"y": 2}]},
+    "date": datetime.datetime(2020, 1, 1),
+    "none": None
+}
+
+
+CASES = [
+    ({}, True),
+    ({"name": "paris"}, True),
+    ({"name": "london"}, False),
+    ({"n": 5.0}, True),
+    ({"flag": 1}, False),
+    ({"tags": "a"}, True),
+    ({"tags": ["a", "b"]}, True),
+    ({"tags": ["b", "a"]}, False),
+    ({"sub.x": 1}, True),
+    ({"sub": {"x": 1}}, False),
+    ({"sub.items.y": 2}, True),
+    ({"sub.items.1.y": 2}, True),
+    ({"sub.items.0.y": 2}, False),
+    ({"missing": None}, True),
+    ({"none": None}, True),
+    ({"n": {"$gt": 4, "$lte": 5}}, True),
+    ({"n": {"$gt": "4"}}, False),
+    ({"name": {"$gte": "p"}}, True),
+    ({"date": {"$lt": datetime.datetime(2021, 1, 1)}}, True),
+    ({"n": {"$in": [1, 5]}}, True),
+    ({"tags": {"$in": ["c", "b"]}}, True),
+    ({"tags": {"$nin": ["c", "b"]}}, False),
+    ({"missing": {"$in": [None]}}, True),
+    ({"n": {"$ne": 5}}, False),
+    ({"missing": {"$exists": False}}, True),
+    ({"none": {"$exists": True}}, True),
+    ({"$or": [{"n": 1}, {"name": "paris"}]}, True),
+    ({"$and": [{"n": 5}, {"name": "london"}]}, False),
+    ({"$nor": [{"n": 1}]}, True),
+    ({"n": {"$not": {"$gt": 4}}}, False),
+    ({"missing": {"$not": {"$gt": 4}}}, True),
+    ({"sub.items": {"$elemMatch": {"y": {"$gte": 2}}}}, True),
+    ({"sub.items": {"$elemMatch": {"y": 3}}}, False),
+    ({"tags": {"$elemMatch": {"$in": ["b", "c"]}}}, True),
+    ({"name": {"$elemMatch": {"$eq": "paris"}}}, False),
+    ({"sub": {"$in": [{"x": 1, "items": [{"y": 1}, {"y": 2}]}]}}, True),
+    ({"sub.items": {"$in": [{"y": 2}, 1]}}, True),
+    ({"flag": {"$in": [1]}}, False),
+    ({"n": {"$nin": [None]}}, True),
+]
+
+
+@pytest.mark.parametrize("query, expected", CASES)
+def test_matches(query, expected):
+    assert matches(DOC, query) is expected
+
+
+@pytest.mark.parametrize("query, expected", CASES)
+def test_compile_filter(query, expected):
+    assert compile_filter(query)(DOC) is expected
+
+
+def test_compile_filter_cache():
+
+    predicate = compile_filter({"n": {"$in": [1, 5]}})
+    assert compile_filter({"n": {"$in": [1, 5]}}) is predicate
+    assert compile_filter({"n": {"$in": [1, 6]}}) is not predicate
+
+    # Documents are plain dicts or Documents, with missing fields
+    assert predicate({"n": 1})
+    assert not predicate({})
+
+
+def test_compile_filter_unsupported():
+
+    # Errors are raised when compiling, not when testing a document
+    with pytest.raises(UnsupportedQueryError):
+        compile_filter({"name": {"$regex": "^p"}})
+
+    with pytest.raises(UnsupportedQueryError):
+        compile_filter({"$where": "true"})
+
+    with pytest.raises(UnsupportedQueryError):
+        compile_filter({"n": {"$not": 5}})
+
+    with pytest.raises(UnsupportedQueryError):
+        compile_filter({"name": re.compile("^p")})
+
+
+def test_unsupported():
+
+    with pytest.raises(UnsupportedQueryError):
+        matches(DOC, {"name": {"$regex": "^p"}})
+
+    with pytest.raises(UnsupportedQueryError):
+        matches(DOC, {"name": re.compile("^p")})
+
+    with pytest.raises(UnsupportedQueryError):
+        matches(DOC, {"$where": "true"})
+
+
+def test_sort_and_project():
+
+    docs = [{"a": 2, "b": 1}, {"a": 1, "b": 2}, {"b": 3}, {"a": "x"}, {"a": 1, "b": 1}]
+    sort_documents(docs, [("a", 1), ("b", -1)])
+    assert docs == [{"b": 3}, {"a": 1, "b": 2}, {"a": 1, "b": 1}, {"a": 2, "b": 1}, {"a": "x"}]
+
+    assert project(DOC, {"name": 1, "sub.x": 1, "_id": 0}) == {"name": "paris", "sub": {"x": 1}}
+    projected = project(DOC, {"sub.items": 0, "tags": 0, "date": 0, "none": 0, "flag": 0})
+    assert projected == {"_id": 1, "name": "paris", "n": 5, "sub": {"x": 1}}
+    assert "items" in DOC["sub"]
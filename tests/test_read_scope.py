@@ -0,0 +1,70 @@
+from bson import ObjectId
+from mongokat.metrics import metrics
+from mongokat.read_scope import _filter_ids, current_read_scope
+
+
+def test_filter_ids():
+
+    assert _filter_ids({"_id": 1, "a": 2}) == [1]
+    assert _filter_ids({"_id": {"$in": [1, 2]}}) == [1, 2]
+    assert _filter_ids({"_id": {"$gt": 1}}) is None
+    assert _filter_ids({"a": 1}) is None
+    assert _filter_ids(None) is None
+    assert _filter_ids(5) == [5]
+
+
+def test_read_scope(Sample):
+
+    _id = Sample.insert_one({"name": "a", "n": 1}).inserted_id
+    other_id = Sample.insert_one({"name": "b", "n": 2}).inserted_id
+
+    with Sample.read_scope() as scope:
+
+        assert current_read_scope() is scope
+
+        doc = Sample.find_by_id(_id)
+        assert scope.misses == 1
+
+        doc2 = Sample.find_one({"_id": _id})
+        assert scope.hits == 1
+        assert doc2 == doc
+        assert doc2 is not doc
+
+        # Cached copies are not affected by local changes
+        doc2["name"] = "local"
+        assert Sample.find_by_id(_id)["name"] == "a"
+
+        # Projections are derived from the full document
+        partial = Sample.find_one({"_id": _id}, fields=["n"])
+        assert partial == {"n": 1}
+        assert scope.misses == 1
+
+        docs = Sample.find_by_ids([other_id, _id, ObjectId()])
+        assert [d["name"] for d in docs] == ["b", "a"]
+        assert scope.misses == 3
+        assert Sample.find_by_id(other_id)["name"] == "b"
+
+        # Writes evict what they target
+        Sample.update_one({"_id": _id}, {"$set": {"n": 2}})
+        assert Sample.find_by_id(_id)["n"] == 2
+
+        Sample.update_many({}, {"$set": {"n": 3}})
+        assert Sample.find_by_id(other_id)["n"] == 3
+
+        # Other queries are not cached
+        assert Sample.find_one({"name": "a"})["n"] == 3
+
+    assert current_read_scope() is None
+
+
+def test_read_scope_ensure_fields(Sample):
+
+    _id = Sample.insert_one({"name": "a", "n": 1}).inserted_id
+
+    with Sample.read_scope() as scope:
+        Sample.find_by_id(_id)
+
+        doc = Sample.find_by_id(_id, fields=["name"])
+        doc.ensure_fields(["n"])
+        assert doc["n"] == 1
+        assert scope.misses == 1
@@ -0,0 +1,52 @@
+import pickle
+import pytest
+from mongokat.records import record_class, projection_fields, Record
+
+
+def test_record_class():
+
+    assert projection_fields({"a": 1, "b.c": 1, "_id": 0}) == ("a", "b")
+    assert projection_fields(["b", "a"]) == ("_id", "a", "b")
+
+    with pytest.raises(ValueError):
+        projection_fields(None)
+
+    with pytest.raises(ValueError):
+        record_class(("keys", ))
+
+    cls = record_class(("_id", "a", "b"))
+    assert record_class(("_id", "a", "b")) is cls
+
+    rec = cls({"_id": 1, "a": 2})
+    assert not hasattr(rec, "__dict__")
+    assert rec.a == 2
+    assert rec["_id"] == 1
+    assert rec.get("b", 3) == 3
+    assert "b" not in rec
+    assert dict(rec.items()) == {"_id": 1, "a": 2}
+    assert rec == {"_id": 1, "a": 2}
+
+    with pytest.raises(KeyError):
+        rec["b"]
+
+    with pytest.raises(AttributeError):
+        rec.a = 3
+
+    assert pickle.loads(pickle.dumps(rec)) == rec
+
+
+def test_find_as_records(Sample):
+
+    Sample.insert_many([{"name": "a", "n": 1, "other": 1}, {"name": "b", "n": 2, "other": 2}])
+
+    records = list(Sample.find({}, fields=["name", "n"], sort=[("n", 1)], as_records=True))
+
+    assert len(records) == 2
+    assert isinstance(records[0], Record)
+    assert [r.name for r in records] == ["a", "b"]
+    assert records[1]["n"] == 2
+    assert "other" not in records[0]
+    assert "_id" not in records[0]
+
+    with pytest.raises(ValueError):
+        Sample.find({}, as_records=True)
@@ -0,0 +1,87 @@
+import os
+import pickle
+import pytest
+from mongokat import Collection, Document
+from mongokat.registry import ClientRegistry, registry
+from mongokat.parallel import collection_client_factory, process_collection
+
+
+class LazyDocument(Document):
+    pass
+
+
+class LazyCollection(Collection):
+    __database__ = "test_registry"
+    __collection__ = "lazy"
+    document_class = LazyDocument
+
+
+@pytest.fixture(scope="function")
+def registered():
+    registry.register("test_registry", "mongodb://127.0.0.1:27017", maxPoolSize=5)
+    yield registry
+    registry.unregister("test_registry")
+
+
+def test_client_registry(monkeypatch):
+
+    reg = ClientRegistry()
+    with pytest.raises(Exception):
+        reg.client("app")
+
+    reg.register("app", "mongodb://127.0.0.1:27017", maxPoolSize=5)
+    reg.register("other", "mongodb://127.0.0.1:27017", maxPoolSize=5)
+    reg.register(None, "mongodb://127.0.0.1:27018")
+
+    client = reg.client("app")
+    assert reg.client("app") is client
+    assert client.max_pool_size == 5
+
+    # Same settings, same client. Unregistered databases use the default settings
+    assert reg.client("other") is client
+    assert reg.client("unknown") is not client
+    assert reg.is_registered("unknown")
+
+    # A forked process gets its own client
+    pid = os.getpid()
+    monkeypatch.setattr(os, "getpid", lambda: pid + 1)
+    assert reg.client("app") is not client
+
+
+def test_lazy_collection(registered, monkeypatch):
+
+    # No client is needed to build the collection
+    collection = LazyCollection()
+    assert collection.is_lazy
+    assert "collection" not in collection.__dict__
+
+    assert collection.collection.full_name == "test_registry.lazy"
+    assert collection.database.name == "test_registry"
+    assert collection.client is registry.client("test_registry")
+    assert collection.db is collection.database
+
+    # Handles are resolved again after a fork
+    client = collection.client
+    pid = os.getpid()
+    monkeypatch.setattr(os, "getpid", lambda: pid + 1)
+    assert collection.client is not client
+    assert collection.client is registry.client("test_registry")
+    assert collection.collection.database.client is collection.client
+
+    with pytest.raises(Exception):
+        Collection()
+
+
+def test_lazy_collection_pickle(registered):
+
+    collection = LazyCollection()
+    doc = collection({"_id": 1, "a": 1})
+
+    factory = collection_client_factory(collection)
+    assert factory() is collection.client
+
+    unpickled = pickle.loads(pickle.dumps(doc))
+    assert unpickled == doc
+    assert isinstance(unpickled, LazyDocument)
+    assert unpickled.mongokat_collection is process_collection(LazyCollection, factory, "test_registry", "lazy")
+    assert unpickled.mongokat_collection.client is collection.client
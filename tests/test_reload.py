@@ -0,0 +1,49 @@
+import pytest
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+
+def test_reload_many(Sample):
+
+    Sample.insert_many([{"name": "a", "n": 1}, {"name": "b", "n": 2}, {"name": "c", "n": 3}])
+    docs = list(Sample.find(sort=[("n", 1)]))
+
+    Sample.update_many({}, {"$inc": {"n": 10}})
+    for doc in docs:
+        doc["local"] = True
+
+    Sample.reload_many(docs, chunk_size=2)
+
+    assert [doc["n"] for doc in docs] == [11, 12, 13]
+    assert not any("local" in doc for doc in docs)
+
+    docs.append(Sample({"_id": ObjectId(), "name": "d"}))
+    with pytest.raises(OperationFailure):
+        Sample.reload_many(docs)
+
+    # Nothing was modified
+    assert docs[-1]["name"] == "d"
+
+
+def test_reload_fields(Sample):
+
+    Sample.insert_one({"name": "a", "n": 1, "sub": {"x": 1, "y": 1}, "old": 1})
+    doc = Sample.find_one({"name": "a"}, fields=["name", "old"])
+
+    Sample.update_one({"_id": doc["_id"]}, {"$set": {"name": "b", "n": 2, "sub.x": 2}, "$unset": {"old": 1}})
+    doc["local"] = True
+
+    doc.reload(fields=["n", "sub.x", "old"])
+
+    assert doc["name"] == "a"
+    assert doc["n"] == 2
+    assert doc["sub"] == {"x": 2}
+    assert "old" not in doc
+    assert doc["local"]
+    assert set(doc._fetched_fields) == set(["name", "old", "n", "sub.x"])
+
+    doc.reload()
+    assert doc["name"] == "b"
+    assert doc["sub"] == {"x": 2, "y": 1}
+    assert doc._fetched_fields is None
+    assert "local" not in doc
@@ -4,8 +4,8 @@ from mongokat import Document, Collection
 class ShortNamesDocument(Document):
   """ This Document subclass supports limited alias names, as suggested in https://github.com/pricingassistant/mongokat/issues/13
 
-  Note that they don't work in queries, field name lists, or dict(doc). Further subclassing would be necessary
-  for that to work. Pull Requests welcome, though we won't include that in MongoKat itself.
+  Note that they don't work in queries, field name lists, or dict(doc). Declare short_names on the Collection
+  instead for that, as in test_collection_shortnames below.
   """
 
   short_names = {
@@ -55,3 +55,52 @@ def test_shortnames(db):
   assert len(raw_docs) == 1
   assert "value" not in raw_docs[0]
   assert raw_docs[0]["v"] == "2"
+
+
+class CollectionShortNamesCollection(Collection):
+  short_names = {
+    "description": "d",
+    "value": "v"
+  }
+
+
+def test_collection_shortnames(db):
+  db.test_shortnames.drop()
+  SN = CollectionShortNamesCollection(collection=db.test_shortnames)
+
+  doc = SN({"description": "desc", "value": {"a": 1}, "regular": "1"})
+  doc.save()
+  assert "_id" in doc
+
+  # Bypass mongokat to see the real document
+  raw_docs = list(db.test_shortnames.find())
+  assert raw_docs == [{"_id": doc["_id"], "d": "desc", "v": {"a": 1}, "regular": "1"}]
+
+  docs = list(SN.find({"description": "desc", "value.a": 1}, sort=[("value", 1)]))
+  assert len(docs) == 1
+  assert dict(docs[0]) == {"_id": doc["_id"], "description": "desc", "value": {"a": 1}, "regular": "1"}
+
+  docs = list(SN.find({"$or": [{"description": "desc"}]}, fields=["value"]))
+  assert dict(docs[0]) == {"value": {"a": 1}}
+  docs[0].ensure_fields(["description"])
+  assert docs[0]["description"] == "desc"
+
+  assert SN.count({"description": "desc"}) == 1
+  assert SN.distinct("description") == ["desc"]
+  assert SN.list_column({}, "value.a") == [1]
+
+  SN.update_one({"description": "desc"}, {"$set": {"value.a": 2}, "$inc": {"counter": 1}})
+  doc = SN.find_one({"_id": doc["_id"]})
+  assert doc["value"] == {"a": 2}
+
+  doc.save_partial({"description": "desc2"})
+  assert db.test_shortnames.find_one()["d"] == "desc2"
+
+  doc = SN.find_one_and_update({"description": "desc2"}, {"$set": {"description": "desc3"}}, return_document="after")
+  assert doc["description"] == "desc3"
+
+  SN.insert_many([{"description": "x"}, {"description": "y"}])
+  assert SN.count() == 3
+
+  SN.delete_many({"description": {"$in": ["x", "y"]}})
+  assert SN.count() == 1
@@ -0,0 +1,168 @@
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+from mongokat.write_buffer import merge_update
+from . import sample_models
+
+
+def test_merge_update():
+
+    pending = {}
+    assert merge_update(pending, {"$inc": {"views": 1}})
+    assert merge_update(pending, {"$inc": {"views": 2}, "$set": {"name": "x"}})
+    assert pending == {"$inc": {"views": 3}, "$set": {"name": "x"}}
+
+    # $set then $inc folds into the $set
+    assert merge_update(pending, {"$inc": {"name_len": 1}})
+    assert merge_update(pending, {"$set": {"score": 1}})
+    assert merge_update(pending, {"$inc": {"score": 4}})
+    assert pending["$set"]["score"] == 5
+
+    # $unset then $inc is a $set
+    assert merge_update(pending, {"$unset": {"x": ""}})
+    assert merge_update(pending, {"$inc": {"x": 2}})
+    assert pending["$set"]["x"] == 2
+    assert "$unset" not in pending
+
+    assert merge_update(pending, {"$max": {"best": 3}})
+    assert merge_update(pending, {"$max": {"best": 1}})
+    assert pending["$max"] == {"best": 3}
+
+    # Conflicts leave pending untouched
+    before = {k: dict(v) for k, v in pending.items()}
+    assert not merge_update(pending, {"$inc": {"best": 1}})
+    assert not merge_update(pending, {"$set": {"views.sub": 1}})
+    assert pending == before
+
+    with pytest.raises(ValueError):
+        merge_update(pending, {"$push": {"l": 1}})
+
+
+def test_write_buffer_filter(offline_sample):
+
+    buf = offline_sample.write_buffer(flush_interval=None)
+
+    with pytest.raises(ValueError):
+        buf.update_one({"_id": 1, "a": 1}, {"$set": {"b": 1}})
+    with pytest.raises(ValueError):
+        buf.update_one({"a": 1}, {"$set": {"b": 1}})
+    with pytest.raises(ValueError):
+        buf.update_one({"_id": {"$in": [1, 2]}}, {"$set": {"b": 1}})
+
+    assert not buf._pending
+
+
+def test_write_buffer_failed_flush(offline_sample):
+
+    writes = []
+    errors = [AutoReconnect("down"), BulkWriteError({"writeErrors": [{"index": 1, "code": 14, "errmsg": "type"}]})]
+
+    def bulk_write(requests, ordered=True):
+        writes.append([request._filter["_id"] for request in requests])
+        if errors:
+            raise errors.pop(0)
+
+    offline_sample.bulk_write = bulk_write
+    buf = offline_sample.write_buffer(flush_interval=None)
+    buf.update_one(1, {"$inc": {"views": 1}})
+    buf.update_one(2, {"$inc": {"views": 1}})
+
+    # Nothing was written: everything stays buffered
+    with pytest.raises(AutoReconnect):
+        buf.flush()
+    assert list(buf._pending) == [1, 2]
+    assert buf.flushed_ops == 0
+
+    # Only the failed update is buffered again, and merged with the next ones
+    buf.update_one(3, {"$inc": {"views": 1}})
+    with pytest.raises(BulkWriteError):
+        buf.flush()
+    assert writes[1] == [1, 2, 3]
+    assert list(buf._pending) == [2]
+    assert buf.flushed_ops == 2
+
+    buf.update_one(2, {"$inc": {"views": 2}})
+    buf.close()
+    assert writes[2] == [2]
+    assert buf.flushed_ops == 3
+    assert not buf._pending
+
+
+def test_write_buffer_update_during_flush(offline_sample):
+
+    writes = []
+    buf = offline_sample.write_buffer(flush_interval=None)
+
+    def bulk_write(requests, ordered=True):
+        writes.append([(request._filter["_id"], request._doc) for request in requests])
+        if len(writes) == 1:
+            # Not blocked by the write in progress, and not mergeable with the failed update
+            buf.update_one(1, {"$inc": {"views": 1}})
+            buf.update_one(2, {"$inc": {"views": 1}})
+            raise AutoReconnect("down")
+
+    offline_sample.bulk_write = bulk_write
+    buf.update_one(1, {"$max": {"views": 5}})
+    buf.update_one(2, {"$inc": {"views": 1}})
+
+    with pytest.raises(AutoReconnect):
+        buf.flush()
+
+    # The failed updates are written before the newer ones
+    buf.flush()
+    assert writes[1] == [(1, {"$max": {"views": 5}})]
+    assert writes[2] == [(1, {"$inc": {"views": 1}}), (2, {"$inc": {"views": 2}})]
+    assert buf.flushed_ops == 3
+    assert not buf._pending and not buf._retry
+
+
+def test_write_buffer(Sample):
+
+    Sample.insert_many([{"_id": 1, "views": 0}, {"_id": 2, "views": 0}])
+
+    with Sample.write_buffer(flush_interval=None) as buf:
+        for _ in range(10):
+            buf.update_one({"_id": 1}, {"$inc": {"views": 1}})
+        buf.update_one(2, {"$set": {"name": "b"}})
+
+        assert Sample.find_one({"_id": 1})["views"] == 0
+
+        buf.flush()
+        assert Sample.find_one({"_id": 1})["views"] == 10
+        assert Sample.find_one({"_id": 2})["name"] == "b"
+
+        buf.update_one({"_id": 1}, {"$max": {"views": 20}})
+        # Unmergeable: the $max is flushed first
+        buf.update_one({"_id": 1}, {"$inc": {"views": 1}})
+        assert Sample.find_one({"_id": 1})["views"] == 20
+
+        doc = Sample.find_one({"_id": 2})
+        buf.save_partial(doc, {"name": "c"})
+        assert doc["name"] == "c"
+
+    assert Sample.find_one({"_id": 1})["views"] == 21
+    assert Sample.find_one({"_id": 2})["name"] == "c"
+    assert buf.flushed_ops == 5
+
+
+def test_write_buffer_max_ops(Sample):
+
+    Sample.insert_one({"_id": 1, "views": 0})
+
+    buf = Sample.write_buffer(flush_interval=None, max_ops=3)
+    for _ in range(3):
+        buf.update_one({"_id": 1}, {"$inc": {"views": 1}})
+    assert Sample.find_one({"_id": 1})["views"] == 3
+    buf.close()
+
+
+def test_write_buffer_hooks(WithHooks):
+
+    WithHooks.insert_one({"_id": 1, "a": 1})
+    sample_models.GLOBAL_HOOK_HISTORY = []
+
+    with WithHooks.write_buffer(flush_interval=None) as buf:
+        buf.update_one({"_id": 1}, {"$inc": {"a": 1}})
+        buf.update_one({"_id": 1}, {"$inc": {"a": 1}})
+
+    assert sample_models.GLOBAL_HOOK_HISTORY == [["after_save", 3]]
+    sample_models.GLOBAL_HOOK_HISTORY = []